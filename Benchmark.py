@@ -0,0 +1,517 @@
+"""
+This file measures how the main code paths scale, so that a change that makes them slower can be caught:
+- dbAPI.update_study_progress, dbAPI.get_next_new_material, dbAPI.get_study_progress_df,
+  EbbinghausPlanner.get_recite_material and the StudiedRanks of dbAPI.get_studied_ranks, on synthetic databases with a
+  10000 words list and study histories from 1 day to 10 years (20 new words a day until the list runs out, recited on
+  the Ebbinghaus dates)
+- one daily session (next material, record it, get the recite material) for 1 to 1000 users, each user in a database
+  file of their own, like every user of the single-user program has
+- the words due today of 1 to 1000 users of one database (e.g. a class), as the batched pass of
+  SM2Planner.get_due_ranks_of_users against a SM2Planner.load per user, and folding a tail of reviews of every user
+- ReciteMaterialGenerator (one by one, concurrent and batched) against the fake chat completions server, with a
+  configurable latency per request
+- the startup of CommandLineInterface ("--help" and "due"), as whole processes, against its startup budget
+Nothing here touches my_database.db: the databases are made in a temporary directory, and deleted at the end.
+The results are saved as json in benchmark_results/, with the git commit they were measured on. Two result files can
+be compared with --compare.
+Usage:
+    python Benchmark.py
+    python Benchmark.py --days 1 365 3650 --users 1 1000 --latencies 0 0.2 --repeats 50
+    python Benchmark.py --compare benchmark_results/old.json benchmark_results/new.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+import dbAPI
+import dbConnection
+import CommandLineInterface
+from FakeChatGPTServer import start_fake_server
+from ReciteMaterialGenerator import ReciteMaterialGenerator
+from RecitePlanner import EbbinghausPlanner, SM2Planner, today_as_day
+import VocabStore
+
+results_directory = "benchmark_results"
+num_synthetic_ranks = 10000
+num_new_words_per_day = 20
+ebbinghaus_intervals = [1, 2, 4, 7, 15, 30, 90, 180]  # the same as EbbinghausPlanner._get_normal_recite_dates()
+default_history_days = [1, 30, 365, 3650]
+default_num_users = [1, 10, 100, 1000]
+default_user_history_days = 365  # the history of every user in the multi-user sessions
+default_latencies = [0.0, 0.05]
+num_scheduled_words_per_user = 1000  # the per-word schedule of every user in the batched due pass
+num_tail_events_per_user = 20  # the reviews of every user that SM2Planner.compact_users folds
+num_generated_words = 20  # how many words ReciteMaterialGenerator gets in one benchmark run
+slower_ratio = 1.2  # --compare marks a result as slower if its median is this much larger than before
+hebrew_letters = "אבגדהוזחטיכלמנסעפצקרשת"
+latin_letters = "abdeghiklmnoprstuvyz"
+
+
+def run_benchmarks(history_days=default_history_days, num_users=default_num_users,
+                   user_history_days=default_user_history_days, latencies=default_latencies, repeats=20,
+                   generator_repeats=3, cli_repeats=5, output_path=None):
+    """
+    :param history_days: the lengths of study history (in days) to measure the database code paths on
+    :param num_users: the numbers of users to measure the daily sessions for
+    :param user_history_days: how many days of history every user has in the multi-user sessions
+    :param latencies: the latencies (in seconds) of the fake server to measure ReciteMaterialGenerator with
+    :param repeats: how many times each database code path is measured
+    :param generator_repeats: how many times each way of generating is measured
+    :param cli_repeats: how many times each command line is started
+    :param output_path: where to save the json, by default benchmark_results/<date>_<commit>.json
+    :return: the report that was saved: a dictionary with the environment and a list of results
+    """
+    results = []
+    original_database = dbAPI.my_database
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            word_list_path = os.path.join(directory, "word_list.db")
+            _create_word_list_database(word_list_path)
+            for days in sorted(set(history_days) | {user_history_days}):
+                history_path = os.path.join(directory, f"history_{days}_days.db")
+                shutil.copyfile(word_list_path, history_path)
+                _fill_study_history(history_path, days)
+                if days in history_days:
+                    results += _benchmark_database_code_paths(history_path, days, repeats)
+                if days == user_history_days:
+                    for users in num_users:
+                        results.append(_benchmark_user_sessions(history_path, days, users, directory))
+            for users in num_users:
+                results += _benchmark_due_of_users(word_list_path, users, directory, repeats)
+            _use_database(original_database)
+            for latency in latencies:
+                results += _benchmark_generator(latency, generator_repeats)
+            results += _benchmark_cli_startup(cli_repeats)
+    finally:
+        _use_database(original_database)
+    report = {"commit": _get_git_commit(), "created_at": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+              "results": results, "word_list_requests": count_word_list_requests(original_database)}
+    if output_path is None:
+        commit = (report["commit"]["hash"] or "unknown")[:10]
+        output_path = os.path.join(results_directory, f"{datetime.now().strftime('%Y-%m-%d_%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print_results(results)
+    if report["word_list_requests"] is not None:
+        print(format_word_list_requests(report["word_list_requests"]))
+    print(f"The results are saved in {output_path}")
+    return report
+
+
+def count_word_list_requests(db_path=dbAPI.my_database):
+    """
+    How many requests generating the whole real frequency list takes, num_new_words_per_day ranks a day: one per row,
+    or one per Hebrew word of the day (all its meanings together, see get_context_sentence_from_ChatGPT_by_sense).
+    :return: a dictionary with the rows, requests_per_row and requests_by_sense, None if db_path has no word list
+    """
+    # connecting would create an empty database where there is none
+    if not os.path.exists(db_path):
+        return None
+    try:
+        rows = dbConnection.get_connection(db_path).execute(
+            f"SELECT Rank, Hebrew FROM {dbAPI.hebrew_list_table};").fetchall()
+    except sqlite3.Error:
+        return None
+    days = {}
+    for rank, hebrew in rows:
+        days.setdefault((rank - 1) // num_new_words_per_day, set()).add(hebrew)
+    return {"rows": len(rows), "requests_per_row": len(rows),
+            "requests_by_sense": sum(len(hebrew_words) for hebrew_words in days.values())}
+
+
+def format_word_list_requests(counts):
+    saved = 1 - counts["requests_by_sense"] / counts["requests_per_row"] if counts["requests_per_row"] else 0.0
+    return (f"The whole word list ({counts['rows']} rows): {counts['requests_per_row']} requests one row at a time, "
+            f"{counts['requests_by_sense']} by sense ({100 * saved:.0f}% fewer)")
+
+
+def compare_results(old_path, new_path):
+    """
+    Print the median of every result of old_path next to the one of new_path, and mark the ones that got slower.
+    :return: the names of the results that got slower
+    """
+    with open(old_path, encoding="utf-8") as file:
+        old_report = json.load(file)
+    with open(new_path, encoding="utf-8") as file:
+        new_report = json.load(file)
+    old_medians = {_result_key(result): result["median_ms"] for result in old_report["results"]}
+    print(f"old: {old_report['commit']['hash']} ({old_report['created_at']}), "
+          f"new: {new_report['commit']['hash']} ({new_report['created_at']})")
+    slower = []
+    for result in new_report["results"]:
+        key = _result_key(result)
+        if key not in old_medians:
+            print(f"{key:<70} {'':>10} {result['median_ms']:>10.2f} ms  (new)")
+            continue
+        ratio = result["median_ms"] / old_medians[key] if old_medians[key] else float("inf")
+        mark = "  SLOWER" if ratio > slower_ratio else ""
+        if mark:
+            slower.append(key)
+        print(f"{key:<70} {old_medians[key]:>10.2f} {result['median_ms']:>10.2f} ms  x{ratio:.2f}{mark}")
+    return slower
+
+
+def print_results(results):
+    for result in results:
+        print(f"{_result_key(result):<70} median {result['median_ms']:>10.2f} ms   p95 {result['p95_ms']:>10.2f} ms   "
+              f"{result['ops_per_second']:>10.1f} /s{'   OVER BUDGET' if result.get('over_budget') else ''}")
+
+
+#######################################################################################################################
+#######################################################################################################################
+##################################################### benchmarks ######################################################
+#######################################################################################################################
+#######################################################################################################################
+
+def _benchmark_database_code_paths(history_path, days, repeats):
+    """
+    The dbAPI and planner code paths on a copy of the history (update_study_progress changes it).
+    """
+    database_path = history_path.replace(".db", "_code_paths.db")
+    shutil.copyfile(history_path, database_path)
+    _use_database(database_path)
+    today = datetime.now()
+    recite_planner = EbbinghausPlanner()
+
+    def update_study_progress(i):
+        # a day after the history, with the next new material, like "generate study material for today" does
+        dbAPI.update_study_progress(dbAPI.format_date_string(today + timedelta(days=i + 1)),
+                                    new_material=dbAPI.get_next_new_material(num_new_words_per_day))
+
+    results = [
+        _measure("dbAPI.get_next_new_material", lambda i: dbAPI.get_next_new_material(num_new_words_per_day),
+                 repeats, history_days=days),
+        _measure("dbAPI.get_study_progress_df", lambda i: dbAPI.get_study_progress_df(), repeats,
+                 history_days=days),
+        _measure("EbbinghausPlanner.get_recite_material", lambda i: recite_planner.get_recite_material(), repeats,
+                 history_days=days),
+        _measure("dbAPI.update_study_progress", update_study_progress, repeats, history_days=days),
+    ]
+    # the studied ranks as ranges: loaded once, then "which dates introduced rank X" is a binary search
+    studied_ranks = dbAPI.get_studied_ranks()
+    results += [
+        _measure("dbAPI.get_studied_ranks", lambda i: dbAPI.get_studied_ranks(), repeats, history_days=days),
+        _measure("StudiedRanks.get_dates", lambda i: studied_ranks.get_dates(1 + i * num_new_words_per_day), repeats,
+                 history_days=days),
+    ]
+    # today's words as (hebrew, english), from SQLite and pandas, and from the compiled copy of hebrew_list
+    vocab_store_path = database_path.replace(".db", ".vocab")
+    VocabStore.build_vocab_store(vocab_store_path, database_path)
+    vocab_store = VocabStore.VocabStore(vocab_store_path)
+    results += [
+        _measure("dbAPI.get_vocabs (word pairs)", lambda i: ReciteMaterialGenerator._get_word_pairs(
+            dbAPI.get_vocabs(1 + num_new_words_per_day * i, num_new_words_per_day * (i + 1))), repeats,
+                 history_days=days),
+        _measure("VocabStore.get_vocabs (word pairs)", lambda i: ReciteMaterialGenerator._get_word_pairs(
+            vocab_store.get_vocabs(1 + num_new_words_per_day * i, num_new_words_per_day * (i + 1))), repeats,
+                 history_days=days),
+    ]
+    vocab_store.close()
+    os.remove(vocab_store_path)
+    # the per-word schedule: a day of reviews is appended to the log, loading replays the tail of the log
+    word_planner = SM2Planner.load_or_rebuild()
+
+    def review_due_words(i):
+        day = today_as_day() + i
+        due_ranks = word_planner.get_due_ranks(day, limit=100)
+        word_planner.review(due_ranks, [SM2Planner.default_grade] * len(due_ranks), day)
+        word_planner.save()
+
+    results += [
+        _measure("SM2Planner.review + save", review_due_words, repeats, history_days=days),
+        _measure("SM2Planner.load (snapshot + tail)", lambda i: SM2Planner.load(), repeats, history_days=days),
+        _measure("SM2Planner.compact", lambda i: SM2Planner.compact(), repeats, history_days=days),
+    ]
+    dbConnection.close_all()
+    os.remove(database_path)
+    return results
+
+
+def _benchmark_user_sessions(history_path, days, num_users, directory):
+    """
+    Every user has their own copy of the history, and does one daily session on it. The copies are made before the
+    measurement, and each one is deleted after its session, so only one extra database is on the disk at a time.
+    Each measurement includes opening the user's database, since that is what a session of a user costs.
+    """
+    today_str = dbAPI.format_date_string(datetime.now() + timedelta(days=1))
+    recite_planner = EbbinghausPlanner()
+    durations = []
+    for user in range(num_users):
+        user_path = os.path.join(directory, f"user_{user}.db")
+        shutil.copyfile(history_path, user_path)
+        begin_time = time.perf_counter()
+        _use_database(user_path)
+        dbAPI.update_study_progress(today_str, new_material=dbAPI.get_next_new_material(num_new_words_per_day))
+        recite_planner.get_recite_material()
+        durations.append(time.perf_counter() - begin_time)
+        dbConnection.close_all()
+        os.remove(user_path)
+    return _summarize("daily session per user", durations, history_days=days, num_users=num_users)
+
+
+def _benchmark_due_of_users(word_list_path, num_users, directory, repeats):
+    """
+    num_users users in one database, each with num_scheduled_words_per_user words in the per-word schedule. First the
+    tails of num_tail_events_per_user reviews are folded (once), then the due words of everyone are read, batched and
+    with a loop over the users.
+    """
+    database_path = os.path.join(directory, f"users_{num_users}.db")
+    shutil.copyfile(word_list_path, database_path)
+    user_ids = _fill_word_schedules(database_path, num_users)
+    day = today_as_day()
+
+    def load_per_user(i):
+        for user_id in user_ids:
+            with dbAPI.as_user(user_id):
+                SM2Planner.load().get_due_ranks(day, limit=100)
+
+    results = [
+        _measure("SM2Planner.compact_users", lambda i: SM2Planner.compact_users(user_ids), 1, num_users=num_users),
+        _measure("SM2Planner.get_due_ranks_of_users", lambda i: SM2Planner.get_due_ranks_of_users(
+            user_ids, day, limit=100), repeats, num_users=num_users),
+        _measure("SM2Planner.load + get_due_ranks per user", load_per_user, max(1, repeats // 10),
+                 num_users=num_users),
+    ]
+    dbConnection.close_all()
+    os.remove(database_path)
+    return results
+
+
+def _benchmark_generator(latency_seconds, repeats):
+    """
+    The four ways of generating context sentences, for num_generated_words words, without cache.
+    """
+    server, base_url = start_fake_server(latency_seconds=latency_seconds)
+    words = _make_words()[:num_generated_words]
+    words_df = pd.DataFrame(words, columns=["Rank", "English", "Transliteration", "Hebrew"])
+    generator = ReciteMaterialGenerator(base_url=base_url)
+    methods = {
+        "ReciteMaterialGenerator one by one": generator.get_context_sentence_from_ChatGPT,
+        "ReciteMaterialGenerator concurrently": generator.get_context_sentence_from_ChatGPT_concurrently,
+        "ReciteMaterialGenerator batched": generator.get_context_sentence_from_ChatGPT_batched,
+        "ReciteMaterialGenerator by sense": generator.get_context_sentence_from_ChatGPT_by_sense,
+    }
+    results = []
+    try:
+        for name, method in methods.items():
+            failures = []
+            server.num_requests = 0
+
+            def generate(i):
+                sentences = method(words_df, "fake-api-key")
+                failures.append(sum("Error" in sentence for sentence in sentences))
+
+            result = _measure(name, generate, repeats, latency_seconds=latency_seconds,
+                              num_words=num_generated_words)
+            result["words_per_second"] = num_generated_words * result["ops_per_second"]
+            result["requests_per_run"] = server.num_requests / repeats
+            result["failures"] = sum(failures)
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def _benchmark_cli_startup(repeats):
+    """
+    The time of running the command line as a new process, python's own start included, like cron would run it.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CommandLineInterface.py")
+    results = []
+    for command in ["--help", "due"]:
+        result = _measure(f"CommandLineInterface {command}",
+                          lambda i: subprocess.run([sys.executable, script, command], capture_output=True, check=True),
+                          repeats)
+        result["budget_ms"] = 1000 * CommandLineInterface.startup_budget_seconds
+        result["over_budget"] = result["median_ms"] > result["budget_ms"]
+        results.append(result)
+    return results
+
+
+def _measure(name, function, repeats, **parameters):
+    """
+    :param function: called with the number of the repeat (0, 1, ...)
+    :param parameters: what the result depends on (history_days, num_users...), saved with it
+    """
+    durations = []
+    for i in range(repeats):
+        begin_time = time.perf_counter()
+        function(i)
+        durations.append(time.perf_counter() - begin_time)
+    return _summarize(name, durations, **parameters)
+
+
+def _summarize(name, durations, **parameters):
+    sorted_durations = sorted(durations)
+    p95_index = max(0, math.ceil(0.95 * len(sorted_durations)) - 1)
+    total = sum(durations)
+    return {"name": name, **parameters, "repeats": len(durations),
+            "mean_ms": 1000 * statistics.mean(durations),
+            "median_ms": 1000 * statistics.median(durations),
+            "p95_ms": 1000 * sorted_durations[p95_index],
+            "min_ms": 1000 * sorted_durations[0],
+            "max_ms": 1000 * sorted_durations[-1],
+            "ops_per_second": len(durations) / total if total else float("inf")}
+
+
+def _result_key(result):
+    parameters = [f"{key}={value}" for key, value in result.items()
+                  if key in ("history_days", "num_users", "latency_seconds", "num_words")]
+    return f"{result['name']} [{', '.join(parameters)}]"
+
+
+#######################################################################################################################
+#######################################################################################################################
+################################################# synthetic databases #################################################
+#######################################################################################################################
+#######################################################################################################################
+
+def _use_database(database_path):
+    """
+    dbAPI works on the database file dbAPI.my_database, point it to another one.
+    """
+    dbConnection.close_all()
+    dbAPI.my_database = database_path
+
+
+def _make_words(seed=0):
+    """
+    :return: a list of (rank, english, transliteration, hebrew) with num_synthetic_ranks ranks, every 6th rank has a
+            second meaning, like the real list has several meanings for some words
+    """
+    random_generator = random.Random(seed)
+    rows = []
+    for rank in range(1, num_synthetic_ranks + 1):
+        length = random_generator.randint(2, 6)
+        hebrew = "".join(random_generator.choice(hebrew_letters) for _ in range(length))
+        transliteration = "".join(random_generator.choice(latin_letters) for _ in range(length + 1))
+        rows.append((rank, f"meaning {rank}", transliteration, hebrew))
+        if rank % 6 == 0:
+            rows.append((rank, f"other meaning {rank}", transliteration, hebrew))
+    return rows
+
+
+def _create_word_list_database(database_path):
+    _use_database(database_path)
+    dbAPI._upsert_hebrew_list_rows(_make_words())
+    dbConnection.close_all()
+
+
+def _fill_study_history(database_path, days):
+    """
+    A history of days days that ends today: every day has num_new_words_per_day new words until the list runs out,
+    and every day's new material is recited on the days of ebbinghaus_intervals after it.
+    """
+    today = datetime.now().date()
+    date_strs = [(today - timedelta(days=days - 1 - day)).strftime("%Y-%m-%d") for day in range(days)]
+    study_progress_rows = []
+    for day, date_str in enumerate(date_strs):
+        begin_rank = day * num_new_words_per_day + 1
+        if begin_rank > num_synthetic_ranks:
+            study_progress_rows.append((date_str, None, None))
+        else:
+            study_progress_rows.append((date_str, begin_rank,
+                                        min(begin_rank + num_new_words_per_day - 1, num_synthetic_ranks)))
+    recitation_rows = [(date_strs[day - interval], date_strs[day])
+                       for day in range(days) for interval in ebbinghaus_intervals
+                       if day - interval >= 0 and study_progress_rows[day - interval][1] is not None]
+    _use_database(database_path)
+    user_id = dbAPI.default_user_id
+    with dbAPI.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(f"""INSERT INTO {dbAPI.study_progress_table}
+                               ({dbAPI.user_id_col_name}, {dbAPI.date_string_col_name}) VALUES (?, ?);""",
+                           [(user_id,) + row[:1] for row in study_progress_rows])
+        cursor.executemany(f"""INSERT INTO {dbAPI.study_range_table}
+                               ({dbAPI.user_id_col_name}, {dbAPI.date_string_col_name}, {dbAPI.begin_rank_col_name},
+                                {dbAPI.end_rank_col_name})
+                               VALUES (?, ?, ?, ?);""",
+                           [(user_id,) + row for row in study_progress_rows if row[1] is not None])
+        cursor.executemany(f"""INSERT INTO {dbAPI.recitation_table}
+                               ({dbAPI.user_id_col_name}, {dbAPI.material_date_col_name},
+                                {dbAPI.recited_on_date_col_name})
+                               VALUES (?, ?, ?);""", [(user_id,) + row for row in recitation_rows])
+    dbConnection.get_connection(database_path).execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    dbConnection.close_all()
+
+
+def _fill_word_schedules(database_path, num_users):
+    """
+    num_users users, each with a snapshot of num_scheduled_words_per_user words due on random days around today, and
+    a tail of num_tail_events_per_user reviews after it.
+    :return: the user ids
+    """
+    random_generator = random.Random(0)
+    today = today_as_day()
+    _use_database(database_path)
+    user_ids = [dbAPI.add_user(f"user_{user}") for user in range(num_users)]
+    ranks = range(1, num_scheduled_words_per_user + 1)
+    with dbAPI.transaction() as conn:
+        cursor = conn.cursor()
+        for user_id in user_ids:
+            cursor.executemany(f"""INSERT INTO {dbAPI.word_schedule_table}
+                                   ({dbAPI.user_id_col_name}, {dbAPI.rank_col_name}, {dbAPI.ease_col_name},
+                                    {dbAPI.interval_days_col_name}, {dbAPI.repetitions_col_name},
+                                    {dbAPI.lapses_col_name}, {dbAPI.due_date_col_name})
+                                   VALUES (?, ?, ?, 4, 2, 0, date(?, 'unixepoch'));""",
+                               [(user_id, rank, SM2Planner.default_ease,
+                                 86400 * (today + random_generator.randint(-10, 30))) for rank in ranks])
+            with dbAPI.as_user(user_id):
+                tail_ranks = random_generator.sample(ranks, num_tail_events_per_user)
+                dbAPI.append_review_events([dbAPI.REVIEW] * len(tail_ranks), tail_ranks,
+                                           [SM2Planner.default_grade] * len(tail_ranks), [today] * len(tail_ranks))
+    dbConnection.get_connection(database_path).execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    dbConnection.close_all()
+    return user_ids
+
+
+def _get_git_commit():
+    """
+    :return: {"hash": ..., "dirty": True if there are uncommitted changes}, the hash is None outside a git repository
+    """
+    try:
+        commit_hash = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                     check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return {"hash": None, "dirty": None}
+    return {"hash": commit_hash, "dirty": bool(changes)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the main code paths on synthetic databases.")
+    parser.add_argument("--days", type=int, nargs="+", default=default_history_days,
+                        help="the lengths of study history (in days) to measure the database code paths on")
+    parser.add_argument("--users", type=int, nargs="+", default=default_num_users,
+                        help="the numbers of users to measure a daily session for")
+    parser.add_argument("--user-days", type=int, default=default_user_history_days,
+                        help="the length of study history (in days) of every user")
+    parser.add_argument("--latencies", type=float, nargs="+", default=default_latencies,
+                        help="the latencies (in seconds) of the fake chat completions server")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--generator-repeats", type=int, default=3)
+    parser.add_argument("--cli-repeats", type=int, default=5)
+    parser.add_argument("--output", help="where to save the json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD_JSON", "NEW_JSON"),
+                        help="compare two saved results instead of running the benchmarks")
+    arguments = parser.parse_args()
+    if arguments.compare:
+        compare_results(*arguments.compare)
+    else:
+        run_benchmarks(arguments.days, arguments.users, arguments.user_days, arguments.latencies, arguments.repeats,
+                       arguments.generator_repeats, arguments.cli_repeats, arguments.output)
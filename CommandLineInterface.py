@@ -0,0 +1,317 @@
+"""
+This file is a non-interactive command line for the daily routine, so it can run from cron or a shell script:
+    python CommandLineInterface.py generate [--words 20] [--api-key KEY] [--base-url URL]
+    python CommandLineInterface.py prefetch [--days 7] [--words 20] [--every-hours 6] [--all-users]
+    python CommandLineInterface.py backfill --begin-rank 1 --end-rank 10000 [--requests-per-minute 500] [--name NAME]
+    python CommandLineInterface.py due [--words] [--review] [--all-users]
+    python CommandLineInterface.py progress [--begin 2023-12-01] [--end 2023-12-31] [--rank 123]
+    python CommandLineInterface.py compact [--all-users]
+    python CommandLineInterface.py users [--add NAME]
+    python CommandLineInterface.py export [--format quizlet jsonl anki] [--begin ...] [--end ...] [--incremental NAME]
+    python CommandLineInterface.py index-corpus heb-eng.tsv [--output hebrew_corpus.idx]
+Without a command it starts the interactive menu of UserInterface.
+--user NAME (or user id), before the command, runs it for another user than the default one, see dbAPI.as_user().
+Only the standard library is imported at start, each command imports what it needs when it runs: "due" only computes
+dates (numpy for RecitePlanner), the commands that read the database load pandas, and only "generate" loads openai.
+Startup is measured by Benchmark.py (the time of "--help" and "due", as a whole process, against
+startup_budget_seconds), and --timing prints where the time of one run went.
+"""
+import argparse
+import os
+import sys
+import time
+
+_begin_time = time.perf_counter()
+startup_budget_seconds = 0.5  # for "due" as a whole process, python's own start included
+api_key_environment_variable = "OPENAI_API_KEY"
+
+
+def generate(arguments):
+    import dbAPI
+    import Prefetcher
+    import UserInterface
+    import VocabStore
+    api_key = None
+    # the key is only needed when some of today's words were not prefetched
+    today_ranks = dbAPI.get_next_new_material(arguments.words)
+    if Prefetcher.get_missing_words(VocabStore.get_vocab_store().get_vocabs_of_ranks(today_ranks)):
+        api_key = _get_api_key(arguments)
+        if api_key is None:
+            return 2
+    UserInterface.generate_today_material(arguments.words, api_key, base_url=arguments.base_url)
+    return 0
+
+
+def prefetch(arguments):
+    """
+    Generate the context sentences of the next days' new words, once, or every --every-hours as a worker.
+    """
+    api_key = _get_api_key(arguments)
+    if api_key is None:
+        return 2
+    import Prefetcher
+    options = {"base_url": arguments.base_url, "requests_per_minute": arguments.requests_per_minute,
+               "max_concurrency": arguments.concurrency, "all_users": arguments.all_users}
+    if arguments.every_hours is not None:
+        Prefetcher.run_prefetch_worker(arguments.days, arguments.words, api_key, 3600 * arguments.every_hours,
+                                       **options)
+        return 0
+    report = Prefetcher.prefetch_upcoming_material(arguments.days, arguments.words, api_key, **options)
+    print(Prefetcher.format_prefetch_report(report))
+    return 0 if report["job"] is None or report["job"]["failed"] == 0 else 1
+
+
+def backfill(arguments):
+    """
+    Generate the context sentences of a range of ranks ahead of time, resumable (see GenerationJob).
+    """
+    api_key = _get_api_key(arguments)
+    if api_key is None:
+        return 2
+    import dbAPI
+    from GenerationJob import GenerationJob, format_report
+    name = arguments.name or f"backfill_{arguments.begin_rank}_{arguments.end_rank}"
+    generation_job = GenerationJob(name, dbAPI.get_vocabs(arguments.begin_rank, arguments.end_rank), api_key,
+                                   base_url=arguments.base_url, requests_per_minute=arguments.requests_per_minute,
+                                   tokens_per_minute=arguments.tokens_per_minute,
+                                   max_concurrency=arguments.concurrency, group_senses=arguments.group_senses,
+                                   db_path=dbAPI.my_database)
+    report = generation_job.run()
+    print(format_report(report))
+    return 0 if report["failed"] == 0 else 1
+
+
+def due(arguments):
+    if arguments.all_users:
+        return due_of_all_users(arguments)
+    from RecitePlanner import EbbinghausPlanner
+    recite_planner = EbbinghausPlanner()
+    for date_str in recite_planner.get_recite_datetime():
+        print(date_str)
+    if arguments.words:
+        recite_material_df = recite_planner.get_recite_material()
+        print(f"These dates have {len(recite_material_df)} words to recite:")
+        print(recite_material_df[["Rank", "Hebrew", "Transliteration", "English"]].to_string(index=False))
+    if arguments.review:
+        import dbAPI
+        from RecitePlanner import SM2Planner
+        word_planner = SM2Planner.load_or_rebuild()
+        due_ranks = word_planner.get_due_ranks(limit=arguments.limit)
+        print(f"{len(due_ranks)} words to review today:")
+        print(dbAPI.get_vocabs_of_ranks(due_ranks).to_string(index=False))
+    return 0
+
+
+def due_of_all_users(arguments):
+    """
+    The number of words due today in the per-word schedule of every user, in one batched pass.
+    """
+    import dbAPI
+    from RecitePlanner import SM2Planner
+    due_ranks = SM2Planner.get_due_ranks_of_users(limit=arguments.limit)
+    for user_id, user_name in dbAPI.get_users():
+        print(f"{user_name} ({user_id}): {len(due_ranks.get(user_id, []))} words to review today")
+    return 0
+
+
+def compact(arguments):
+    """
+    Fold the new review events into the per-word schedule, e.g. every night from cron.
+    """
+    from RecitePlanner import SM2Planner
+    if arguments.all_users:
+        num_events = SM2Planner.compact_users()
+        print(f"Folded {sum(num_events.values())} review events of {len(num_events)} users into their schedules")
+        return 0
+    planner, num_events = SM2Planner.compact()
+    print(f"Folded {num_events} review events into the schedule (up to event {planner.last_event_id})")
+    return 0
+
+
+def progress(arguments):
+    import dbAPI
+    if arguments.rank is not None:
+        studied_ranks = dbAPI.get_studied_ranks()
+        dates = studied_ranks.get_dates(arguments.rank)
+        print(f"Rank {arguments.rank} was studied on {', '.join(dates)}" if dates else
+              f"Rank {arguments.rank} was not studied yet")
+        print(f"Studied ranks: {studied_ranks.ranks}")
+        return 0
+    from RangeSet import RangeSet
+    study_progress_df = dbAPI.get_study_progress_df(arguments.begin, arguments.end)
+    # the ranges as "1-40, 50-60"
+    study_progress_df[dbAPI.new_material_col_name] = study_progress_df[dbAPI.new_material_col_name].map(
+        lambda ranges: str(RangeSet(ranges)))
+    print(study_progress_df.to_string(index=False))
+    return 0
+
+
+def export(arguments):
+    import StudyMaterialExporter
+    from contextlib import ExitStack
+    os.makedirs(arguments.output_directory, exist_ok=True)
+    path = os.path.join(arguments.output_directory, arguments.name)
+    with ExitStack() as stack:
+        writers = []
+        if "quizlet" in arguments.format:
+            writers.append(stack.enter_context(StudyMaterialExporter.QuizletWriter(
+                path + ".csv", fields=("Hebrew+Pronounce", "English", "ExampleSentence", "SentenceTranslation"))))
+        if "jsonl" in arguments.format:
+            writers.append(stack.enter_context(StudyMaterialExporter.JsonlWriter(path + ".jsonl")))
+        if "anki" in arguments.format:
+            writers.append(stack.enter_context(StudyMaterialExporter.AnkiPackageWriter(path + ".apkg")))
+        num_cards = StudyMaterialExporter.export_study_material(writers, arguments.begin, arguments.end,
+                                                                incremental_name=arguments.incremental)
+    print(f"Exported {num_cards} words to {path}.*")
+    return 0
+
+
+def index_corpus(arguments):
+    """
+    Build the index of a sentence pairs file, so that "generate" takes the sentences of the corpus when it can.
+    """
+    import SentenceCorpus
+    output_path = arguments.output or SentenceCorpus.corpus_index_path
+    num_sentences = SentenceCorpus.build_corpus_index(arguments.tsv_path, output_path)
+    print(f"Indexed {num_sentences} sentences in {output_path}")
+    return 0
+
+
+def users(arguments):
+    import dbAPI
+    if arguments.add is not None:
+        print(f"User {arguments.add} has the id {dbAPI.add_user(arguments.add)}")
+        return 0
+    for user_id, user_name in dbAPI.get_users():
+        print(f"{user_id}\t{user_name}")
+    return 0
+
+
+def interactive(arguments):
+    import UserInterface
+    UserInterface.main()
+    return 0
+
+
+def run_as_user(arguments):
+    import dbAPI
+    # a name first (it can be all digits), then an id of an existing user
+    user_id = dbAPI.get_user_id(arguments.user)
+    if user_id is None and arguments.user.isdigit() and int(arguments.user) in dict(dbAPI.get_users()):
+        user_id = int(arguments.user)
+    if user_id is None:
+        print(f"There is no user {arguments.user}, add it with: users --add {arguments.user}", file=sys.stderr)
+        return 2
+    with dbAPI.as_user(user_id):
+        return arguments.command(arguments)
+
+
+def _get_api_key(arguments):
+    api_key = arguments.api_key or os.environ.get(api_key_environment_variable)
+    if api_key is None:
+        print(f"Give the OpenAI API key with --api-key or the environment variable {api_key_environment_variable}",
+              file=sys.stderr)
+    return api_key
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Learn the Hebrew frequency list, one day at a time.")
+    parser.add_argument("--timing", action="store_true", help="print how long the imports and the command took")
+    parser.add_argument("--user", help="the name (or id) of the user to run the command for, by default the default "
+                                       "user")
+    parser.set_defaults(command=interactive)
+    subparsers = parser.add_subparsers(title="commands")
+
+    generate_parser = subparsers.add_parser("generate", help="generate today's new words with context sentences")
+    generate_parser.add_argument("--words", type=int, default=20, help="how many new words")
+    generate_parser.add_argument("--api-key",
+                                 help=f"by default the environment variable {api_key_environment_variable}")
+    generate_parser.add_argument("--base-url", help="another chat completions server, e.g. FakeChatGPTServer")
+    generate_parser.set_defaults(command=generate)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="generate the context sentences of the next days' new "
+                                                             "words ahead of time")
+    prefetch_parser.add_argument("--days", type=int, default=7, help="how many days ahead")
+    prefetch_parser.add_argument("--words", type=int, default=20, help="how many new words per day")
+    prefetch_parser.add_argument("--every-hours", type=float,
+                                 help="keep running and prefetch again every this many hours")
+    prefetch_parser.add_argument("--requests-per-minute", type=float, default=500)
+    prefetch_parser.add_argument("--concurrency", type=int, default=5)
+    prefetch_parser.add_argument("--all-users", action="store_true",
+                                 help="the upcoming words of all the users, instead of only the --user")
+    prefetch_parser.add_argument("--api-key",
+                                 help=f"by default the environment variable {api_key_environment_variable}")
+    prefetch_parser.add_argument("--base-url", help="another chat completions server, e.g. FakeChatGPTServer")
+    prefetch_parser.set_defaults(command=prefetch)
+
+    backfill_parser = subparsers.add_parser("backfill", help="generate the context sentences of a range of ranks, "
+                                                             "running it again resumes it")
+    backfill_parser.add_argument("--begin-rank", type=int, required=True)
+    backfill_parser.add_argument("--end-rank", type=int, required=True)
+    backfill_parser.add_argument("--name", help="the name of the job, by default from the ranks")
+    backfill_parser.add_argument("--requests-per-minute", type=float, default=500)
+    backfill_parser.add_argument("--tokens-per-minute", type=float)
+    backfill_parser.add_argument("--concurrency", type=int, default=5)
+    backfill_parser.add_argument("--group-senses", action="store_true",
+                                 help="one request for all the meanings of a Hebrew word, instead of one per row")
+    backfill_parser.add_argument("--api-key",
+                                 help=f"by default the environment variable {api_key_environment_variable}")
+    backfill_parser.add_argument("--base-url", help="another chat completions server, e.g. FakeChatGPTServer")
+    backfill_parser.set_defaults(command=backfill)
+
+    due_parser = subparsers.add_parser("due", help="the dates whose material should be recited today")
+    due_parser.add_argument("--words", action="store_true", help="also print the words of these dates")
+    due_parser.add_argument("--review", action="store_true", help="also print the words due in the per-word schedule")
+    due_parser.add_argument("--limit", type=int, default=100, help="at most this many words of the per-word schedule")
+    due_parser.add_argument("--all-users", action="store_true",
+                            help="only the number of words due in the per-word schedule, of every user")
+    due_parser.set_defaults(command=due)
+
+    compact_parser = subparsers.add_parser("compact", help="fold the new review events into the per-word schedule")
+    compact_parser.add_argument("--all-users", action="store_true", help="the schedules of all the users")
+    compact_parser.set_defaults(command=compact)
+
+    users_parser = subparsers.add_parser("users", help="list the users")
+    users_parser.add_argument("--add", metavar="NAME", help="add a user (e.g. a student of the class)")
+    users_parser.set_defaults(command=users)
+
+    progress_parser = subparsers.add_parser("progress", help="the study progress")
+    progress_parser.add_argument("--begin", help="from this date (inclusive), %%Y-%%m-%%d")
+    progress_parser.add_argument("--end", help="until this date (inclusive), %%Y-%%m-%%d")
+    progress_parser.add_argument("--rank", type=int, help="on which dates this rank was studied, and all the studied "
+                                                          "ranks")
+    progress_parser.set_defaults(command=progress)
+
+    export_parser = subparsers.add_parser("export", help="export the studied words with their context sentences")
+    export_parser.add_argument("--format", nargs="+", choices=["quizlet", "jsonl", "anki"], default=["quizlet"])
+    export_parser.add_argument("--begin", help="from this date (inclusive), %%Y-%%m-%%d")
+    export_parser.add_argument("--end", help="until this date (inclusive), %%Y-%%m-%%d")
+    export_parser.add_argument("--incremental", metavar="NAME",
+                               help="only the words that changed since the last export with this name")
+    export_parser.add_argument("--output-directory", default="GeneratedStudyMaterial")
+    export_parser.add_argument("--name", default="export", help="the file name, without extension")
+    export_parser.set_defaults(command=export)
+
+    index_corpus_parser = subparsers.add_parser("index-corpus", help="index a Hebrew-English sentence pairs file (e.g. "
+                                                                     "from Tatoeba) for offline context sentences")
+    index_corpus_parser.add_argument("tsv_path", help="hebrew id, hebrew, english id, english; or hebrew, english")
+    index_corpus_parser.add_argument("--output", help="the index file, by default the one that generate uses")
+    index_corpus_parser.set_defaults(command=index_corpus)
+    return parser
+
+
+def main(argv=None):
+    arguments = make_parser().parse_args(argv)
+    command_begin_time = time.perf_counter()
+    if arguments.user is None:
+        exit_code = arguments.command(arguments)
+    else:
+        exit_code = run_as_user(arguments)
+    if arguments.timing:
+        print(f"startup {1000 * (command_begin_time - _begin_time):.1f} ms, "
+              f"command {1000 * (time.perf_counter() - command_begin_time):.1f} ms", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+This file contains a fake chat completions server, so that the ReciteMaterialGenerator can be tried out without network
+and without paying OpenAI. It only mimics the part of the API that we use: POST .../chat/completions, and it answers
+with made-up sentences in the format that the prompt asks for (one word, a batch of words, or the meanings of a word).
+Usage:
+    server, base_url = start_fake_server()
+    generator = ReciteMaterialGenerator(base_url=base_url)
+    ...
+    server.shutdown()
+Or run this file directly to have a server on port 8000.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeChatGPTServer(ThreadingHTTPServer):
+    """
+    A local http server that behaves like the chat completions endpoint.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, fail_words=None, max_words_per_response=None, latency_seconds=0.0,
+                 rate_limit_every=None, retry_after_seconds=1.0, rate_limit_code="rate_limit_exceeded", failure_rate=0.0,
+                 seed=0):
+        """
+        :param server_address: (host, port), port 0 means pick a free port
+        :param fail_words: a set of user messages (e.g. "רב (Rabbi)") that the server will answer with an error 500.
+                In a batched request, these words are left out of the answer instead.
+        :param max_words_per_response: if a batched request asks for more words than this, the answer is cut off in the
+                middle with finish_reason "length", like a real response that ran out of tokens
+        :param latency_seconds: how long each request waits before it is answered, like the time a real model takes.
+                Requests are handled in parallel threads, so concurrent requests wait at the same time.
+        :param rate_limit_every: if given, every n-th request is answered with 429 and a Retry-After header of
+                retry_after_seconds, like OpenAI does when the rate limit is reached
+        :param rate_limit_code: the error code of these 429 answers, "insufficient_quota" for an account that ran out
+                of credit
+        :param failure_rate: the fraction of requests (chosen at random, with seed) that are answered with an error
+                500, to test retries
+        """
+        super().__init__(server_address, _FakeChatGPTRequestHandler)
+        self.fail_words = set(fail_words) if fail_words else set()
+        self.max_words_per_response = max_words_per_response
+        self.latency_seconds = latency_seconds
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_seconds = retry_after_seconds
+        self.rate_limit_code = rate_limit_code
+        self.failure_rate = failure_rate
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_injected_failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        """
+        :return: None if the request should be answered, else the injected error: "rate_limit" or "server_error"
+        """
+        with self._lock:
+            self.num_requests += 1
+            if self.rate_limit_every and self.num_requests % self.rate_limit_every == 0:
+                self.num_rate_limited += 1
+                return "rate_limit"
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.num_injected_failures += 1
+                return "server_error"
+            return None
+
+    def make_content(self, user_message):
+        """
+        The fake answer for one user message.
+        """
+        return json.dumps({"ExampleSentence": f"{user_message} משפט לדוגמה",
+                           "SentenceTranslation": f"An example sentence for {user_message}"}, ensure_ascii=False)
+
+    def make_batch_content(self, words):
+        """
+        The fake answer for a batched request, the user message is a json list of words.
+        :return: the content and the finish reason
+        """
+        entries = []
+        for word in words:
+            if word in self.fail_words:
+                continue
+            entry = json.loads(self.make_content(word))
+            entry["Word"] = word
+            entries.append(entry)
+        content = json.dumps(entries, ensure_ascii=False)
+        if self.max_words_per_response is not None and len(words) > self.max_words_per_response:
+            # cut off in the middle of the entry after the last one that fits
+            kept = json.dumps(entries[:self.max_words_per_response], ensure_ascii=False)
+            return kept[:-1] + ", {\"Word\": \"" + words[self.max_words_per_response][:2], "length"
+        return content, "stop"
+
+
+    def make_sense_content(self, word, senses):
+        """
+        The fake answer for a request by sense (see HebrewContextSentenceGeneratorSensePrompt), one entry per meaning.
+        A meaning whose "hebrew (meaning)" is in fail_words is left out of the answer.
+        :return: the content and the finish reason
+        """
+        entries = []
+        for sense in senses:
+            english_hebrew_string = f"{word} ({sense['Meaning']})"
+            if english_hebrew_string in self.fail_words:
+                continue
+            entry = json.loads(self.make_content(english_hebrew_string))
+            entry["Meaning"] = sense["Meaning"]
+            entries.append(entry)
+        return json.dumps(entries, ensure_ascii=False), "stop"
+
+
+class _FakeChatGPTRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        injected_error = self.server.count_request()
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request_body = json.loads(self.rfile.read(length))
+        user_message = request_body["messages"][-1]["content"]
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+        if injected_error == "rate_limit":
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                            "code": self.server.rate_limit_code}},
+                            headers={"Retry-After": str(self.server.retry_after_seconds)})
+            return
+        if injected_error == "server_error":
+            self._send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+            return
+        if user_message in self.server.fail_words:
+            self._send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+            return
+        words = _parse_batch(user_message)
+        if isinstance(words, dict):
+            content, finish_reason = self.server.make_sense_content(words["Word"], words["Senses"])
+        elif words is None:
+            content, finish_reason = self.server.make_content(user_message), "stop"
+        else:
+            content, finish_reason = self.server.make_batch_content(words)
+        self._send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request_body.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": _estimate_usage(request_body["messages"], content),
+        })
+
+    def _send_json(self, status_code, body, headers=None):
+        body_bytes = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body_bytes)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+    def log_message(self, format, *args):
+        # keep the console clean
+        pass
+
+
+def _estimate_usage(messages, content):
+    """
+    Made-up token counts, about 4 characters per token, so that token throughput can be measured.
+    """
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    completion_tokens = len(content) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _parse_batch(user_message):
+    """
+    :return: the list of words if the user message is a batched request, the dictionary {"Word": ..., "Senses": ...}
+            if it is a request by sense, else None
+    """
+    try:
+        words = json.loads(user_message)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(words, list) or (isinstance(words, dict) and "Senses" in words):
+        return words
+    return None
+
+
+def start_fake_server(host="127.0.0.1", port=0, **server_kwargs):
+    """
+    Start the fake server in a background thread.
+    :return: the server (call server.shutdown() when done) and the base_url to give to ReciteMaterialGenerator
+    """
+    server = FakeChatGPTServer((host, port), **server_kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    fake_server = FakeChatGPTServer(("127.0.0.1", 8000))
+    print("Fake chat completions server is running on http://127.0.0.1:8000/v1")
+    fake_server.serve_forever()
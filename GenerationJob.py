@@ -0,0 +1,403 @@
+"""
+This file contains a job runner for generating context sentences for many words, from today's 20 to a backfill of the
+whole list:
+- rate limits: a token bucket for the requests per minute, and one for the tokens per minute. A 429 answer pauses all
+  the requests for as long as its Retry-After header says, other failures are retried with exponential backoff.
+- checkpoints: every word's status is saved in the table generation_job_word as soon as it is finished, and its
+  sentence in the SentenceCache. If the run is interrupted (a crash, Ctrl+C, no network), running the job with the same
+  name again only asks for the words that are not done yet.
+- a report of the throughput: words per minute, tokens per minute, requests, 429s and retries.
+- group_senses: one request for all the meanings (rows) of a Hebrew word, instead of one request per row.
+It can be tried against FakeChatGPTServer, which can answer with 429s and 500s (rate_limit_every, failure_rate).
+Usage:
+    job = GenerationJob("backfill", dbAPI.get_vocabs(1, 10000), API_KEY, requests_per_minute=500)
+    report = job.run()
+    print(format_report(report))
+    sentences = job.get_results()
+"""
+import asyncio
+import random
+import time
+import openai
+import dbConnection
+import Tracing
+from ReciteMaterialGenerator import ReciteMaterialGenerator, first_prompt_file, sense_prompt_file
+from SentenceCache import SentenceCache
+
+my_database = "my_database.db"
+generation_job_word_table = "generation_job_word"
+# client errors that are worth asking again: a request timeout, and a conflict on OpenAI's side
+retryable_status_codes = (408, 409)
+# the status of a word in a job
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class TokenBucket:
+    """
+    Allows rate_per_second on average, and bursts of up to capacity. Only for use from one event loop.
+    """
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self, amount=1):
+        """
+        Wait until amount tokens are available, and take them.
+        """
+        # more than the capacity would never be available
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate_per_second)
+
+    def consume(self, amount):
+        """
+        Take amount tokens without waiting, the bucket can go below 0 (e.g. when a request used more tokens than
+        estimated), then the next acquire() waits longer.
+        """
+        self._refill()
+        self.tokens -= amount
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate_per_second)
+        self._updated_at = now
+
+
+class GenerationJob:
+    """
+    Generate the context sentences of the words of a df, see the top of this file.
+    """
+
+    def __init__(self, name, new_materials_df, API_KEY, base_url=None, cache=None, requests_per_minute=60,
+                 tokens_per_minute=None, max_concurrency=5, max_attempts=5, max_rate_limited_attempts=20,
+                 max_backoff_seconds=60, group_senses=False, db_path=my_database):
+        """
+        :param name: identifies the job, running a job with the same name again resumes it
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :param cache: the SentenceCache where the sentences are stored, by default the one of db_path
+        :param requests_per_minute: at most this many requests per minute (bursts of up to max_concurrency)
+        :param tokens_per_minute: at most this many tokens per minute, None for no limit. A request is counted with
+                an estimate when it is sent, and corrected with its real usage when it comes back.
+        :param max_attempts: how many times a word is asked before it is marked as failed, the 429 answers (rate
+                limited) are waited for and not counted
+        :param max_rate_limited_attempts: how many 429 answers a word waits for before it is marked as failed, so a
+                limit that doesn't go away doesn't keep the job running forever. A 429 for an exhausted quota
+                (insufficient_quota) fails the word at once.
+        :param max_backoff_seconds: the longest wait between two attempts of a word
+        :param group_senses: ask for all the meanings of a Hebrew word (its rows in the df) in one request, see
+                ReciteMaterialGenerator.get_context_sentence_from_ChatGPT_by_sense
+        """
+        self.name = name
+        self.API_KEY = API_KEY
+        self.generator = ReciteMaterialGenerator(base_url=base_url, max_concurrency=max_concurrency)
+        self.cache = cache if cache is not None else SentenceCache(db_path)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.max_rate_limited_attempts = max_rate_limited_attempts
+        self.max_backoff_seconds = max_backoff_seconds
+        self.db_path = db_path
+        self.group_senses = group_senses
+        self.word_pairs = self.generator._get_word_pairs(new_materials_df)
+        self.transliterations = dict(zip(self.word_pairs, self.generator._get_transliterations(new_materials_df)))
+        self._paused_until = 0.0
+        self._counters = {}
+        self._initialize_table()
+
+    def run(self):
+        """
+        Generate the words that are not done yet, the ones that failed in an earlier run are tried again.
+        :return: the report, see run_async()
+        """
+        return asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        :return: a dictionary with the number of (different) words: in the job, done, failed, and already done before
+                this run; and the requests, 429 answers, retries, tokens, seconds, words per minute and tokens per
+                minute of this run
+        """
+        begin_time = time.perf_counter()
+        self._counters = {"generated": 0, "failed": 0, "requests": 0, "rate_limited": 0, "retries": 0,
+                          "prompt_tokens": 0, "completion_tokens": 0}
+        with Tracing.span("GenerationJob.run", job=self.name, words=len(self.word_pairs)) as trace_span:
+            self._add_words()
+            unfinished = self._get_unfinished_words()
+            # a word can already be in the cache: from another job, or the run crashed between caching and saving
+            # the checkpoint
+            cached_results = self._get_cached_results(unfinished)
+            self._set_status([word_pair for word_pair, result in zip(unfinished, cached_results)
+                              if result is not None], DONE)
+            missing = [word_pair for word_pair, result in zip(unfinished, cached_results) if result is None]
+            request_bucket = TokenBucket(self.requests_per_minute / 60, self.max_concurrency)
+            token_bucket = None
+            if self.tokens_per_minute is not None:
+                token_bucket = TokenBucket(self.tokens_per_minute / 60, self.tokens_per_minute / 60 * 10)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            # the job does the retries, so that it can wait as long as a 429 asks for. When everything is already in
+            # the cache (e.g. prefetched), no client is needed, nor an API key
+            if missing:
+                async with openai.AsyncOpenAI(api_key=self.API_KEY, base_url=self.generator.base_url,
+                                              max_retries=0) as client:
+                    async def generate_one(word_pairs):
+                        async with semaphore:
+                            await self._generate_words(client, word_pairs, request_bucket, token_bucket)
+                    if self.group_senses:
+                        requests = self.generator._group_senses(missing)
+                    else:
+                        requests = [[word_pair] for word_pair in missing]
+                    await asyncio.gather(*[generate_one(word_pairs) for word_pairs in requests])
+            trace_span.set(**self._counters)
+        seconds = time.perf_counter() - begin_time
+        status = self.get_status()
+        tokens = self._counters["prompt_tokens"] + self._counters["completion_tokens"]
+        num_words = len(set(self.word_pairs))
+        return {"job": self.name, "words": num_words, "done": status.get(DONE, 0),
+                "failed": status.get(FAILED, 0), "already_done": num_words - len(missing),
+                **self._counters, "seconds": seconds,
+                "words_per_minute": 60 * self._counters["generated"] / seconds if seconds else 0.0,
+                "tokens_per_minute": 60 * tokens / seconds if seconds else 0.0}
+
+    def get_results(self):
+        """
+        :return: a list of dictionaries, in the same order as the rows of the df, like the ones of
+                ReciteMaterialGenerator. A word that is not done has empty sentences and an "Error" field.
+        """
+        cached_results = self._get_cached_results(self.word_pairs)
+        errors = self._get_errors()
+        results = []
+        for word_pair, result in zip(self.word_pairs, cached_results):
+            if result is None:
+                result = ReciteMaterialGenerator._failed_result(errors.get(word_pair) or "Not generated yet")
+            results.append(result)
+        return results
+
+    def get_status(self):
+        """
+        :return: a dictionary {status: number of words} of this job
+        """
+        query = f"""SELECT STATUS, COUNT(*) FROM {generation_job_word_table}
+                    WHERE JOB_NAME = ?
+                    GROUP BY STATUS;"""
+        return dict(dbConnection.get_connection(self.db_path).execute(query, (self.name,)).fetchall())
+
+    def delete(self):
+        """
+        Forget the checkpoints of this job (the sentences stay in the cache).
+        """
+        dbConnection.get_connection(self.db_path).execute(
+            f"DELETE FROM {generation_job_word_table} WHERE JOB_NAME = ?;", (self.name,))
+
+    async def _generate_words(self, client, word_pairs, request_bucket, token_bucket):
+        """
+        Generate one word, or with group_senses all the meanings of one Hebrew word in one request. The meanings that
+        are missing in the answer are asked again in the next attempt.
+        """
+        error = None
+        attempt = 0  # the attempts that count against max_attempts, a rate limited request is not one of them
+        num_rate_limited = 0
+        num_requests = 0
+        while attempt < self.max_attempts:
+            if num_requests > 0:
+                self._counters["retries"] += 1
+            num_requests += 1
+            estimated_tokens = self._estimate_tokens(word_pairs)
+            await self._wait_while_paused()
+            await request_bucket.acquire()
+            if token_bucket is not None:
+                await token_bucket.acquire(estimated_tokens)
+            self._counters["requests"] += 1
+            try:
+                if self.group_senses:
+                    response = await self.generator._create_sense_completion_async(client, word_pairs,
+                                                                                   self.transliterations)
+                else:
+                    response = await self.generator._create_chat_completion_async(
+                        client, self.generator._to_english_hebrew_string(word_pairs[0]))
+                if response.usage is not None:
+                    self._counters["prompt_tokens"] += response.usage.prompt_tokens
+                    self._counters["completion_tokens"] += response.usage.completion_tokens
+                    if token_bucket is not None:
+                        token_bucket.consume(response.usage.total_tokens - estimated_tokens)
+                if self.group_senses:
+                    results = self.generator._parse_sense_response(response, word_pairs)
+                else:
+                    results = {word_pairs[0]: self.generator._parse_response(response)}
+            except openai.RateLimitError as e:
+                # everyone waits, not only this word: the limit is for the whole API key
+                self._counters["rate_limited"] += 1
+                error = e
+                num_rate_limited += 1
+                if e.code == "insufficient_quota" or num_rate_limited >= self.max_rate_limited_attempts:
+                    # waiting won't help: the account is out of credit, or the limit doesn't go away
+                    break
+                wait_seconds = _get_retry_after_seconds(e.response)
+                if wait_seconds is None:
+                    wait_seconds = self._get_backoff_seconds(attempt)
+                self._paused_until = max(self._paused_until, time.monotonic() + wait_seconds)
+                continue
+            except openai.APIStatusError as e:
+                error = e
+                attempt += 1
+                if e.status_code < 500 and e.status_code not in retryable_status_codes:
+                    # a bad request or a wrong API key, asking again won't help
+                    break
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(self._get_backoff_seconds(attempt - 1))
+                continue
+            except Exception as e:
+                # no connection, a timeout, or an answer that is not what the prompt asked for
+                error = e
+                attempt += 1
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(self._get_backoff_seconds(attempt - 1))
+                continue
+            attempt += 1
+            done = [word_pair for word_pair in word_pairs if word_pair in results]
+            if done:
+                self.cache.put_many(done, [results[word_pair] for word_pair in done], self.generator.language_models,
+                                    self._get_prompt_hash())
+                self._set_status(done, DONE, attempts=num_requests)
+                self._counters["generated"] += len(done)
+            word_pairs = [word_pair for word_pair in word_pairs if word_pair not in results]
+            if not word_pairs:
+                return
+            error = Exception("The meaning is missing or malformed in ChatGPT's response")
+        self._set_status(word_pairs, FAILED, attempts=num_requests, error=str(error))
+        self._counters["failed"] += len(word_pairs)
+
+    async def _wait_while_paused(self):
+        while True:
+            wait_seconds = self._paused_until - time.monotonic()
+            if wait_seconds <= 0:
+                return
+            await asyncio.sleep(wait_seconds)
+
+    def _get_backoff_seconds(self, attempt):
+        """
+        1, 2, 4, ... seconds (at most max_backoff_seconds), times a random factor, so that the words that failed at
+        the same time don't all come back at the same time.
+        """
+        return min(self.max_backoff_seconds, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _estimate_tokens(self, word_pairs):
+        """
+        About 4 characters per token, and a completion of about 100 tokens per word.
+        """
+        if self.group_senses:
+            messages = self.generator._get_sense_messages(word_pairs, self.transliterations)
+        else:
+            messages = self.generator._get_messages(self.generator._to_english_hebrew_string(word_pairs[0]))
+        return sum(len(message["content"]) for message in messages) // 4 + 100 * len(word_pairs)
+
+    def _get_prompt_hash(self):
+        return self.generator._get_prompt_hash(sense_prompt_file if self.group_senses else first_prompt_file)
+
+    def _get_cached_results(self, word_pairs):
+        """
+        :return: the results of the word pairs in the cache, None for the missing ones. A sentence made with the other
+                prompt (one word at a time, or by sense) is also good, so that switching group_senses doesn't ask for
+                the words again.
+        """
+        results = self.cache.get_many(word_pairs, self.generator.language_models, self._get_prompt_hash())
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            other_prompt_file = first_prompt_file if self.group_senses else sense_prompt_file
+            other_results = self.cache.get_many([word_pairs[i] for i in missing], self.generator.language_models,
+                                                self.generator._get_prompt_hash(other_prompt_file))
+            for i, result in zip(missing, other_results):
+                results[i] = result
+        return results
+
+    def _initialize_table(self):
+        # POSITION keeps the order of the words in the df
+        dbConnection.get_connection(self.db_path).execute(f"""
+            CREATE TABLE IF NOT EXISTS {generation_job_word_table}(
+                JOB_NAME TEXT NOT NULL,
+                HEBREW TEXT NOT NULL,
+                ENGLISH TEXT NOT NULL,
+                POSITION INTEGER NOT NULL,
+                STATUS TEXT NOT NULL DEFAULT '{PENDING}' CHECK (STATUS IN ('{PENDING}', '{DONE}', '{FAILED}')),
+                ATTEMPTS INTEGER NOT NULL DEFAULT 0,
+                ERROR TEXT,
+                UPDATED_AT REAL,
+                PRIMARY KEY (JOB_NAME, HEBREW, ENGLISH)
+            ) WITHOUT ROWID
+        """)
+
+    def _add_words(self):
+        """
+        Add the words of the df to the job, the ones that are already in it keep their status.
+        """
+        query = f"""INSERT OR IGNORE INTO {generation_job_word_table} (JOB_NAME, HEBREW, ENGLISH, POSITION)
+                    VALUES (?, ?, ?, ?);"""
+        with dbConnection.transaction(self.db_path) as conn:
+            conn.executemany(query, [(self.name, hebrew, english, position)
+                                     for position, (hebrew, english) in enumerate(self.word_pairs)])
+
+    def _get_unfinished_words(self):
+        """
+        :return: the (hebrew, english) of the words of the df that are not done, in the order of the df
+        """
+        query = f"""SELECT HEBREW, ENGLISH FROM {generation_job_word_table}
+                    WHERE JOB_NAME = ? AND STATUS != '{DONE}';"""
+        unfinished = set(dbConnection.get_connection(self.db_path).execute(query, (self.name,)).fetchall())
+        return list(dict.fromkeys(word_pair for word_pair in self.word_pairs if word_pair in unfinished))
+
+    def _get_errors(self):
+        query = f"""SELECT HEBREW, ENGLISH, ERROR FROM {generation_job_word_table}
+                    WHERE JOB_NAME = ? AND ERROR IS NOT NULL;"""
+        rows = dbConnection.get_connection(self.db_path).execute(query, (self.name,)).fetchall()
+        return {(hebrew, english): error for hebrew, english, error in rows}
+
+    def _set_status(self, word_pairs, status, attempts=None, error=None):
+        """
+        Save the checkpoint of the words, one commit for all of them.
+        """
+        query = f"""UPDATE {generation_job_word_table}
+                    SET STATUS = ?, ATTEMPTS = COALESCE(?, ATTEMPTS), ERROR = ?, UPDATED_AT = ?
+                    WHERE JOB_NAME = ? AND HEBREW = ? AND ENGLISH = ?;"""
+        now = time.time()
+        with dbConnection.transaction(self.db_path) as conn:
+            conn.executemany(query, [(status, attempts, error, now, self.name, hebrew, english)
+                                     for hebrew, english in word_pairs])
+
+
+def format_report(report):
+    """
+    :param report: what GenerationJob.run() returned
+    :return: a few lines to print
+    """
+    return (f"Job {report['job']}: {report['done']} of {report['words']} words done "
+            f"({report['already_done']} were done before this run), {report['failed']} failed.\n"
+            f"{report['generated']} words in {report['seconds']:.1f} s: {report['words_per_minute']:.1f} words/min, "
+            f"{report['tokens_per_minute']:.0f} tokens/min.\n"
+            f"{report['requests']} requests, {report['rate_limited']} rate limited (429), {report['retries']} retries.")
+
+
+def _get_retry_after_seconds(response):
+    """
+    :return: how long the 429 response asks us to wait, None if it doesn't say
+    """
+    if response is None:
+        return None
+    for header, factor in [("retry-after-ms", 0.001), ("retry-after", 1.0)]:
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * factor)
+        except ValueError:
+            # Retry-After can also be an http date, then use the backoff
+            return None
+    return None
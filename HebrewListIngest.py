@@ -0,0 +1,240 @@
+"""
+This file gets the Hebrew frequency list (from the website, a saved copy of the page, or a csv/tsv file) into the table
+hebrew_list. It is a pipeline of generators, so only one batch of rows is in memory at a time:
+    read chunks of text -> parse them into rows of cells -> clean the rows (forward fill Rank and Hebrew) -> write
+    batches of rows, one transaction per batch
+Each stage measures the time it spends, so we can see where the time goes.
+Running it again is safe: rows that are already in the table are skipped (see dbAPI._upsert_hebrew_list_rows).
+To work without network, write the list to a local html file with write_hebrew_list_html() (same format as the
+website), and ingest that file. fixtures/hebrew_frequency_list_sample.html is a small one.
+"""
+import csv
+import html
+import time
+from html.parser import HTMLParser
+import dbAPI
+
+hebrew_list_columns = ["Rank", "English", "Transliteration", "Hebrew"]
+words_table_id = "words"  # the id of the <table> of the website that has the words
+
+
+def ingest_hebrew_list(source=dbAPI.hebrew_list_url, batch_size=1000, chunk_size=64 * 1024):
+    """
+    :param source: an url, or the path of a local .html, .csv or .tsv file. A csv/tsv file must have a header with
+            the columns Rank, English, Transliteration, Hebrew.
+    :param batch_size: how many rows are written in one transaction
+    :param chunk_size: how many characters are read at a time
+    :return: a dictionary with the number of rows read, the number of rows that were new, and the seconds spent in
+            each stage ("read", "parse", "clean", "write") and in total
+    """
+    timings = {}
+    begin_time = time.perf_counter()
+    if source.lower().endswith((".csv", ".tsv")):
+        chunks = None
+        rows = _timed(_read_delimited_rows(source), timings, "read")
+    else:
+        chunks = _timed(_read_chunks(source, chunk_size), timings, "read")
+        rows = _timed(_parse_html_rows(chunks), timings, "parse")
+    words = _timed(_clean_rows(rows), timings, "clean")
+    num_rows = 0
+    num_new_rows = 0
+    write_seconds = 0.0
+    for batch in _batched(words, batch_size):
+        write_begin_time = time.perf_counter()
+        num_new_rows += dbAPI._upsert_hebrew_list_rows(batch)
+        write_seconds += time.perf_counter() - write_begin_time
+        num_rows += len(batch)
+    # each stage's time includes the time of the stages before it, keep only its own part
+    seconds = {"read": timings.get("read", 0.0)}
+    seconds["parse"] = timings["parse"] - timings["read"] if chunks is not None else 0.0
+    seconds["clean"] = timings["clean"] - timings.get("parse", timings["read"])
+    seconds["write"] = write_seconds
+    seconds["total"] = time.perf_counter() - begin_time
+    return {"rows": num_rows, "new_rows": num_new_rows, "seconds": seconds}
+
+
+def write_hebrew_list_html(path, limit=None):
+    """
+    Write the table hebrew_list to an html file in the format of the website: a row that has the same Rank and Hebrew
+    as the row before has these two cells empty.
+    :param limit: write only the first limit rows
+    """
+    query = f"""SELECT Rank, English, Transliteration, Hebrew
+                FROM {dbAPI.hebrew_list_table}
+                ORDER BY Rank, rowid"""
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    cursor = dbAPI._connect_shared().cursor().execute(query)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<html>\n<head><meta charset="utf-8"></head>\n<body>\n')
+        file.write(f'<table id="{words_table_id}">\n')
+        file.write("<tr>" + "".join(f"<th>{column}</th>" for column in hebrew_list_columns) + "</tr>\n")
+        previous_rank, previous_hebrew = None, None
+        for rank, english, transliteration, hebrew in cursor:
+            if (rank, hebrew) == (previous_rank, previous_hebrew):
+                cells = ["", english, transliteration, ""]
+            else:
+                cells = [str(rank), english, transliteration, hebrew]
+            file.write("<tr>" + "".join(f"<td>{html.escape(cell or '')}</td>" for cell in cells) + "</tr>\n")
+            previous_rank, previous_hebrew = rank, hebrew
+        file.write("</table>\n</body>\n</html>\n")
+
+
+#######################################################################################################################
+#######################################################################################################################
+########################################################## stages #####################################################
+#######################################################################################################################
+#######################################################################################################################
+
+def _read_chunks(source, chunk_size):
+    """
+    :return: a generator of strings
+    """
+    if source.lower().startswith(("http://", "https://")):
+        # only needed for downloading, so imported here
+        import requests
+        with requests.get(source, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or "utf-8"
+            for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=True):
+                yield chunk
+    else:
+        with open(source, "r", encoding="utf-8") as file:
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def _read_delimited_rows(path):
+    """
+    :return: a generator of lists of cells, the first one is the header
+    """
+    delimiter = "\t" if path.lower().endswith(".tsv") else ","
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        for row in csv.reader(file, delimiter=delimiter):
+            yield [cell.strip() for cell in row]
+
+
+def _parse_html_rows(chunks):
+    """
+    :param chunks: a generator of strings, together they are the html page
+    :return: a generator of lists of cells of the words table, the first one is the header
+    """
+    parser = _WordsTableParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.pop_rows()
+    parser.close()
+    yield from parser.pop_rows()
+
+
+def _clean_rows(rows):
+    """
+    The website leaves Rank and Hebrew empty when they are the same as the row before (several meanings of one word),
+    fill them in. Rows whose Rank is not a number are skipped.
+    :param rows: a generator of lists of cells, the first one is the header
+    :return: a generator of (rank, english, transliteration, hebrew)
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    column_indices = [header.index(column) for column in hebrew_list_columns]
+    previous_rank, previous_hebrew = None, None
+    for row in rows:
+        if len(row) < len(header):
+            continue
+        rank_cell, english, transliteration, hebrew = [row[i] for i in column_indices]
+        if rank_cell:
+            try:
+                previous_rank = int(rank_cell)
+            except ValueError:
+                previous_rank = None
+        if hebrew:
+            previous_hebrew = hebrew
+        if previous_rank is None or previous_hebrew is None:
+            continue
+        yield previous_rank, english, transliteration, previous_hebrew
+
+
+def _batched(iterator, batch_size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _timed(iterator, timings, stage):
+    """
+    Add the time spent in getting each item of iterator to timings[stage].
+    """
+    timings.setdefault(stage, 0.0)
+    iterator = iter(iterator)
+    while True:
+        begin_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] += time.perf_counter() - begin_time
+            return
+        timings[stage] += time.perf_counter() - begin_time
+        yield item
+
+
+class _WordsTableParser(HTMLParser):
+    """
+    Collects the rows of <table id="words">. A cell's text is the stripped pieces of text in it, put together (same as
+    BeautifulSoup's get_text(strip=True)). A piece of text can come in several handle_data() calls when it is split
+    between two chunks, so it is only stripped when the next tag comes.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._in_words_table = False
+        self._current_row = None
+        self._current_cell = None
+        self._current_text = []
+        self._rows = []
+
+    def pop_rows(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def handle_starttag(self, tag, attrs):
+        self._end_text()
+        if tag == "table" and dict(attrs).get("id") == words_table_id:
+            self._in_words_table = True
+        elif not self._in_words_table:
+            return
+        elif tag == "tr":
+            self._current_row = []
+        elif tag in ("td", "th") and self._current_row is not None:
+            self._current_cell = []
+
+    def handle_endtag(self, tag):
+        self._end_text()
+        if not self._in_words_table:
+            return
+        if tag in ("td", "th") and self._current_cell is not None:
+            self._current_row.append("".join(self._current_cell))
+            self._current_cell = None
+        elif tag == "tr" and self._current_row is not None:
+            if self._current_row:
+                self._rows.append(self._current_row)
+            self._current_row = None
+        elif tag == "table":
+            self._in_words_table = False
+
+    def handle_data(self, data):
+        if self._current_cell is not None:
+            self._current_text.append(data)
+
+    def _end_text(self):
+        if self._current_text:
+            self._current_cell.append("".join(self._current_text).strip())
+            self._current_text = []
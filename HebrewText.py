@@ -0,0 +1,59 @@
+"""
+This file contains helpers to normalize text, so that different spellings of the same word compare equal:
+- Hebrew: niqqud and cantillation marks are removed, and final letters (ך ם ן ף ץ) become regular letters, so
+  "שָׁלוֹם", "שלום" and "שלומ" are all "שלומ".
+- Transliteration: lower case, no accents, and no apostrophes/brackets, so "ba'alei [tshuva]" is "baalei tshuva".
+- English: lower case, and punctuation becomes spaces.
+"""
+import re
+import unicodedata
+
+final_letters = str.maketrans({"ך": "כ", "ם": "מ", "ן": "נ", "ף": "פ", "ץ": "צ"})
+hebrew_letter_pattern = re.compile("[א-ת]")
+# maqaf (the Hebrew hyphen) separates words, geresh and gershayim are part of abbreviations and are dropped
+hebrew_punctuation = str.maketrans({"־": " ", "׳": None, "״": None, "'": None, '"': None})
+non_word_pattern = re.compile(r"[^\w\s]")
+whitespace_pattern = re.compile(r"\s+")
+
+
+def is_hebrew(text):
+    """
+    :return: True if the text has at least one Hebrew letter
+    """
+    return hebrew_letter_pattern.search(text) is not None
+
+
+def normalize_hebrew(text):
+    if not text:
+        return ""
+    # niqqud and cantillation marks are all combining marks (category Mn)
+    text = "".join(char for char in unicodedata.normalize("NFD", text) if unicodedata.category(char) != "Mn")
+    text = text.translate(final_letters).translate(hebrew_punctuation)
+    text = non_word_pattern.sub(" ", text)
+    return whitespace_pattern.sub(" ", text).strip()
+
+
+def normalize_transliteration(text):
+    if not text:
+        return ""
+    text = "".join(char for char in unicodedata.normalize("NFKD", text.lower()) if unicodedata.category(char) != "Mn")
+    text = text.replace("'", "").replace("’", "")
+    text = non_word_pattern.sub(" ", text)
+    return whitespace_pattern.sub(" ", text).strip()
+
+
+def normalize_english(text):
+    if not text:
+        return ""
+    text = non_word_pattern.sub(" ", text.lower())
+    return whitespace_pattern.sub(" ", text).strip()
+
+
+def normalize_query(text):
+    """
+    Normalize a search query, as Hebrew if it has Hebrew letters, else as Latin text (transliteration or English,
+    both normalize the same way for plain words).
+    """
+    if is_hebrew(text):
+        return normalize_hebrew(text)
+    return normalize_transliteration(text)
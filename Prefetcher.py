@@ -0,0 +1,136 @@
+"""
+This file generates the context sentences of the next days' new words ahead of time, so that "generate today's
+material" doesn't wait for ChatGPT: the next ranks are known from the study progress (every day takes the next
+num_new_words_per_day ranks), and the sentences are stored in the SentenceCache, where today's generation job finds
+them without sending a request. Then today's material is a read of the cache and a record of the progress.
+Run it on a schedule (e.g. every night from cron), or as a worker process that prefetches every few hours:
+    python CommandLineInterface.py prefetch --days 7
+    python CommandLineInterface.py prefetch --days 7 --every-hours 6
+Words that are in the local corpus (see SentenceCorpus) are taken from it, the others are asked from ChatGPT.
+The sentence cache is shared by all the users, so for a class one prefetch of everyone's upcoming words prepares all
+their days, and the words that several users study are only generated once:
+    python CommandLineInterface.py prefetch --days 7 --all-users
+"""
+import os
+import time
+import dbAPI
+import VocabStore
+from GenerationJob import GenerationJob, format_report
+from RangeSet import RangeSet
+from ReciteMaterialGenerator import ReciteMaterialGenerator, first_prompt_file, sense_prompt_file
+from SentenceCache import SentenceCache
+from SentenceCorpus import SentenceCorpus, CorpusSentenceGenerator, corpus_index_path
+
+prefetch_days = 7  # by default, a week of new words is prepared ahead
+
+
+def get_upcoming_ranks(num_days, num_new_words_per_day, all_users=False):
+    """
+    :param all_users: the ranks of all the users together (one query per database file), instead of the current user
+    :return: a RangeSet of the ranks of the new words of the next num_days days, starting today
+    """
+    if not all_users:
+        return dbAPI.get_next_new_material(num_days * num_new_words_per_day)
+    upcoming_ranks = RangeSet()
+    for user_ranks in dbAPI.get_next_new_material_of_users(num_days * num_new_words_per_day).values():
+        upcoming_ranks = upcoming_ranks | user_ranks
+    return upcoming_ranks
+
+
+def generate_context_sentences(new_materials_df, job_name, API_KEY, base_url=None, requests_per_minute=500,
+                               max_concurrency=5, group_senses=True, db_path=dbAPI.my_database):
+    """
+    The sentences of the corpus first, and a GenerationJob for the words that are not in it (if everything is already
+    in the cache, no request is sent, and API_KEY can be None).
+    :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English'], or a VocabSlice
+    :param job_name: the name of the GenerationJob, running it again with the same name resumes it
+    :param group_senses: one request for all the meanings of a Hebrew word (see GenerationJob)
+    :return: (a list of dictionaries like the ones of ReciteMaterialGenerator, in the order of the rows of
+            new_materials_df; the report, a dictionary with the words from_corpus and from_ChatGPT, and the report of
+            the job under "job", None if no job was needed). from_ChatGPT counts the distinct (hebrew, english) pairs
+            that were given to the job, the rows of the same word and meaning are one.
+    """
+    report = {"words": len(new_materials_df), "from_corpus": 0, "from_ChatGPT": 0, "job": None}
+
+    def generate_with_ChatGPT(materials_df):
+        report["from_ChatGPT"] = len(set(ReciteMaterialGenerator._get_word_pairs(materials_df)))
+        generation_job = GenerationJob(job_name, materials_df, API_KEY, base_url=base_url,
+                                       requests_per_minute=requests_per_minute, max_concurrency=max_concurrency,
+                                       group_senses=group_senses, db_path=db_path)
+        report["job"] = generation_job.run()
+        return generation_job.get_results()
+
+    if os.path.exists(corpus_index_path):
+        with SentenceCorpus(corpus_index_path) as corpus:
+            generator = CorpusSentenceGenerator(corpus, fallback=generate_with_ChatGPT, cache=SentenceCache(db_path))
+            sentences = generator.get_context_sentence(new_materials_df)
+        report["from_corpus"] = generator.num_found
+    else:
+        sentences = generate_with_ChatGPT(new_materials_df)
+    return sentences, report
+
+
+def get_missing_words(new_materials_df, db_path=dbAPI.my_database):
+    """
+    :return: the (hebrew, english) of the words that have no context sentence yet: not in the corpus (in their
+            meaning), and not in the SentenceCache from ChatGPT. If it is empty, the words can be generated without an
+            API key.
+    """
+    generator = ReciteMaterialGenerator()
+    cache = SentenceCache(db_path)
+    missing = generator._get_word_pairs(new_materials_df)
+    # made one word at a time, or by sense
+    for prompt_file in [sense_prompt_file, first_prompt_file]:
+        if missing:
+            cached_results = cache.get_many(missing, generator.language_models, generator._get_prompt_hash(prompt_file))
+            missing = [word_pair for word_pair, result in zip(missing, cached_results) if result is None]
+    if missing and os.path.exists(corpus_index_path):
+        with SentenceCorpus(corpus_index_path) as corpus:
+            missing = [word_pair for word_pair in missing if corpus.find_sentence_of_meaning(*word_pair) is None]
+    return missing
+
+
+def prefetch_upcoming_material(num_days, num_new_words_per_day, API_KEY, base_url=None, requests_per_minute=500,
+                               max_concurrency=5, db_path=dbAPI.my_database, all_users=False):
+    """
+    Generate the context sentences of the new words of the next num_days days.
+    :param all_users: of all the users, see get_upcoming_ranks()
+    :return: the report of generate_context_sentences(), with the RangeSet of the ranks under "ranks"
+    """
+    upcoming_ranks = get_upcoming_ranks(num_days, num_new_words_per_day, all_users=all_users)
+    new_materials_df = VocabStore.get_vocab_store().get_vocabs_of_ranks(upcoming_ranks)
+    # the job is named after the ranks, so an interrupted prefetch of the same days is resumed
+    job_name = f"prefetch_{upcoming_ranks.begin}_{upcoming_ranks.end}"
+    _, report = generate_context_sentences(new_materials_df, job_name, API_KEY,
+                                           base_url=base_url, requests_per_minute=requests_per_minute,
+                                           max_concurrency=max_concurrency, db_path=db_path)
+    report["ranks"] = upcoming_ranks
+    return report
+
+
+def run_prefetch_worker(num_days, num_new_words_per_day, API_KEY, interval_seconds, base_url=None,
+                        requests_per_minute=500, max_concurrency=5, db_path=dbAPI.my_database, all_users=False):
+    """
+    Prefetch, then again every interval_seconds, until it is stopped (Ctrl+C). A failed round (e.g. no network) is
+    printed and tried again in the next round.
+    """
+    while True:
+        try:
+            print(format_prefetch_report(prefetch_upcoming_material(
+                num_days, num_new_words_per_day, API_KEY, base_url=base_url, requests_per_minute=requests_per_minute,
+                max_concurrency=max_concurrency, db_path=db_path, all_users=all_users)), flush=True)
+        except Exception as e:
+            print(f"The prefetch failed, trying again in {interval_seconds:.0f} s: {e}", flush=True)
+        time.sleep(interval_seconds)
+
+
+def format_prefetch_report(report):
+    """
+    :param report: what prefetch_upcoming_material() returned
+    :return: a few lines to print
+    """
+    lines = [f"Prefetched ranks {report['ranks']}: {report['from_corpus']} words from the corpus, "
+             f"{report['from_ChatGPT']} from ChatGPT."]
+    if report["job"] is not None:
+        lines.append(format_report(report["job"]))
+    return "\n".join(lines)
@@ -0,0 +1,244 @@
+"""
+This file has the structures for sets of ranks that are stored as ranges, like the new material of the study progress
+(a date studies the ranks [BEGIN_RANK, END_RANK], or several such ranges, see dbAPI.study_range_table).
+A RangeSet keeps its ranges sorted, disjoint and merged (two ranges that touch become one), in two lists of begins and
+ends, so "is rank X in it" is a binary search, and adding or removing a range merges or splits the ranges around it.
+StudiedRanks is the whole study progress: the RangeSet of every date, the RangeSet of all the studied ranks, and for
+"which dates introduced rank X" the ranks cut into segments that are covered by the same dates.
+Usage:
+    studied_ranks = dbAPI.get_studied_ranks()
+    123 in studied_ranks, studied_ranks.get_dates(123), studied_ranks.get_next_new_ranks(20)
+"""
+import bisect
+
+
+class RangeSet:
+    """
+    A set of integers (ranks), stored as sorted disjoint ranges [begin, end] (inclusive, like get_vocabs).
+    Iterating it gives the ranks, in order, and len() is the number of ranks. ranges() gives the ranges.
+    """
+
+    def __init__(self, ranges=()):
+        """
+        :param ranges: (begin, end) pairs, in any order, they can overlap
+        """
+        self._begins = []
+        self._ends = []
+        for begin, end in ranges:
+            self.add(begin, end)
+
+    def add(self, begin, end):
+        """
+        Add the ranks [begin, end], merged with the ranges it overlaps or touches.
+        """
+        if begin > end:
+            return
+        # ranges that come in order (e.g. the dates of the study progress) are added at the end, without a search
+        if not self._begins or begin > self._ends[-1] + 1:
+            self._begins.append(begin)
+            self._ends.append(end)
+            return
+        if begin >= self._begins[-1]:
+            self._ends[-1] = max(self._ends[-1], end)
+            return
+        # the ranges that end at begin - 1 or later, and begin at end + 1 or earlier, are merged with it
+        first = bisect.bisect_left(self._ends, begin - 1)
+        last = bisect.bisect_right(self._begins, end + 1)
+        if first < last:
+            begin = min(begin, self._begins[first])
+            end = max(end, self._ends[last - 1])
+        self._begins[first:last] = [begin]
+        self._ends[first:last] = [end]
+
+    def remove(self, begin, end):
+        """
+        Remove the ranks [begin, end], a range that has them in its middle is split in two.
+        """
+        if begin > end:
+            return
+        first = bisect.bisect_left(self._ends, begin)
+        last = bisect.bisect_right(self._begins, end)
+        if first >= last:
+            return
+        pieces = []
+        if self._begins[first] < begin:
+            pieces.append((self._begins[first], begin - 1))
+        if self._ends[last - 1] > end:
+            pieces.append((end + 1, self._ends[last - 1]))
+        self._begins[first:last] = [piece[0] for piece in pieces]
+        self._ends[first:last] = [piece[1] for piece in pieces]
+
+    def find(self, rank):
+        """
+        :return: the (begin, end) of the range that has rank, None if rank is not in the set
+        """
+        i = bisect.bisect_right(self._begins, rank) - 1
+        if i >= 0 and self._ends[i] >= rank:
+            return self._begins[i], self._ends[i]
+        return None
+
+    def covers(self, begin, end):
+        """
+        :return: True if all the ranks [begin, end] are in the set
+        """
+        found_range = self.find(begin)
+        return found_range is not None and found_range[1] >= end
+
+    def get_gaps(self, begin, end):
+        """
+        :return: a RangeSet of the ranks in [begin, end] that are not in this set
+        """
+        gaps = RangeSet([(begin, end)])
+        first = bisect.bisect_left(self._ends, begin)
+        last = bisect.bisect_right(self._begins, end)
+        for i in range(first, last):
+            gaps.remove(self._begins[i], self._ends[i])
+        return gaps
+
+    def get_missing(self, count, begin=1):
+        """
+        :return: a RangeSet of the first count ranks from begin that are not in this set: the gaps first, then the
+                ranks after the last range
+        """
+        missing = RangeSet()
+        rank = begin
+        i = bisect.bisect_left(self._ends, rank)
+        while count > 0:
+            if i < len(self._begins) and self._begins[i] <= rank:
+                rank = self._ends[i] + 1
+                i += 1
+                continue
+            take = count if i == len(self._begins) else min(count, self._begins[i] - rank)
+            # the missing ranges are separated by ranges of this set, so they are already disjoint and sorted
+            missing._begins.append(rank)
+            missing._ends.append(rank + take - 1)
+            count -= take
+            rank += take
+        return missing
+
+    def ranges(self):
+        """
+        :return: a list of (begin, end), sorted
+        """
+        return list(zip(self._begins, self._ends))
+
+    @property
+    def begin(self):
+        """
+        The lowest rank, None if the set is empty.
+        """
+        return self._begins[0] if self._begins else None
+
+    @property
+    def end(self):
+        """
+        The highest rank, None if the set is empty.
+        """
+        return self._ends[-1] if self._ends else None
+
+    def copy(self):
+        range_set = RangeSet()
+        range_set._begins = list(self._begins)
+        range_set._ends = list(self._ends)
+        return range_set
+
+    def __or__(self, other):
+        union = self.copy()
+        for begin, end in other.ranges():
+            union.add(begin, end)
+        return union
+
+    def __contains__(self, rank):
+        return self.find(rank) is not None
+
+    def __iter__(self):
+        for begin, end in zip(self._begins, self._ends):
+            yield from range(begin, end + 1)
+
+    def __len__(self):
+        return sum(self._ends) - sum(self._begins) + len(self._begins)
+
+    def __bool__(self):
+        return bool(self._begins)
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and self._begins == other._begins and self._ends == other._ends
+
+    def __str__(self):
+        return ", ".join(str(begin) if begin == end else f"{begin}-{end}" for begin, end in self.ranges())
+
+    def __repr__(self):
+        return f"RangeSet({self.ranges()})"
+
+
+class StudiedRanks:
+    """
+    The new material of every date, see dbAPI.get_studied_ranks(). A rank that was studied on several dates (e.g. it
+    was studied again later) belongs to all of them.
+    """
+
+    def __init__(self, dated_ranges=()):
+        """
+        :param dated_ranges: (date_str, begin_rank, end_rank) rows, like dbAPI.get_new_material_ranges()
+        """
+        self.ranks = RangeSet()  # all the studied ranks
+        self._date_ranks = {}  # date_str -> RangeSet
+        self._segment_begins = None  # built by get_dates() when it is first needed
+        self._segment_dates = None
+        for date_str, begin_rank, end_rank in dated_ranges:
+            self.add(date_str, begin_rank, end_rank)
+
+    def add(self, date_str, begin_rank, end_rank):
+        self._date_ranks.setdefault(date_str, RangeSet()).add(begin_rank, end_rank)
+        self.ranks.add(begin_rank, end_rank)
+        self._segment_begins = self._segment_dates = None
+
+    def of_date(self, date_str):
+        """
+        :return: the RangeSet of the new material of date_str, empty if it has none
+        """
+        return self._date_ranks.get(date_str, RangeSet())
+
+    def dates(self):
+        """
+        :return: the dates that have new material, oldest first
+        """
+        return sorted(self._date_ranks)
+
+    def get_dates(self, rank):
+        """
+        :return: the dates whose new material has rank, oldest first (an empty list if rank was never studied)
+        """
+        if self._segment_begins is None:
+            self._build_segments()
+        i = bisect.bisect_right(self._segment_begins, rank) - 1
+        return list(self._segment_dates[i]) if i >= 0 else []
+
+    def get_next_new_ranks(self, count):
+        """
+        :return: a RangeSet of the first count ranks that were never studied, the gaps first
+        """
+        return self.ranks.get_missing(count)
+
+    def _build_segments(self):
+        """
+        Cut the ranks at every begin and end + 1 of every date's ranges: the ranks between two cuts are covered by the
+        same dates. _segment_dates[i] are the dates of the ranks from _segment_begins[i] until the next cut.
+        """
+        changes = {}  # cut -> the dates that start and stop there
+        for date_str, range_set in self._date_ranks.items():
+            for begin, end in range_set.ranges():
+                changes.setdefault(begin, ([], []))[0].append(date_str)
+                changes.setdefault(end + 1, ([], []))[1].append(date_str)
+        self._segment_begins = sorted(changes)
+        self._segment_dates = []
+        dates = set()
+        for cut in self._segment_begins:
+            starting_dates, stopping_dates = changes[cut]
+            # the ranges of one date are disjoint and don't touch, so a date doesn't start and stop at the same cut
+            dates.difference_update(stopping_dates)
+            dates.update(starting_dates)
+            self._segment_dates.append(tuple(sorted(dates)))
+
+    def __contains__(self, rank):
+        return rank in self.ranks
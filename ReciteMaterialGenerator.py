@@ -17,7 +17,18 @@ methods for generating languages, such as using other language models.
 
 import openai
 import json
+import asyncio
+import os
 from itertools import chain
+from SentenceCache import SentenceCache
+import Tracing
+
+first_prompt_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "HebrewContextSentenceGeneratorFirstPrompt")
+batch_prompt_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "HebrewContextSentenceGeneratorBatchPrompt")
+sense_prompt_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "HebrewContextSentenceGeneratorSensePrompt")
 
 
 class ReciteMaterialGenerator:
@@ -26,8 +37,22 @@ class ReciteMaterialGenerator:
     The input must be a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
     Later it might be able to expand to all language pairs
     """
-    def __init__(self):
+    def __init__(self, base_url=None, max_concurrency=5, cache=None):
+        """
+        :param base_url: the url of the chat completions server, None means OpenAI's own server. Point this to a local
+                server (e.g. FakeChatGPTServer) to run without network.
+        :param max_concurrency: how many requests can be in flight at the same time in the async mode
+        :param cache: a SentenceCache, if given, words already in the cache are not sent to ChatGPT, and new sentences
+                are stored in it
+        """
         self.language_models = "gpt-3.5-turbo"
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self._first_prompt = None
+        self._batch_prompt = None
+        self._sense_prompt = None
+        self._prompt_hashes = {}
 
     def get_context_sentence_from_ChatGPT(self, new_materials_df, API_KEY):
         """
@@ -35,16 +60,192 @@ class ReciteMaterialGenerator:
         :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
         :return:
         """
-        english_hebrew_tuples = list(zip(new_materials_df["Hebrew"], new_materials_df["English"]))
-        english_hebrew_strings = []
-        for english_hebrew_tuple in english_hebrew_tuples:
-            english_hebrew_string = english_hebrew_tuple[0] + " (" + english_hebrew_tuple[1] + ")"
-            english_hebrew_strings.append(english_hebrew_string)
-        results_temp = []
-        for english_hebrew_string in english_hebrew_strings:
-            result = self._request_ChatGTP(english_hebrew_string, API_KEY)
-            results_temp.append(result)
-        return results_temp
+        def generate(english_hebrew_strings):
+            results_temp = []
+            for english_hebrew_string in english_hebrew_strings:
+                result = self._request_ChatGTP(english_hebrew_string, API_KEY)
+                results_temp.append(result)
+            return results_temp
+        return self._generate_with_cache(new_materials_df, first_prompt_file, generate)
+
+    def get_context_sentence_from_ChatGPT_concurrently(self, new_materials_df, API_KEY, max_concurrency=None):
+        """
+        Same as get_context_sentence_from_ChatGPT, but the requests are sent in parallel (at most max_concurrency at a
+        time). A word that failed will not abort the batch, instead its result will be a dictionary with empty sentences
+        and an "Error" field, so the caller can decide what to do with it.
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :param max_concurrency: if None, use self.max_concurrency
+        :return: a list of dictionaries, in the same order as the rows of new_materials_df
+        """
+        return asyncio.run(self.get_context_sentence_from_ChatGPT_async(new_materials_df, API_KEY, max_concurrency))
+
+    async def get_context_sentence_from_ChatGPT_async(self, new_materials_df, API_KEY, max_concurrency=None):
+        """
+        The async version of get_context_sentence_from_ChatGPT_concurrently, use this one if you already have an event
+        loop running.
+        """
+        if max_concurrency is None:
+            max_concurrency = self.max_concurrency
+        word_pairs = self._get_word_pairs(new_materials_df)
+        with Tracing.span("ReciteMaterialGenerator.generate", words=len(word_pairs)) as trace_span:
+            cached_results = self._get_cached_results(word_pairs, first_prompt_file)
+            missing = [i for i, result in enumerate(cached_results) if result is None]
+            semaphore = asyncio.Semaphore(max_concurrency)
+            async with openai.AsyncOpenAI(api_key=API_KEY, base_url=self.base_url) as client:
+                async def request_one(english_hebrew_string):
+                    async with semaphore:
+                        try:
+                            return await self._request_ChatGTP_async(client, english_hebrew_string)
+                        except Exception as e:
+                            return self._failed_result(e)
+                # gather keeps the order of the input, regardless of which request finished first
+                new_results = await asyncio.gather(*[request_one(self._to_english_hebrew_string(word_pairs[i]))
+                                                     for i in missing])
+            results = self._merge_new_results(word_pairs, cached_results, missing, new_results, first_prompt_file)
+            self._record_generation(trace_span, word_pairs, missing, new_results)
+        return results
+
+    def get_context_sentence_from_ChatGPT_batched(self, new_materials_df, API_KEY, batch_size=10, max_attempts=3):
+        """
+        Pack several words into one request, so the (long) prompt is only paid once per batch instead of once per word.
+        ChatGPT should answer with a json list, one dictionary per word. Each dictionary is checked against the word we
+        asked for, and only the words that are missing or malformed are asked again (in a later batch).
+        If the response was cut off (finish_reason is not "stop", e.g. "length"), we keep the complete dictionaries that
+        did arrive, and make the batches smaller from now on.
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :param batch_size: how many words to start with in one request
+        :param max_attempts: how many times a word can be asked before we give up on it
+        :return: a list of dictionaries, in the same order as the rows of new_materials_df. A word we gave up on will
+                have empty sentences and an "Error" field.
+        """
+        def generate(english_hebrew_strings):
+            return self._generate_batched(english_hebrew_strings, API_KEY, batch_size, max_attempts)
+        return self._generate_with_cache(new_materials_df, batch_prompt_file, generate)
+
+    def get_context_sentence_from_ChatGPT_by_sense(self, new_materials_df, API_KEY, max_concurrency=None,
+                                                   max_attempts=3):
+        """
+        The scraped list has a row per meaning of a Hebrew word (e.g. עם is "am", people, and "im", with), so asking
+        for every row on its own pays the prompt once per meaning, and the sentences don't show the difference.
+        This sends one request per Hebrew word, with all its meanings that are not cached, and splits the answer back
+        into the rows. The meanings that are missing or malformed in the answer are asked again, up to max_attempts.
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English'] (the
+                transliteration is optional, it tells ChatGPT how each meaning is read)
+        :param max_concurrency: if None, use self.max_concurrency
+        :return: a list of dictionaries, in the same order as the rows of new_materials_df
+        """
+        return asyncio.run(self.get_context_sentence_from_ChatGPT_by_sense_async(new_materials_df, API_KEY,
+                                                                                 max_concurrency, max_attempts))
+
+    async def get_context_sentence_from_ChatGPT_by_sense_async(self, new_materials_df, API_KEY, max_concurrency=None,
+                                                               max_attempts=3):
+        """
+        The async version of get_context_sentence_from_ChatGPT_by_sense.
+        """
+        if max_concurrency is None:
+            max_concurrency = self.max_concurrency
+        word_pairs = self._get_word_pairs(new_materials_df)
+        transliterations = dict(zip(word_pairs, self._get_transliterations(new_materials_df)))
+        with Tracing.span("ReciteMaterialGenerator.generate_by_sense", words=len(word_pairs)) as trace_span:
+            cached_results = self._get_cached_results(word_pairs, sense_prompt_file)
+            missing = [i for i, result in enumerate(cached_results) if result is None]
+            groups = self._group_senses([word_pairs[i] for i in missing])
+            trace_span.set(groups=len(groups))
+            new_results_by_pair = {}
+            semaphore = asyncio.Semaphore(max_concurrency)
+            async with openai.AsyncOpenAI(api_key=API_KEY, base_url=self.base_url) as client:
+                async def request_group(group):
+                    error = None
+                    for attempt in range(max_attempts):
+                        if attempt > 0:
+                            trace_span.add("retries")
+                        try:
+                            async with semaphore:
+                                response = await self._create_sense_completion_async(client, group, transliterations)
+                            new_results_by_pair.update(self._parse_sense_response(response, group))
+                        except Exception as e:
+                            error = e
+                        group = [word_pair for word_pair in group if word_pair not in new_results_by_pair]
+                        if not group:
+                            return
+                        if error is None:
+                            error = Exception("The meaning is missing or malformed in ChatGPT's response")
+                    for word_pair in group:
+                        new_results_by_pair[word_pair] = self._failed_result(error)
+                await asyncio.gather(*[request_group(group) for group in groups])
+            new_results = [new_results_by_pair[word_pairs[i]] for i in missing]
+            results = self._merge_new_results(word_pairs, cached_results, missing, new_results, sense_prompt_file)
+            self._record_generation(trace_span, word_pairs, missing, new_results)
+        return results
+
+    def _generate_batched(self, english_hebrew_strings, API_KEY, batch_size, max_attempts):
+        """
+        See get_context_sentence_from_ChatGPT_batched
+        :param english_hebrew_strings: a list of strings of form "hebrew (english)"
+        """
+        results = [None] * len(english_hebrew_strings)
+        attempts = [0] * len(english_hebrew_strings)
+        last_errors = [None] * len(english_hebrew_strings)
+        pending = list(range(len(english_hebrew_strings)))
+        client = openai.OpenAI(api_key=API_KEY, base_url=self.base_url)
+        trace_span = Tracing.span("ReciteMaterialGenerator._generate_batched", words=len(english_hebrew_strings))
+        with trace_span:
+            while pending:
+                batch, pending = pending[:batch_size], pending[batch_size:]
+                batch_words = [english_hebrew_strings[i] for i in batch]
+                try:
+                    entries, is_truncated = self._request_ChatGTP_batch(client, batch_words)
+                except Exception as e:
+                    entries, is_truncated = [], False
+                    for i in batch:
+                        last_errors[i] = e
+                if is_truncated and batch_size > 1:
+                    # the answer didn't fit, so next batches will be smaller
+                    batch_size = max(1, len(batch) // 2)
+                entries_by_word = {}
+                for entry in entries:
+                    if self._is_valid_batch_entry(entry):
+                        entries_by_word.setdefault(entry["Word"].strip(), entry)
+                retry = []
+                for i in batch:
+                    entry = entries_by_word.get(english_hebrew_strings[i].strip())
+                    if entry is not None:
+                        results[i] = {"ExampleSentence": entry["ExampleSentence"],
+                                      "SentenceTranslation": entry["SentenceTranslation"]}
+                        continue
+                    attempts[i] += 1
+                    if last_errors[i] is None:
+                        last_errors[i] = Exception("The word is missing or malformed in ChatGPT's response")
+                    if attempts[i] < max_attempts:
+                        retry.append(i)
+                        trace_span.add("retries")
+                    else:
+                        results[i] = self._failed_result(last_errors[i])
+                # words that failed are asked again after the words that were never asked
+                pending = pending + retry
+        return results
+
+    def _request_ChatGTP_batch(self, client, hebrew_words):
+        """
+        Ask for several words in one request.
+        :param client: an openai.OpenAI client
+        :param hebrew_words: a list of strings of form "hebrew (english)"
+        :return: the list of dictionaries that could be parsed, and whether the response was cut off
+        """
+        with Tracing.span("ReciteMaterialGenerator._request_ChatGTP_batch", words=len(hebrew_words)) as trace_span:
+            raw_response = client.chat.completions.with_raw_response.create(
+                model=self.language_models,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": self._get_batch_prompt()},
+                    {"role": "assistant", "content": "Yes"},
+                    {"role": "user", "content": json.dumps(hebrew_words, ensure_ascii=False)}
+                ]
+            )
+            response = raw_response.parse()
+            self._record_response(trace_span, raw_response, response)
+        is_truncated = not response.choices[0].finish_reason == "stop"
+        return self._parse_partial_json_list(response.choices[0].message.content), is_truncated
 
     def _request_ChatGTP(self, hebrew_word, API_KEY):
         """
@@ -53,20 +254,103 @@ class ReciteMaterialGenerator:
         :param hebrew_words_list:
         :return:
         """
-        with open("HebrewContextSentenceGeneratorFirstPrompt", 'r') as file:
-            # todo there might be a bug here: the file path is relative to the running script. might not be this script
-            first_prompt = file.read()
         # todo remember hide this in the environment when push to git
-        client = openai.OpenAI(api_key=API_KEY)
-        response = client.chat.completions.create(
-            model=self.language_models,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": first_prompt},
-                {"role": "assistant", "content": "Yes"},
-                {"role": "user", "content": hebrew_word}
-            ]
-        )
+        client = openai.OpenAI(api_key=API_KEY, base_url=self.base_url)
+        with Tracing.span("ReciteMaterialGenerator._request_ChatGTP") as trace_span:
+            raw_response = client.chat.completions.with_raw_response.create(
+                model=self.language_models,
+                messages=self._get_messages(hebrew_word)
+            )
+            response = raw_response.parse()
+            self._record_response(trace_span, raw_response, response)
+        return self._parse_response(response)
+
+    async def _request_ChatGTP_async(self, client, hebrew_word):
+        """
+        :param client: an openai.AsyncOpenAI client, shared by all the requests of one batch
+        :param hebrew_word: a string of form "hebrew (english)"
+        :return:
+        """
+        return self._parse_response(await self._create_chat_completion_async(client, hebrew_word))
+
+    async def _create_chat_completion_async(self, client, hebrew_word):
+        """
+        The request of _request_ChatGTP_async, without parsing, for callers that also need the token usage (see
+        GenerationJob).
+        :return: the openai ChatCompletion
+        """
+        with Tracing.span("ReciteMaterialGenerator._request_ChatGTP_async") as trace_span:
+            raw_response = await client.chat.completions.with_raw_response.create(
+                model=self.language_models,
+                messages=self._get_messages(hebrew_word)
+            )
+            response = raw_response.parse()
+            self._record_response(trace_span, raw_response, response)
+        return response
+
+    async def _create_sense_completion_async(self, client, word_pairs, transliterations=None):
+        """
+        Ask for the meanings of one Hebrew word in one request, without parsing (see _parse_sense_response).
+        :param word_pairs: (hebrew, english) tuples that all have the same hebrew
+        :param transliterations: a dictionary {(hebrew, english): transliteration}, optional
+        :return: the openai ChatCompletion
+        """
+        with Tracing.span("ReciteMaterialGenerator._request_ChatGTP_senses_async",
+                          senses=len(word_pairs)) as trace_span:
+            raw_response = await client.chat.completions.with_raw_response.create(
+                model=self.language_models,
+                messages=self._get_sense_messages(word_pairs, transliterations)
+            )
+            response = raw_response.parse()
+            self._record_response(trace_span, raw_response, response)
+        return response
+
+    def _get_first_prompt(self):
+        """
+        The prompt file is read only once, and relative to this file (not to the running script).
+        """
+        if self._first_prompt is None:
+            with open(first_prompt_file, 'r') as file:
+                self._first_prompt = file.read()
+        return self._first_prompt
+
+    def _get_batch_prompt(self):
+        if self._batch_prompt is None:
+            with open(batch_prompt_file, 'r') as file:
+                self._batch_prompt = file.read()
+        return self._batch_prompt
+
+    def _get_sense_prompt(self):
+        if self._sense_prompt is None:
+            with open(sense_prompt_file, 'r') as file:
+                self._sense_prompt = file.read()
+        return self._sense_prompt
+
+    def _get_sense_messages(self, word_pairs, transliterations=None):
+        senses = []
+        for word_pair in word_pairs:
+            sense = {}
+            if transliterations and transliterations.get(word_pair):
+                sense["Transliteration"] = transliterations[word_pair]
+            sense["Meaning"] = word_pair[1]
+            senses.append(sense)
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": self._get_sense_prompt()},
+            {"role": "assistant", "content": "Yes"},
+            {"role": "user", "content": json.dumps({"Word": word_pairs[0][0], "Senses": senses}, ensure_ascii=False)}
+        ]
+
+    def _get_messages(self, hebrew_word):
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": self._get_first_prompt()},
+            {"role": "assistant", "content": "Yes"},
+            {"role": "user", "content": hebrew_word}
+        ]
+
+    @staticmethod
+    def _parse_response(response):
         # Check if response is finished normally
         if not response.choices[0].finish_reason == "stop":
             raise Exception("The response didn't end properly")
@@ -78,6 +362,176 @@ class ReciteMaterialGenerator:
         # todo what is the max length for hebrew_words_list? Need to check, so far I pick 5.
         return context_sentences
 
+    @staticmethod
+    def _parse_partial_json_list(content):
+        """
+        Parse a json list of dictionaries, and if the list is cut off in the middle, return the dictionaries that are
+        complete. Anything that is not a json list gives an empty list.
+        """
+        decoder = json.JSONDecoder()
+        content = content.strip()
+        if not content.startswith("["):
+            return []
+        entries = []
+        position = 1
+        while position < len(content):
+            # skip separators between the elements
+            while position < len(content) and content[position] in " \t\r\n,":
+                position += 1
+            if position >= len(content) or content[position] == "]":
+                break
+            try:
+                entry, position = decoder.raw_decode(content, position)
+            except json.JSONDecodeError:
+                break
+            entries.append(entry)
+        return entries
+
+    @classmethod
+    def _parse_sense_response(cls, response, word_pairs):
+        """
+        :param word_pairs: the (hebrew, english) tuples that were asked, see _create_sense_completion_async
+        :return: a dictionary {(hebrew, english): result} of the meanings that are complete in the response. A response
+                that was cut off still gives the meanings before the cut. An entry is matched by its Meaning, or, if
+                the response has one valid entry per meaning, by its position (the model sometimes rephrases the
+                meaning).
+        """
+        entries = cls._parse_partial_json_list(response.choices[0].message.content)
+        valid_entries = [entry for entry in entries if cls._is_valid_batch_entry(entry, word_field="Meaning")]
+        entries_by_meaning = {}
+        for entry in valid_entries:
+            entries_by_meaning.setdefault(entry["Meaning"].strip(), entry)
+        matched = {}
+        for word_pair in word_pairs:
+            entry = entries_by_meaning.get(word_pair[1].strip())
+            if entry is not None:
+                matched[word_pair] = entry
+        if len(valid_entries) == len(entries) == len(word_pairs):
+            used = {id(entry) for entry in matched.values()}
+            for word_pair, entry in zip(word_pairs, entries):
+                if word_pair not in matched and id(entry) not in used:
+                    matched[word_pair] = entry
+        return {word_pair: {"ExampleSentence": entry["ExampleSentence"],
+                            "SentenceTranslation": entry["SentenceTranslation"]}
+                for word_pair, entry in matched.items()}
+
+    @staticmethod
+    def _is_valid_batch_entry(entry, word_field="Word"):
+        """
+        An entry of the batched response must have all three fields, all non-empty strings.
+        :param word_field: the field that says which word the entry is for, "Meaning" in the response by sense
+        """
+        if not isinstance(entry, dict):
+            return False
+        for field in [word_field, "ExampleSentence", "SentenceTranslation"]:
+            if not isinstance(entry.get(field), str) or not entry[field].strip():
+                return False
+        return True
+
+    @staticmethod
+    def _record_response(trace_span, raw_response, response):
+        """
+        Put the token usage, the retries of the openai client and the finish reason on the span (see Tracing).
+        """
+        trace_span.set(retries=raw_response.retries_taken, finish_reason=response.choices[0].finish_reason)
+        if response.usage is not None:
+            trace_span.set(prompt_tokens=response.usage.prompt_tokens,
+                           completion_tokens=response.usage.completion_tokens,
+                           total_tokens=response.usage.total_tokens)
+
+    @staticmethod
+    def _record_generation(trace_span, word_pairs, missing, new_results):
+        trace_span.set(cache_hits=len(word_pairs) - len(missing), cache_misses=len(missing),
+                       failures=sum("Error" in result for result in new_results))
+
+    @staticmethod
+    def _failed_result(error):
+        """
+        The result of a word that we couldn't get a sentence for.
+        """
+        return {"ExampleSentence": "", "SentenceTranslation": "", "Error": str(error)}
+
+    def _generate_with_cache(self, new_materials_df, prompt_file, generate):
+        """
+        Look up the words in the cache, and only give the missing ones to generate().
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :param prompt_file: the prompt that generate() uses, it is part of the cache key
+        :param generate: a function that takes a list of strings of form "hebrew (english)" and returns a list of
+                dictionaries
+        :return: a list of dictionaries, in the same order as the rows of new_materials_df
+        """
+        word_pairs = self._get_word_pairs(new_materials_df)
+        with Tracing.span("ReciteMaterialGenerator.generate", words=len(word_pairs)) as trace_span:
+            cached_results = self._get_cached_results(word_pairs, prompt_file)
+            missing = [i for i, result in enumerate(cached_results) if result is None]
+            new_results = generate([self._to_english_hebrew_string(word_pairs[i]) for i in missing]) if missing else []
+            results = self._merge_new_results(word_pairs, cached_results, missing, new_results, prompt_file)
+            self._record_generation(trace_span, word_pairs, missing, new_results)
+        return results
+
+    def _get_cached_results(self, word_pairs, prompt_file):
+        """
+        :return: a list of the same length as word_pairs, None for the words that are not cached (or if there is no
+                cache at all)
+        """
+        if self.cache is None:
+            return [None] * len(word_pairs)
+        return self.cache.get_many(word_pairs, self.language_models, self._get_prompt_hash(prompt_file))
+
+    def _merge_new_results(self, word_pairs, cached_results, missing, new_results, prompt_file):
+        """
+        Put the newly generated results in the place of the missing ones, and store them in the cache.
+        """
+        results = list(cached_results)
+        for i, result in zip(missing, new_results):
+            results[i] = result
+        if self.cache is not None and missing:
+            self.cache.put_many([word_pairs[i] for i in missing], new_results, self.language_models,
+                                self._get_prompt_hash(prompt_file))
+        return results
+
+    def _get_prompt_hash(self, prompt_file):
+        if prompt_file not in self._prompt_hashes:
+            self._prompt_hashes[prompt_file] = SentenceCache.hash_prompt_file(prompt_file)
+        return self._prompt_hashes[prompt_file]
+
+    @staticmethod
+    def _get_word_pairs(new_materials_df):
+        """
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :return: a list of (hebrew, english) tuples
+        """
+        return list(zip(new_materials_df["Hebrew"], new_materials_df["English"]))
+
+    @staticmethod
+    def _get_transliterations(new_materials_df):
+        """
+        :return: a list of the transliterations of the rows, None for each row if the df doesn't have them
+        """
+        if "Transliteration" not in new_materials_df.columns:
+            return [None] * len(new_materials_df)
+        return list(new_materials_df["Transliteration"])
+
+    @staticmethod
+    def _group_senses(word_pairs):
+        """
+        :param word_pairs: a list of (hebrew, english) tuples
+        :return: a list of lists of the different (hebrew, english) tuples that have the same hebrew, in the order of
+                the first appearance of each hebrew
+        """
+        groups = {}
+        for word_pair in word_pairs:
+            groups.setdefault(word_pair[0], {})[word_pair] = None
+        return [list(group) for group in groups.values()]
+
+    @staticmethod
+    def _to_english_hebrew_string(word_pair):
+        """
+        :param word_pair: a (hebrew, english) tuple
+        :return: a string of form "hebrew (english)"
+        """
+        return word_pair[0] + " (" + word_pair[1] + ")"
+
 # test
 # myClass = HebrewContextSentenceGenerator()
 # sents = myClass.get_context_sentence_from_ChatGPT(["כאשר", "אין", "אמר", "באופן", "הברית"])
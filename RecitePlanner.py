@@ -7,6 +7,15 @@ There are some things to consider:
 """
 import datetime
 from abc import ABC, abstractmethod
+import numpy as np
+
+# dbAPI (and with it pandas) is imported in the methods that use the database, so that only computing the dates to
+# recite stays cheap (see CommandLineInterface)
+
+epoch_date = datetime.date(1970, 1, 1)
+# the event types of the table review_event, the same as dbAPI.INTRODUCE and dbAPI.REVIEW
+INTRODUCE = "introduce"
+REVIEW = "review"
 
 
 # class RecitePlanner(ABC):
@@ -34,7 +43,8 @@ from abc import ABC, abstractmethod
 class EbbinghausPlanner:
     """
     This class represent a planner that will decide what should one recite today
-    This will only be initialized once for each user. Should I prepare for multi-user? #todo
+    This will only be initialized once for each user. The user is the current one of dbAPI: for another user, use it
+    inside "with dbAPI.as_user(user_id):".
     So far keep the precision of minutes in case there is a usage in the future.
     Now we set up a database, with columns:
     [reciteMaterial:BLOB, first_time: date, 1 day recite: Bool, 2 day recite, ......]
@@ -49,8 +59,30 @@ class EbbinghausPlanner:
     Q: What if user switched time zone?
     A: So far not considered, later simple change datetime to greenwich.
     """
-    def get_recite_material(self):
-        pass
+    def get_recite_material(self, export_path=None):
+        """
+        All the words of all the dates that should be recited today, as one review deck. It is one query no matter how
+        many dates there are, see dbAPI.get_vocabs_of_dates().
+        :param export_path: if given, the deck is also written to this file, separated by ";" like the files in
+                GeneratedStudyMaterial/, so it can be uploaded to quizlet
+        :return: a pandas df with columns ['Rank', 'English', 'Transliteration', 'Hebrew', 'DATE_STR',
+                'ExampleSentence', 'SentenceTranslation']
+        """
+        import dbAPI
+        recite_material_df = dbAPI.get_vocabs_of_dates(self.get_recite_datetime())
+        if export_path is not None:
+            self.export_recite_material(recite_material_df, export_path)
+        return recite_material_df
+
+    @staticmethod
+    def export_recite_material(recite_material_df, export_path):
+        """
+        Write a df of get_recite_material() to export_path, separated by ";" for quizlet.
+        """
+        export_df = recite_material_df.copy()
+        export_df["Hebrew+Pronounce"] = export_df["Hebrew"] + " (" + export_df["Transliteration"] + ")"
+        export_df[["Hebrew+Pronounce", "English", "ExampleSentence", "SentenceTranslation"]].to_csv(
+            export_path, index=False, sep=";")
 
     def get_recite_datetime(self):
         return self._get_normal_recite_dates()
@@ -71,5 +103,339 @@ class EbbinghausPlanner:
         return recite_dates
 
 
+class SM2Planner:
+    """
+    This class represent a planner that schedules each word on its own, instead of each day's batch of new words.
+    It uses the SM-2 algorithm (the one of SuperMemo 2, Anki uses a variant of it): every word has an ease factor, an
+    interval in days, and the date on which it is due. A word that was remembered well is due again after a longer
+    and longer interval, a word that was forgotten starts again from 1 day.
+    Grades are the ones of SM-2:
+    5 perfect, 4 correct after a hesitation, 3 correct with difficulty, 2/1/0 not remembered.
+
+    The state of all the words is kept in numpy arrays indexed by rank (index 0 is not used), so computing the words
+    due today, the next intervals or the workload of the next days is a few vectorized operations over the whole list,
+    instead of a python loop over 10000 words.
+    Days are counted as integers from 1970-01-01 (see date_string_to_day()).
+
+    In the database, every introduce() and review() is an event in the append-only table review_event, save() only
+    appends the new events. The table word_schedule is a snapshot of the state after the events up to some event:
+    load() reads the snapshot and replays the events after it (the tail), and compact() folds the tail into the
+    snapshot, so loading stays fast while recording a review never rewrites what was written before.
+    A planner is the schedule of one user (the current one of dbAPI, see dbAPI.as_user()). For many users at once,
+    compact_users() and get_due_ranks_of_users() work on the database directly, without a planner per user.
+    """
+    default_ease = 2.5
+    minimum_ease = 1.3
+    # the grade given to a recitation from the study_progress tables, since we don't know how well it went
+    default_grade = 4
+    # load_or_rebuild() compacts the log when its tail is longer than this
+    max_uncompacted_events = 5000
+
+    def __init__(self, max_rank=10000):
+        size = max_rank + 1
+        self.ease = np.full(size, self.default_ease)
+        self.interval_days = np.zeros(size)
+        self.repetitions = np.zeros(size, dtype=np.int64)
+        self.lapses = np.zeros(size, dtype=np.int64)
+        self.due_day = np.full(size, -1, dtype=np.int64)  # -1 means the word is not introduced yet
+        self.last_reviewed_day = np.full(size, -1, dtype=np.int64)  # -1 means never reviewed
+        self.last_event_id = 0  # the last review event that is included in the arrays
+        self.num_tail_events = 0  # how many of them were replayed from the tail of the log by load()
+        self._changed = np.zeros(size, dtype=bool)  # which ranks differ from the snapshot in the database
+        self._new_events = []  # (event_type, ranks, grades, day) that save() has to append to the log
+
+    @classmethod
+    def load(cls, max_rank=10000):
+        """
+        :return: a planner with the schedule stored in the database: the snapshot, and the events after it
+        """
+        import dbAPI
+        # one transaction, so that the snapshot and the tail are of the same moment
+        with dbAPI.transaction():
+            schedule = dbAPI.get_word_schedule()
+            compacted_event_id = dbAPI.get_compacted_event_id()
+            events = dbAPI.get_review_events(after_event_id=compacted_event_id)
+        ranks = schedule["rank"]
+        max_event_rank = max((event[1] for event in events), default=0)
+        planner = cls(max(max_rank, int(ranks.max()) if len(ranks) else 0, max_event_rank))
+        planner.ease[ranks] = schedule["ease"]
+        planner.interval_days[ranks] = schedule["interval_days"]
+        planner.repetitions[ranks] = schedule["repetitions"]
+        planner.lapses[ranks] = schedule["lapses"]
+        planner.due_day[ranks] = schedule["due_day"]
+        planner.last_reviewed_day[ranks] = schedule["last_reviewed_day"]
+        planner.last_event_id = compacted_event_id
+        planner._apply_events(events)
+        return planner
+
+    @classmethod
+    def load_or_rebuild(cls, max_rank=10000):
+        """
+        :return: the planner stored in the database, or, if the per-word schedule was never used, one started from
+                the study history (and saved). If the tail of the log got long, it is compacted first.
+        """
+        planner = cls.load(max_rank)
+        if planner.num_tail_events > cls.max_uncompacted_events:
+            planner, _ = cls.compact(max_rank)
+        if not (planner.due_day >= 0).any():
+            # the study history is the log of the time before the per-word schedule, only the snapshot is saved
+            planner = cls.rebuild_from_history(max_rank)
+            planner._new_events = []
+            planner._save_snapshot()
+        return planner
+
+    @classmethod
+    def compact(cls, max_rank=10000):
+        """
+        Fold the events of the log that are not in word_schedule yet into it: only the words that have new events are
+        written, and the log itself is not changed. Run it now and then (load_or_rebuild() does it when the tail is
+        long, or "python CommandLineInterface.py compact").
+        :return: the planner, as load() would return it, and the number of events that were folded
+        """
+        import dbAPI
+        with dbAPI.transaction():
+            planner = cls.load(max_rank)
+            num_events = planner.num_tail_events
+            planner._save_snapshot()
+        return planner, num_events
+
+    @classmethod
+    def compact_users(cls, user_ids=None):
+        """
+        compact() for many users: the tails of their logs, and the snapshot rows of the ranks in them, are read in one
+        pass per database file, and each user's tail is replayed on a planner that is only as big as the highest rank
+        it touches (the other ranks are not read nor written).
+        :param user_ids: None for all the users
+        :return: a dictionary user_id -> the number of events that were folded, for the users that had a tail
+        """
+        import dbAPI
+        num_events = {}
+        for db_path, db_user_ids in dbAPI._group_users_by_database(user_ids).items():
+            with dbAPI.transaction(db_path):
+                tails = dbAPI.get_log_tails_of_users(db_path, db_user_ids)
+                for user_id, (compacted_event_id, events, schedule) in tails.items():
+                    planner = cls(max(event[1] for event in events))
+                    ranks = schedule["rank"]
+                    planner.ease[ranks] = schedule["ease"]
+                    planner.interval_days[ranks] = schedule["interval_days"]
+                    planner.repetitions[ranks] = schedule["repetitions"]
+                    planner.lapses[ranks] = schedule["lapses"]
+                    planner.due_day[ranks] = schedule["due_day"]
+                    planner.last_reviewed_day[ranks] = schedule["last_reviewed_day"]
+                    planner.last_event_id = compacted_event_id
+                    planner._apply_events(events)
+                    with dbAPI.as_user(user_id):
+                        planner._save_snapshot()
+                    num_events[user_id] = len(events)
+        return num_events
+
+    @classmethod
+    def get_due_ranks_of_users(cls, user_ids=None, day=None, limit=None):
+        """
+        get_due_ranks() of many users (e.g. a whole class), as one batched pass instead of a load() per user: the
+        tails of the logs are compacted, then the due words of all the users of a database file are one query.
+        Users whose schedule was never started (see load_or_rebuild()) have no due words here.
+        :param user_ids: None for all the users
+        :return: a dictionary user_id -> numpy array of ranks, like get_due_ranks()
+        """
+        import dbAPI
+        day = today_as_day() if day is None else day
+        cls.compact_users(user_ids)
+        return dbAPI.get_due_ranks_of_users(day, limit=limit, user_ids=user_ids)
+
+    @classmethod
+    def rebuild_from_history(cls, max_rank=10000):
+        """
+        Compute the schedule from the study_progress tables: each date's new material is introduced on that date, and
+        each recitation of a date's material counts as a review with default_grade, in chronological order.
+        Use this once to start the per-word schedule from an existing study history.
+        :return: the planner, it is not saved yet
+        """
+        import dbAPI
+        planner = cls(max_rank)
+        material_ranges = {}
+        events = []  # (day, 0 for introduce / 1 for review, begin_rank, end_rank)
+        for date_str, begin_rank, end_rank in dbAPI.get_new_material_ranges():
+            material_ranges.setdefault(date_str, []).append((begin_rank, end_rank))
+            events.append((date_string_to_day(date_str), 0, begin_rank, end_rank))
+        for material_date_str, recited_on_date_str in dbAPI.get_recitations():
+            for begin_rank, end_rank in material_ranges.get(material_date_str, []):
+                events.append((date_string_to_day(recited_on_date_str), 1, begin_rank, end_rank))
+        for day, event_type, begin_rank, end_rank in sorted(events):
+            ranks = np.arange(begin_rank, min(end_rank, max_rank) + 1)
+            if event_type == 0:
+                planner.introduce(ranks, day)
+            else:
+                planner.review(ranks, np.full(len(ranks), cls.default_grade), day)
+        return planner
+
+    def save(self):
+        """
+        Append the events since the last load/save to the log, in one transaction. The snapshot is not written, see
+        compact().
+        """
+        import dbAPI
+        event_types, ranks, grades, days = [], [], [], []
+        for event_type, event_ranks, event_grades, day in self._new_events:
+            event_types += [event_type] * len(event_ranks)
+            ranks += event_ranks.tolist()
+            grades += [None] * len(event_ranks) if event_grades is None else event_grades.tolist()
+            days += [day] * len(event_ranks)
+        if ranks:
+            dbAPI.append_review_events(event_types, ranks, grades, days)
+        self._new_events = []
+
+    def _save_snapshot(self):
+        """
+        Write the words that differ from the snapshot in the database, as the state after self.last_event_id.
+        The events that were not saved yet (e.g. a review() before compact()) are appended to the log first, in the
+        same transaction, so the snapshot is the state after them.
+        """
+        import dbAPI
+        with dbAPI.transaction():
+            if self._new_events:
+                self.save()
+                self.last_event_id = dbAPI.get_last_review_event_id()
+            ranks = np.flatnonzero(self._changed)
+            dbAPI.save_word_schedule(ranks, self.ease[ranks], self.interval_days[ranks], self.repetitions[ranks],
+                                     self.lapses[ranks], self.due_day[ranks], self.last_reviewed_day[ranks],
+                                     last_event_id=self.last_event_id)
+        self._changed[:] = False
+        self.num_tail_events = 0
+
+    def introduce(self, ranks, day=None):
+        """
+        Start scheduling new words, they are first due the day after they are studied.
+        Words that are already scheduled are left as they are.
+        :param ranks: a numpy array (or list) of ranks
+        :param day: the day they were studied, today if None
+        """
+        day = today_as_day() if day is None else day
+        ranks = self._introduce(np.asarray(ranks, dtype=np.int64), day)
+        if len(ranks):
+            self._new_events.append((INTRODUCE, ranks, None, day))
+
+    def review(self, ranks, grades, day=None):
+        """
+        Record the reviews of some words (SM-2), and schedule their next review.
+        :param ranks: a numpy array of ranks, without duplicates
+        :param grades: a numpy array of grades 0-5, same length as ranks
+        :param day: the day of the review, today if None
+        """
+        day = today_as_day() if day is None else day
+        ranks = np.asarray(ranks, dtype=np.int64)
+        grades = np.asarray(grades, dtype=np.int64)
+        self._review(ranks, grades, day)
+        if len(ranks):
+            self._new_events.append((REVIEW, ranks, grades, day))
+
+    def _introduce(self, ranks, day):
+        """
+        :return: the ranks that were not scheduled yet, the only ones that changed
+        """
+        ranks = ranks[self.due_day[ranks] < 0]
+        self.due_day[ranks] = day + 1
+        self.interval_days[ranks] = 0
+        self.repetitions[ranks] = 0
+        self._changed[ranks] = True
+        return ranks
+
+    def _review(self, ranks, grades, day):
+        interval_days, ease, repetitions = self._next_state(ranks, grades)
+        passed = grades >= 3
+        self.interval_days[ranks] = interval_days
+        self.ease[ranks] = ease
+        self.repetitions[ranks] = repetitions
+        self.lapses[ranks] += ~passed
+        self.due_day[ranks] = day + interval_days.astype(np.int64)
+        self.last_reviewed_day[ranks] = day
+        self._changed[ranks] = True
+
+    def _apply_events(self, events):
+        """
+        Replay events of the log, see dbAPI.get_review_events(). The events that follow each other with the same type
+        and day are applied together, as long as no rank appears twice.
+        """
+        batch_ranks, batch_grades, batch_key = [], [], None
+        batch_rank_set = set()
+
+        def apply_batch():
+            if batch_key is None or not batch_ranks:
+                return
+            if batch_key[0] == INTRODUCE:
+                self._introduce(np.array(batch_ranks, dtype=np.int64), batch_key[1])
+            else:
+                self._review(np.array(batch_ranks, dtype=np.int64), np.array(batch_grades, dtype=np.int64),
+                             batch_key[1])
+
+        for event_id, rank, event_type, grade, day in events:
+            if (event_type, day) != batch_key or rank in batch_rank_set:
+                apply_batch()
+                batch_ranks, batch_grades, batch_key = [], [], (event_type, day)
+                batch_rank_set = set()
+            batch_ranks.append(rank)
+            batch_grades.append(grade)
+            batch_rank_set.add(rank)
+            self.last_event_id = event_id
+        apply_batch()
+        self.num_tail_events += len(events)
+
+    def preview_intervals(self, ranks, grade):
+        """
+        :return: the intervals (in days) that the words would get if they were reviewed now with this grade
+        """
+        ranks = np.asarray(ranks, dtype=np.int64)
+        return self._next_state(ranks, np.full(len(ranks), grade))[0]
+
+    def get_due_ranks(self, day=None, limit=None):
+        """
+        :param day: today if None
+        :param limit: return at most this many ranks
+        :return: a numpy array of the ranks that are due on this day (or overdue), the most overdue first, and then by
+                rank (more frequent words first)
+        """
+        day = today_as_day() if day is None else day
+        due_ranks = np.flatnonzero((self.due_day >= 0) & (self.due_day <= day))
+        due_ranks = due_ranks[np.argsort(self.due_day[due_ranks], kind="stable")]
+        return due_ranks if limit is None else due_ranks[:limit]
+
+    def get_workload(self, num_days=30, day=None):
+        """
+        :return: a numpy array of length num_days, the number of words due on each of the next days (the first one is
+                today, and includes the overdue words)
+        """
+        day = today_as_day() if day is None else day
+        scheduled_due_days = self.due_day[self.due_day >= 0]
+        days_from_today = np.maximum(scheduled_due_days - day, 0)
+        return np.bincount(days_from_today[days_from_today < num_days], minlength=num_days)
+
+    def _next_state(self, ranks, grades):
+        """
+        The SM-2 formulas, for many words at once.
+        :return: the new interval_days, ease and repetitions of the words
+        """
+        passed = grades >= 3
+        repetitions = np.where(passed, self.repetitions[ranks] + 1, 0)
+        interval_days = np.where(repetitions <= 1, 1.0,
+                                 np.where(repetitions == 2, 6.0,
+                                          np.round(self.interval_days[ranks] * self.ease[ranks])))
+        # the ease only changes when the word is remembered, a forgotten word keeps its ease and starts over
+        ease_change = 0.1 - (5 - grades) * (0.08 + (5 - grades) * 0.02)
+        ease = np.where(passed, np.maximum(self.minimum_ease, self.ease[ranks] + ease_change), self.ease[ranks])
+        return interval_days, ease, repetitions
+
+
+def today_as_day():
+    return (datetime.date.today() - epoch_date).days
+
+
+def date_string_to_day(date_str):
+    """
+    :param date_str: a string of form %Y-%m-%d
+    :return: the number of days since 1970-01-01
+    """
+    return (datetime.datetime.strptime(date_str, "%Y-%m-%d").date() - epoch_date).days
 
 
+def day_to_date_string(day):
+    return (epoch_date + datetime.timedelta(days=int(day))).strftime("%Y-%m-%d")
@@ -0,0 +1,160 @@
+"""
+This file contains a cache for the context sentences that we got from ChatGPT, so we never pay twice for the same word.
+It lives in a table of the sqlite database, so it survives crashes and re-runs.
+A sentence is identified by (Hebrew, English, model, prompt): if any of them changes, the old sentence doesn't count.
+The prompt is identified by a hash of the prompt file's content, so editing the prompt file invalidates the cache.
+"""
+import hashlib
+import time
+import dbConnection
+import Tracing
+
+my_database = "my_database.db"
+sentence_cache_table = "sentence_cache"
+
+
+class SentenceCache:
+    """
+    A sqlite backed cache of context sentences.
+    Eviction:
+    - max_entries: keep only this many entries, the least recently used ones are thrown away first
+    - max_age_days: throw away entries that were created more than this many days ago
+    Both are None by default, meaning nothing is evicted.
+    """
+
+    def __init__(self, db_path=my_database, max_entries=None, max_age_days=None):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._initialize_table()
+
+    def get_many(self, word_pairs, model, prompt_hash):
+        """
+        :param word_pairs: a list of (hebrew, english) tuples
+        :param model: the name of the language model, e.g. "gpt-3.5-turbo"
+        :param prompt_hash: see hash_prompt_file()
+        :return: a list of the same length as word_pairs, each element is either a dictionary
+                {"ExampleSentence": ..., "SentenceTranslation": ...} or None if the word is not in the cache
+        """
+        keys = [self.make_key(hebrew, english, model, prompt_hash) for hebrew, english in word_pairs]
+        found = {}
+        now = time.time()
+        with Tracing.span("SentenceCache.get_many", lookups=len(keys)) as trace_span:
+            cursor = dbConnection.get_connection(self.db_path).cursor()
+            # sqlite has a limit on the number of ? in one query, so look up in chunks
+            for chunk_begin in range(0, len(keys), 500):
+                chunk = keys[chunk_begin:chunk_begin + 500]
+                query = f"""SELECT CACHE_KEY, EXAMPLE_SENTENCE, SENTENCE_TRANSLATION
+                            FROM {sentence_cache_table}
+                            WHERE CACHE_KEY IN ({", ".join("?" * len(chunk))});"""
+                for key, example_sentence, sentence_translation in cursor.execute(query, chunk):
+                    found[key] = {"ExampleSentence": example_sentence, "SentenceTranslation": sentence_translation}
+            if found:
+                query = f"""UPDATE {sentence_cache_table}
+                            SET HITS = HITS + 1, LAST_USED_AT = ?
+                            WHERE CACHE_KEY = ?;"""
+                with dbConnection.transaction(self.db_path) as conn:
+                    conn.cursor().executemany(query, [(now, key) for key in found])
+            trace_span.set(hits=len(found))
+        results = [found.get(key) for key in keys]
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def put_many(self, word_pairs, sentences, model, prompt_hash):
+        """
+        :param word_pairs: a list of (hebrew, english) tuples
+        :param sentences: a list of dictionaries {"ExampleSentence": ..., "SentenceTranslation": ...}, of the same
+                length as word_pairs. Failed results (with an "Error" field) are not stored.
+        """
+        now = time.time()
+        rows = []
+        for (hebrew, english), sentence in zip(word_pairs, sentences):
+            if "Error" in sentence:
+                continue
+            rows.append((self.make_key(hebrew, english, model, prompt_hash), hebrew, english, model, prompt_hash,
+                         sentence["ExampleSentence"], sentence["SentenceTranslation"], now, now))
+        query = f"""INSERT OR REPLACE INTO {sentence_cache_table}
+                    (CACHE_KEY, HEBREW, ENGLISH, MODEL, PROMPT_HASH, EXAMPLE_SENTENCE, SENTENCE_TRANSLATION,
+                     CREATED_AT, LAST_USED_AT, HITS)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0);"""
+        with Tracing.span("SentenceCache.put_many", rows=len(rows)), dbConnection.transaction(self.db_path) as conn:
+            conn.cursor().executemany(query, rows)
+        if self.max_entries is not None or self.max_age_days is not None:
+            self.evict()
+
+    def evict(self):
+        """
+        Throw away the entries that are too old, and then the least recently used ones until there are at most
+        max_entries left.
+        :return: the number of entries thrown away
+        """
+        num_evicted = 0
+        with dbConnection.transaction(self.db_path) as conn:
+            cursor = conn.cursor()
+            if self.max_age_days is not None:
+                oldest_allowed = time.time() - self.max_age_days * 24 * 60 * 60
+                cursor.execute(f"DELETE FROM {sentence_cache_table} WHERE CREATED_AT < ?;", (oldest_allowed,))
+                num_evicted += cursor.rowcount
+            if self.max_entries is not None:
+                cursor.execute(f"""DELETE FROM {sentence_cache_table}
+                                   WHERE CACHE_KEY IN (SELECT CACHE_KEY FROM {sentence_cache_table}
+                                                       ORDER BY LAST_USED_AT DESC
+                                                       LIMIT -1 OFFSET ?);""", (self.max_entries,))
+                num_evicted += cursor.rowcount
+        return num_evicted
+
+    def stats(self):
+        """
+        :return: a dictionary with the hits and misses of this object, and the number of entries in the cache
+        """
+        conn = dbConnection.get_connection(self.db_path)
+        num_entries = conn.cursor().execute(f"SELECT COUNT(*) FROM {sentence_cache_table};").fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "entries": num_entries}
+
+    def clear(self):
+        dbConnection.get_connection(self.db_path).cursor().execute(f"DELETE FROM {sentence_cache_table};")
+
+    @staticmethod
+    def make_key(hebrew, english, model, prompt_hash):
+        # separate the fields with a character that can't be in any of them, so ("ab", "c") != ("a", "bc")
+        content = "\x1f".join([hebrew, english, model, prompt_hash])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def hash_prompt_file(prompt_file):
+        with open(prompt_file, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def _initialize_table(self):
+        with dbConnection.transaction(self.db_path) as conn:
+            create_sentence_cache_table(conn.cursor())
+
+
+def create_sentence_cache_table(cursor):
+    """
+    Also called by dbAPI's schema migration, so the table exists before anything reads it.
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {sentence_cache_table}(
+            CACHE_KEY TEXT PRIMARY KEY,
+            HEBREW TEXT NOT NULL,
+            ENGLISH TEXT NOT NULL,
+            MODEL TEXT NOT NULL,
+            PROMPT_HASH TEXT NOT NULL,
+            EXAMPLE_SENTENCE TEXT NOT NULL,
+            SENTENCE_TRANSLATION TEXT NOT NULL,
+            CREATED_AT REAL NOT NULL,
+            LAST_USED_AT REAL NOT NULL,
+            HITS INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {sentence_cache_table}_last_used
+                       ON {sentence_cache_table}(LAST_USED_AT);""")
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {sentence_cache_table}_word
+                       ON {sentence_cache_table}(HEBREW, ENGLISH);""")
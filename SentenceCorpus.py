@@ -0,0 +1,328 @@
+"""
+This file finds context sentences in a local Hebrew-English corpus, instead of asking ChatGPT: no network, no cost,
+and a lookup takes microseconds.
+The corpus is a tsv file of sentence pairs, either like Tatoeba's "sentence pairs" download
+(hebrew id, hebrew sentence, english id, english sentence) or just (hebrew sentence, english sentence).
+build_corpus_index() turns it into an index file once, and SentenceCorpus reads the index with mmap, so opening it
+doesn't read the whole file, and only the pages that a lookup touches are loaded.
+The index is an inverted index: for every token (a Hebrew word normalized with HebrewText, and the same word without
+the prefix letters ו ה ב ל מ ש כ, so "הספר" is also found as "ספר") the list of sentences that have it, already sorted
+from the best example to the worst. The best example is:
+1. the word itself, not only with a prefix
+2. the fewest words that are not in the frequency list (a sentence of common words is easier to learn from)
+3. the shortest
+CorpusSentenceGenerator gives the same results as ReciteMaterialGenerator, and only asks a fallback (e.g. ChatGPT) for
+the words that are not in the corpus. Among the best sentences of a word it takes the first whose translation has a
+word of the English meaning, so the different meanings of a word get different sentences. When none of them has it
+(e.g. את is in many sentences, but as the object marker, not as "you (f.)"), the word goes to the fallback too.
+Usage:
+    build_corpus_index("heb-eng.tsv", corpus_index_path)
+    generator = CorpusSentenceGenerator(SentenceCorpus(corpus_index_path))
+    sentences = generator.get_context_sentence(new_materials_df)
+"""
+import csv
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+import HebrewText
+
+corpus_index_path = "hebrew_corpus.idx"
+corpus_model_name = "corpus"  # the "model" of the corpus sentences in the SentenceCache
+hebrew_prefix_letters = "והבלמשכ"
+max_prefix_length = 2  # e.g. "וה" in "והספר"
+max_sentence_tokens = 20  # longer sentences are not good examples, they are left out of the index
+max_candidates = 20  # the best sentences of a word among which the generator looks for its meaning
+# magic, version, byte order, number of sentences, tokens and postings, the sha256 of the tsv, then the offset of each
+# section: sentence offsets, sentence text, token offsets, token text, posting offsets, postings
+_header_format = "<4sIBxxxIII32s6Q"
+_magic = b"LHSC"
+_version = 1
+
+
+def build_corpus_index(tsv_path, index_path=corpus_index_path, frequent_words=None):
+    """
+    :param tsv_path: the sentence pairs, see the top of this file
+    :param frequent_words: a set of normalized Hebrew words that count as common, by default the words of hebrew_list
+    :return: the number of sentences in the index
+    """
+    if frequent_words is None:
+        frequent_words = _get_frequent_words()
+    sentences = []  # (hebrew, english)
+    sentence_keys = []  # (number of uncommon words, number of words), smaller is a better example
+    postings = {}  # token -> list of (not exact, sentence id)
+    seen_sentences = set()
+    with open(tsv_path, "rb") as file:
+        corpus_hash = hashlib.sha256(file.read()).digest()
+    for hebrew, english in _read_sentence_pairs(tsv_path):
+        tokens = HebrewText.normalize_hebrew(hebrew).split()
+        if not tokens or len(tokens) > max_sentence_tokens or hebrew in seen_sentences:
+            continue
+        seen_sentences.add(hebrew)
+        sentence_id = len(sentences)
+        sentences.append((hebrew, english))
+        num_uncommon = 0
+        token_variants = {}  # token -> True if it is in the sentence as it is, False if only after a prefix
+        for token in tokens:
+            variants = _get_token_variants(token)
+            if not any(variant in frequent_words for variant in variants):
+                num_uncommon += 1
+            for variant in variants:
+                token_variants[variant] = token_variants.get(variant, False) or variant == token
+        sentence_keys.append((num_uncommon, len(tokens)))
+        for variant, is_exact in token_variants.items():
+            postings.setdefault(variant, []).append((not is_exact, sentence_id))
+    _write_index(index_path, sentences, sentence_keys, postings, corpus_hash)
+    return len(sentences)
+
+
+class SentenceCorpus:
+    """
+    A read-only view of an index file made by build_corpus_index().
+    """
+
+    def __init__(self, index_path=corpus_index_path):
+        self.index_path = index_path
+        self._file = open(index_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.unpack_from(_header_format, self._mmap, 0)
+        magic, version, is_little_endian, self.num_sentences, self.num_tokens, num_postings, corpus_hash = header[:7]
+        if magic != _magic or version != _version:
+            raise ValueError(f"{index_path} is not a corpus index of this version, build it again")
+        if bool(is_little_endian) != (sys.byteorder == "little"):
+            raise ValueError(f"{index_path} was built on a machine with another byte order, build it again")
+        # the hash of the tsv the index was built from, it identifies the corpus in the SentenceCache
+        self.fingerprint = corpus_hash.hex()
+        (sentence_offsets_at, sentence_text_at, token_offsets_at, token_text_at, posting_offsets_at,
+         postings_at) = header[7:]
+        view = memoryview(self._mmap)
+        self._sentence_offsets = view[sentence_offsets_at:sentence_offsets_at + 8 * (self.num_sentences + 1)].cast("Q")
+        self._sentence_text = view[sentence_text_at:token_offsets_at]
+        self._token_offsets = view[token_offsets_at:token_offsets_at + 8 * (self.num_tokens + 1)].cast("Q")
+        self._token_text = view[token_text_at:posting_offsets_at]
+        self._posting_offsets = view[posting_offsets_at:posting_offsets_at + 8 * (self.num_tokens + 1)].cast("Q")
+        self._postings = view[postings_at:postings_at + 4 * num_postings].cast("I")
+
+    def find_sentences(self, hebrew_word, limit=1):
+        """
+        :param hebrew_word: a word (or a few words) of the frequency list, with or without niqqud
+        :return: a list of up to limit (hebrew sentence, english sentence), the best example first. For several words,
+                the sentences that have all of them.
+        """
+        tokens = HebrewText.normalize_hebrew(hebrew_word).split()
+        if not tokens:
+            return []
+        posting_lists = [self._get_postings(token) for token in tokens]
+        # go through the shortest list in its order, and keep the sentences that are in all the others
+        posting_lists.sort(key=len)
+        others = [set(posting_list) for posting_list in posting_lists[1:]]
+        sentences = []
+        for sentence_id in posting_lists[0]:
+            if all(sentence_id in other for other in others):
+                sentences.append(self._get_sentence(sentence_id))
+                if len(sentences) == limit:
+                    break
+        return sentences
+
+    def find_sentence_of_meaning(self, hebrew_word, english):
+        """
+        :param english: the meaning of the word, e.g. "people / nation"
+        :return: the best (hebrew sentence, english sentence) of the word in this meaning (see _choose_sentence()),
+                None if the corpus has none
+        """
+        return _choose_sentence(self.find_sentences(hebrew_word, limit=max_candidates), english)
+
+    def close(self):
+        # the memoryviews must be released before the mmap can be closed
+        for view in [self._sentence_offsets, self._sentence_text, self._token_offsets, self._token_text,
+                     self._posting_offsets, self._postings]:
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_sentences
+
+    def _get_postings(self, token):
+        """
+        :return: the sentence ids of the token (a memoryview, best example first), empty if it is not in the index
+        """
+        token_bytes = token.encode("utf-8")
+        # binary search in the sorted tokens
+        low, high = 0, self.num_tokens
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_token(middle) < token_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.num_tokens or self._get_token(low) != token_bytes:
+            return self._postings[0:0]
+        return self._postings[self._posting_offsets[low]:self._posting_offsets[low + 1]]
+
+    def _get_token(self, token_id):
+        return self._token_text[self._token_offsets[token_id]:self._token_offsets[token_id + 1]].tobytes()
+
+    def _get_sentence(self, sentence_id):
+        text = self._sentence_text[self._sentence_offsets[sentence_id]:self._sentence_offsets[sentence_id + 1]]
+        hebrew, english = bytes(text).decode("utf-8").split("\t", 1)
+        return hebrew, english
+
+
+class CorpusSentenceGenerator:
+    """
+    A context sentence generator backed by a SentenceCorpus, with the same results as ReciteMaterialGenerator.
+    """
+
+    def __init__(self, corpus, fallback=None, cache=None):
+        """
+        :param corpus: a SentenceCorpus
+        :param fallback: a function that takes a df of the words that are not in the corpus and returns their results
+                (e.g. ReciteMaterialGenerator's get_context_sentence_from_ChatGPT_concurrently with the API key), None
+                to give these words an "Error" field
+        :param cache: a SentenceCache, if given the corpus sentences are stored in it (as the model "corpus"), so that
+                exports and review decks find them like the ChatGPT ones
+        """
+        self.corpus = corpus
+        self.fallback = fallback
+        self.cache = cache
+        self.num_found = 0
+        self.num_fallback = 0
+
+    def get_context_sentence(self, new_materials_df):
+        """
+        :param new_materials_df: a pandas df with columns ['Rank', 'Transliteration', 'Hebrew', 'English']
+        :return: a list of dictionaries {"ExampleSentence": ..., "SentenceTranslation": ...}, in the same order as the
+                rows of new_materials_df
+        """
+        results = []
+        missing = []
+        for i, (hebrew_word, english) in enumerate(zip(new_materials_df["Hebrew"], new_materials_df["English"])):
+            sentence = self.corpus.find_sentence_of_meaning(hebrew_word, english)
+            if sentence is not None:
+                hebrew_sentence, english_sentence = sentence
+                results.append({"ExampleSentence": hebrew_sentence, "SentenceTranslation": english_sentence})
+            else:
+                results.append(None)
+                missing.append(i)
+        if self.cache is not None:
+            found = [i for i, result in enumerate(results) if result is not None]
+            self.cache.put_many([(new_materials_df["Hebrew"].iloc[i], new_materials_df["English"].iloc[i])
+                                 for i in found], [results[i] for i in found], corpus_model_name,
+                                self.corpus.fingerprint)
+        self.num_found += len(results) - len(missing)
+        self.num_fallback += len(missing)
+        if missing:
+            if self.fallback is not None:
+                fallback_results = self.fallback(new_materials_df.iloc[missing])
+            else:
+                fallback_results = [{"ExampleSentence": "", "SentenceTranslation": "",
+                                     "Error": "The word (in this meaning) is not in the corpus"}] * len(missing)
+            for i, result in zip(missing, fallback_results):
+                results[i] = result
+        return results
+
+
+def _choose_sentence(sentences, english):
+    """
+    A Hebrew word can have several meanings (e.g. "עם" is "with" and "people"), and every meaning is its own row.
+    :param sentences: the candidates, best example first
+    :param english: the meaning of this row, e.g. "people / nation"
+    :return: the first sentence whose translation has a word of the meaning, None if none has it (the sentences may
+            all be of another meaning of the word)
+    """
+    words = re.findall(r"[a-z]+", english.lower())
+    # the short words ("of", "to", "a") are in most sentences, unless the meaning is only short words, e.g. "he"
+    meaning_words = {word for word in words if len(word) > 2} or set(words)
+    for hebrew_sentence, english_sentence in sentences:
+        if meaning_words & set(re.findall(r"[a-z]+", english_sentence.lower())):
+            return hebrew_sentence, english_sentence
+    return None
+
+
+def _get_token_variants(token):
+    """
+    :return: the token, and the token without up to max_prefix_length prefix letters (if at least 2 letters are left)
+    """
+    variants = [token]
+    for prefix_length in range(1, max_prefix_length + 1):
+        if len(token) - prefix_length < 2 or token[prefix_length - 1] not in hebrew_prefix_letters:
+            break
+        variants.append(token[prefix_length:])
+    return variants
+
+
+def _read_sentence_pairs(tsv_path):
+    """
+    :return: a generator of (hebrew, english), from a tsv with 4 columns (Tatoeba) or 2 columns
+    """
+    with open(tsv_path, "r", encoding="utf-8", newline="") as file:
+        for row in csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if len(row) >= 4:
+                hebrew, english = row[1], row[3]
+            elif len(row) >= 2:
+                hebrew, english = row[0], row[1]
+            else:
+                continue
+            hebrew, english = hebrew.strip(), english.strip()
+            # a tab would break the "hebrew\tenglish" entries of the index
+            if hebrew and english and "\t" not in english:
+                yield hebrew, english
+
+
+def _get_frequent_words():
+    # only needed when building, so imported here
+    import dbAPI
+    rows = dbAPI._connect_shared().execute(f"SELECT Hebrew FROM {dbAPI.hebrew_list_table};").fetchall()
+    return {HebrewText.normalize_hebrew(row[0]) for row in rows}
+
+
+def _write_index(index_path, sentences, sentence_keys, postings, corpus_hash):
+    sentence_offsets = [0]
+    sentence_text = bytearray()
+    for hebrew, english in sentences:
+        sentence_text += f"{hebrew}\t{english}".encode("utf-8")
+        sentence_offsets.append(len(sentence_text))
+    token_offsets = [0]
+    token_text = bytearray()
+    posting_offsets = [0]
+    posting_ids = []
+    # sorted by their utf-8 bytes, which is what SentenceCorpus compares
+    for token in sorted(postings, key=lambda token: token.encode("utf-8")):
+        token_text += token.encode("utf-8")
+        token_offsets.append(len(token_text))
+        ordered = sorted(postings[token], key=lambda posting: (posting[0], sentence_keys[posting[1]], posting[1]))
+        posting_ids.extend(sentence_id for _, sentence_id in ordered)
+        posting_offsets.append(len(posting_ids))
+    sections = [struct.pack(f"={len(sentence_offsets)}Q", *sentence_offsets), bytes(sentence_text),
+                struct.pack(f"={len(token_offsets)}Q", *token_offsets), bytes(token_text),
+                struct.pack(f"={len(posting_offsets)}Q", *posting_offsets),
+                struct.pack(f"={len(posting_ids)}I", *posting_ids)]
+    # every section starts at a multiple of 8 bytes, so the arrays are aligned
+    section_offsets = []
+    position = _align(struct.calcsize(_header_format))
+    for section in sections:
+        section_offsets.append(position)
+        position = _align(position + len(section))
+    header = struct.pack(_header_format, _magic, _version, sys.byteorder == "little", len(sentences),
+                         len(token_offsets) - 1, len(posting_ids), corpus_hash, *section_offsets)
+    temporary_path = index_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(header)
+        for section_offset, section in zip(section_offsets, sections):
+            file.write(b"\0" * (section_offset - file.tell()))
+            file.write(section)
+    # replace the old index only when the new one is complete
+    os.replace(temporary_path, index_path)
+
+
+def _align(position):
+    return (position + 7) // 8 * 8
@@ -0,0 +1,216 @@
+"""
+This file exports the studied words (with their context sentences from the sentence cache) to files that flash card
+programs can import:
+- QuizletWriter: delimited text, like the files in GeneratedStudyMaterial/ (Quizlet's import takes this)
+- JsonlWriter: one json object per line
+- AnkiPackageWriter: an Anki package (.apkg), needs the genanki package
+The cards are streamed: iter_study_cards() reads them from the database in batches, and each card is handed to every
+writer and written at once, so the memory used doesn't depend on how many dates are exported.
+An export can be incremental: it remembers (under a name, per user) when it ran last, and next time only writes the
+cards that changed since then (new material of a date, or a new context sentence).
+Usage:
+    with QuizletWriter("words.csv") as quizlet_writer, JsonlWriter("words.jsonl") as jsonl_writer:
+        export_study_material([quizlet_writer, jsonl_writer], begin_date_str="2023-12-01")
+"""
+import csv
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+from collections import namedtuple
+import dbAPI
+
+export_state_table = dbAPI.export_state_table
+# ExampleSentence and SentenceTranslation are None if the word has no sentence in the cache
+StudyCard = namedtuple("StudyCard", ["Rank", "English", "Transliteration", "Hebrew", "DATE_STR", "ExampleSentence",
+                                     "SentenceTranslation"])
+
+
+def iter_study_cards(begin_date_str=None, end_date_str=None, changed_since=None, batch_size=500):
+    """
+    :param begin_date_str: only the new material of the dates from this date (inclusive), None for no limit
+    :param end_date_str: only the new material of the dates until this date (inclusive), None for no limit
+    :param changed_since: a unix timestamp, only the cards whose date was updated, or whose sentence was generated, at
+            or after this time. None for all cards.
+    :param batch_size: how many rows are fetched from the database at a time
+    :return: a generator of StudyCard, one per word (a word in the new material of several dates comes once, with the
+            first date), ordered by rank
+    """
+    window_condition, parameters = dbAPI._date_window_condition(f"s.{dbAPI.date_string_col_name}",
+                                                                begin_date_str, end_date_str)
+    condition = window_condition
+    if changed_since is not None:
+        condition += (f" AND (CAST(strftime('%s', s.{dbAPI.updated_at_col_name}) AS REAL) >= ?"
+                      f" OR c.CREATED_AT >= ?)")
+        parameters = parameters + [changed_since, changed_since]
+    query = dbAPI._studied_words_query(condition)
+    cursor = dbAPI._connect().cursor()
+    cursor.execute(query, [dbAPI.get_user_id()] + parameters)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield StudyCard(*row)
+
+
+def export_study_material(writers, begin_date_str=None, end_date_str=None, incremental_name=None):
+    """
+    Write the cards of the dates in [begin_date_str, end_date_str] to all the writers, in one pass over the database.
+    :param writers: a list of writers (QuizletWriter, JsonlWriter, AnkiPackageWriter...), anything with write(card)
+    :param incremental_name: if given, only the cards that changed since the last export with this name are written,
+            and this export is remembered under this name
+    :return: the number of cards written
+    """
+    # whole seconds, rounded down, because UPDATED_AT has seconds precision: a card can be exported twice, but a card
+    # changed while this export runs is never missed
+    export_begin_time = math.floor(time.time())
+    changed_since = get_last_export_time(incremental_name) if incremental_name is not None else None
+    num_cards = 0
+    for card in iter_study_cards(begin_date_str, end_date_str, changed_since):
+        for writer in writers:
+            writer.write(card)
+        num_cards += 1
+    if incremental_name is not None:
+        query = f"""INSERT INTO {export_state_table} ({dbAPI.user_id_col_name}, EXPORT_NAME, LAST_EXPORTED_AT)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT({dbAPI.user_id_col_name}, EXPORT_NAME) DO UPDATE SET
+                        LAST_EXPORTED_AT = excluded.LAST_EXPORTED_AT;"""
+        dbAPI._connect().execute(query, (dbAPI.get_user_id(), incremental_name, export_begin_time))
+    return num_cards
+
+
+def get_last_export_time(incremental_name):
+    """
+    :return: the unix timestamp of the last export with this name, None if there was none
+    """
+    query = f"SELECT LAST_EXPORTED_AT FROM {export_state_table} WHERE {dbAPI.user_id_col_name} = ? AND EXPORT_NAME = ?;"
+    row = dbAPI._connect().execute(query, (dbAPI.get_user_id(), incremental_name)).fetchone()
+    return row[0] if row else None
+
+
+#######################################################################################################################
+#######################################################################################################################
+########################################################## writers ####################################################
+#######################################################################################################################
+#######################################################################################################################
+
+class _Writer:
+    """
+    Writers are context managers, the file is complete only after close().
+    """
+
+    def write(self, card):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def get_field(card, field):
+        """
+        :param field: a field of StudyCard, or "Hebrew+Pronounce" for "hebrew (transliteration)"
+        """
+        if field == "Hebrew+Pronounce":
+            return f"{card.Hebrew} ({card.Transliteration})"
+        value = getattr(card, field)
+        return "" if value is None else value
+
+
+class QuizletWriter(_Writer):
+    """
+    Delimited text, one card per line. By default it is the same as the HL_ files of GeneratedStudyMaterial/:
+    "Hebrew+Pronounce;English", with a header.
+    """
+
+    def __init__(self, path, fields=("Hebrew+Pronounce", "English"), delimiter=";", header=True):
+        self.fields = fields
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._csv_writer = csv.writer(self._file, delimiter=delimiter, lineterminator="\n")
+        if header:
+            self._csv_writer.writerow(fields)
+
+    def write(self, card):
+        self._csv_writer.writerow([self.get_field(card, field) for field in self.fields])
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter(_Writer):
+    """
+    One json object per line, with all the fields of StudyCard.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, card):
+        self._file.write(json.dumps(card._asdict(), ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class AnkiPackageWriter(_Writer):
+    """
+    An Anki package (.apkg) with one note per word: the front is the Hebrew word and its transliteration, the back the
+    English translation and the context sentence.
+    The notes are written to the package's sqlite collection as they come, so they are not kept in memory. Each note
+    has a fixed id (from the word), so importing an incremental export into Anki updates the notes instead of adding
+    them again.
+    """
+    # random, but fixed, so that Anki knows it is the same deck and note type in every export
+    deck_id = 1702912339
+    model_id = 1702912340
+
+    def __init__(self, path, deck_name="Hebrew frequency list"):
+        # optional dependency, only needed for this writer
+        import genanki
+        self._genanki = genanki
+        self.path = path
+        self._model = genanki.Model(
+            self.model_id, "LearnHebrew word",
+            fields=[{"name": "Hebrew"}, {"name": "Transliteration"}, {"name": "English"},
+                    {"name": "ExampleSentence"}, {"name": "SentenceTranslation"}],
+            templates=[{
+                "name": "Hebrew to English",
+                "qfmt": '<div dir="rtl">{{Hebrew}}</div><div>{{Transliteration}}</div>',
+                "afmt": '{{FrontSide}}<hr id="answer">{{English}}'
+                        '<div dir="rtl">{{ExampleSentence}}</div><div>{{SentenceTranslation}}</div>',
+            }])
+        deck = genanki.Deck(self.deck_id, deck_name)
+        deck.add_model(self._model)
+        database_file, self._database_path = tempfile.mkstemp(suffix=".anki2")
+        os.close(database_file)
+        self._timestamp = time.time()
+        self._id_generator = iter(range(int(self._timestamp * 1000), 2 ** 62))
+        self._conn = sqlite3.connect(self._database_path)
+        self._cursor = self._conn.cursor()
+        # creates the collection with the (still empty) deck
+        genanki.Package(deck).write_to_db(self._cursor, self._timestamp, self._id_generator)
+
+    def write(self, card):
+        note = self._genanki.Note(
+            model=self._model,
+            fields=[self.get_field(card, field) for field in
+                    ["Hebrew", "Transliteration", "English", "ExampleSentence", "SentenceTranslation"]],
+            guid=self._genanki.guid_for(card.Rank, card.Hebrew, card.English))
+        note.write_to_db(self._cursor, self._timestamp, self.deck_id, self._id_generator)
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+        with zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED) as package:
+            package.write(self._database_path, "collection.anki2")
+            package.writestr("media", "{}")
+        os.remove(self._database_path)
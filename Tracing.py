@@ -0,0 +1,208 @@
+"""
+This file records how long the slow operations take (database connections, transactions and queries, ChatGPT requests,
+sentence cache lookups), so that when generating the daily material is slow we can see where the time went.
+Every operation is a span: a name, a duration, the span it happened in, and some numbers about it (rows, tokens,
+retries, cache hits...).
+Tracing is off by default, and then span() does nothing but return a shared dummy object. Turn it on with:
+- the environment variable LEARNHEBREW_TRACE: "1" to record, or a file path to also write the trace there at exit
+- enable() from the code (e.g. option 7 of UserInterface)
+The trace file is in the Chrome trace format, it can be opened with https://ui.perfetto.dev or chrome://tracing.
+Usage:
+    with Tracing.span("dbAPI.get_vocabs", begin_rank=begin_rank) as trace_span:
+        df = ...
+        trace_span.set(rows=len(df))
+"""
+import atexit
+import collections
+import contextvars
+import json
+import os
+import threading
+import time
+
+trace_environment_variable = "LEARNHEBREW_TRACE"
+# only the last spans are kept, so that a process that runs for days with tracing on (the prefetch worker) doesn't
+# grow without limit
+max_finished_spans = 100000
+
+_enabled = False
+_output_path = None  # where the trace is written at exit, None for nowhere
+_finished_spans = collections.deque(maxlen=max_finished_spans)
+_spans_lock = threading.Lock()
+_next_span_id = 0
+# the span we are in, a contextvar so that asyncio tasks (and threads) each have their own
+_current_span = contextvars.ContextVar("current_span", default=None)
+_process_begin_time = time.perf_counter()
+
+
+class Span:
+    """
+    One recorded operation. Use set() for values, and add() for counters (e.g. rows, a retry).
+    """
+
+    def __init__(self, name, attributes):
+        global _next_span_id
+        with _spans_lock:
+            _next_span_id += 1
+            self.span_id = _next_span_id
+        self.name = name
+        self.attributes = attributes
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.thread_id = threading.get_ident()
+        self.begin_time = None
+        self.duration = None
+        self.error = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, attribute, amount=1):
+        self.attributes[attribute] = self.attributes.get(attribute, 0) + amount
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        self.begin_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.begin_time
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        with _spans_lock:
+            _finished_spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {"name": self.name, "span_id": self.span_id, "parent_id": self.parent_id, "thread_id": self.thread_id,
+                "begin_ms": 1000 * (self.begin_time - _process_begin_time), "duration_ms": 1000 * self.duration,
+                "attributes": self.attributes, "error": self.error}
+
+
+class _NoSpan:
+    """
+    What span() returns when tracing is off: accepts everything and records nothing.
+    """
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, attribute, amount=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, **attributes):
+    """
+    :return: a context manager that records the code in it as a span, if tracing is on
+    """
+    if not _enabled:
+        return _no_span
+    return Span(name, attributes)
+
+
+def enable(output_path=None):
+    """
+    Start recording spans.
+    :param output_path: if given, the trace is written to this file when the program exits
+    """
+    global _enabled, _output_path
+    _enabled = True
+    if output_path is not None:
+        _output_path = output_path
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_spans():
+    """
+    :return: a list of dictionaries, one per finished span (the last max_finished_spans of them), in the order they
+            finished
+    """
+    with _spans_lock:
+        spans = list(_finished_spans)
+    return [finished_span.to_dict() for finished_span in spans]
+
+
+def clear():
+    with _spans_lock:
+        _finished_spans.clear()
+
+
+def write_trace(path):
+    """
+    Write the finished spans to path in the Chrome trace format (the attributes are the "args" of each event).
+    """
+    events = []
+    for finished_span in get_spans():
+        args = dict(finished_span["attributes"], span_id=finished_span["span_id"],
+                    parent_id=finished_span["parent_id"])
+        if finished_span["error"] is not None:
+            args["error"] = finished_span["error"]
+        events.append({"name": finished_span["name"], "ph": "X", "pid": os.getpid(), "tid": finished_span["thread_id"],
+                       "ts": 1000 * finished_span["begin_ms"], "dur": 1000 * finished_span["duration_ms"],
+                       "args": args})
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, ensure_ascii=False, default=str)
+
+
+def get_summary():
+    """
+    :return: a list of dictionaries, one per span name, with the number of calls, the total, mean and max duration in
+            ms, the number of errors, and the sum of every numeric attribute. The slowest in total first.
+    """
+    summary = {}
+    for finished_span in get_spans():
+        row = summary.setdefault(finished_span["name"], {"name": finished_span["name"], "calls": 0, "total_ms": 0.0,
+                                                         "max_ms": 0.0, "errors": 0, "totals": {}})
+        row["calls"] += 1
+        row["total_ms"] += finished_span["duration_ms"]
+        row["max_ms"] = max(row["max_ms"], finished_span["duration_ms"])
+        row["errors"] += finished_span["error"] is not None
+        for attribute, value in finished_span["attributes"].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                row["totals"][attribute] = row["totals"].get(attribute, 0) + value
+    rows = sorted(summary.values(), key=lambda row: row["total_ms"], reverse=True)
+    for row in rows:
+        row["mean_ms"] = row["total_ms"] / row["calls"]
+    return rows
+
+
+def format_summary():
+    """
+    :return: get_summary() as a table, one line per span name
+    """
+    lines = [f"{'span':<55} {'calls':>6} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'errors':>6}  totals"]
+    for row in get_summary():
+        totals = ", ".join(f"{attribute}={value:g}" for attribute, value in sorted(row["totals"].items()))
+        lines.append(f"{row['name']:<55} {row['calls']:>6} {row['total_ms']:>10.1f} {row['mean_ms']:>9.2f} "
+                     f"{row['max_ms']:>9.2f} {row['errors']:>6}  {totals}")
+    return "\n".join(lines)
+
+
+def _write_trace_at_exit():
+    if _output_path is not None and get_spans():
+        write_trace(_output_path)
+
+
+_environment_value = os.environ.get(trace_environment_variable, "")
+if _environment_value and _environment_value != "0":
+    enable(output_path=None if _environment_value == "1" else _environment_value)
+atexit.register(_write_trace_at_exit)
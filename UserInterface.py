@@ -1,46 +1,117 @@
-from RecitePlanner import EbbinghausPlanner
+from RecitePlanner import EbbinghausPlanner, SM2Planner
+import os
 import dbAPI
-from ReciteMaterialGenerator import ReciteMaterialGenerator
+from GenerationJob import format_report
+import Prefetcher
+import VocabSearch
+import VocabStore
+import Tracing
+import StudyMaterialExporter
+from StudyMaterialExporter import QuizletWriter, JsonlWriter, AnkiPackageWriter
+from RangeSet import RangeSet
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 
 NUM_NEW_WORD_PER_DAY = 20
+NUM_CONCURRENT_REQUESTS = 5
+NUM_REQUESTS_PER_MINUTE = 500  # the limit of the OpenAI account, lower it for a free tier key
+NUM_MAX_REVIEW_WORDS_PER_DAY = 100
+EXPORT_NAME = "all_study_material"  # the incremental export of menu option 6
+OUTPUT_DIRECTORY = "GeneratedStudyMaterial"
 
 
-def generate_today_material(num_new_words_to_learn, API_KEY):
+def get_output_directory():
+    """
+    :return: the folder of the generated files of the current user (see dbAPI.as_user()), the files of the default user
+            stay directly in OUTPUT_DIRECTORY
+    """
+    user_id = dbAPI.get_user_id()
+    if user_id == dbAPI.default_user_id:
+        return OUTPUT_DIRECTORY
+    output_directory = os.path.join(OUTPUT_DIRECTORY, f"user_{user_id}")
+    os.makedirs(output_directory, exist_ok=True)
+    return output_directory
+
+
+def generate_today_material(num_new_words_to_learn, API_KEY, base_url=None):
+    """
+    :param base_url: the chat completions server, None for OpenAI's (see ReciteMaterialGenerator)
+    If it is interrupted, running it again continues where it stopped: the same words are chosen (the progress is only
+    recorded at the end), and the generation job of these words only asks for the ones that are not done yet.
+    """
     # decide what to study today
-    # begin_rank, end_rank = 90, 100
-    begin_rank, end_rank = dbAPI.get_next_new_material(num_new_words_to_learn)
-    new_materials_df = dbAPI.get_vocabs(begin_rank, end_rank)
-
-    # generate context sentences: notice that it's seperated by ";"
-    recite_material_generator = ReciteMaterialGenerator()
-    context_sentence = recite_material_generator.get_context_sentence_from_ChatGPT(new_materials_df, API_KEY)
-    new_materials_df['ExampleSentence'] = [d['ExampleSentence'] for d in context_sentence]
-    new_materials_df['SentenceTranslation'] = [d['SentenceTranslation'] for d in context_sentence]
-    new_materials_df[["ExampleSentence", 'SentenceTranslation']].to_csv(
-        f"GeneratedStudyMaterial/CS_{datetime.now().strftime("%Y-%m-%d")}.csv",
-        index=False, sep=";")
-    # todo: for now I will use this with quizlet, so just need to output to csv and upload to quizlet.
+    # new_ranks = RangeSet([(90, 100)]), usually one range, several if some ranks were skipped before
+    new_ranks = dbAPI.get_next_new_material(num_new_words_to_learn)
+    # the words from the compiled copy of hebrew_list, a VocabSlice that is used like the df of dbAPI.get_vocabs
+    new_materials_df = VocabStore.get_vocab_store().get_vocabs_of_ranks(new_ranks)
 
-    # output the hebrew+pronounce - english: notice that it's seperated by ";"
-    hebrew_pronounce_tuples = list(zip(new_materials_df["Hebrew"], new_materials_df["Transliteration"]))
-    hebrew_pronounce_strings = []
-    for hebrew_pronounce_tuple in hebrew_pronounce_tuples:
-        hebrew_pronounce_string = hebrew_pronounce_tuple[0] + " (" + hebrew_pronounce_tuple[1] + ")"
-        hebrew_pronounce_strings.append(hebrew_pronounce_string)
-    new_materials_df['Hebrew+Pronounce'] = hebrew_pronounce_strings
-    new_materials_df[['Hebrew+Pronounce', "English"]].to_csv(
-        f"GeneratedStudyMaterial/HL_{datetime.now().strftime("%Y-%m-%d")}.csv",
-        index=False, sep=";")
+    # generate context sentences (from the corpus, then ChatGPT), each one is saved as soon as it arrives. The words
+    # that were prefetched are already in the cache, then no request is sent
+    sentences, report = Prefetcher.generate_context_sentences(
+        new_materials_df, f"daily_{new_ranks.begin}_{new_ranks.end}", API_KEY, base_url=base_url,
+        requests_per_minute=NUM_REQUESTS_PER_MINUTE, max_concurrency=NUM_CONCURRENT_REQUESTS)
+    if report["job"] is not None:
+        print(format_report(report["job"]))
+    if report["from_corpus"]:
+        print(f"{report['from_corpus']} context sentences from the corpus, {report['from_ChatGPT']} from ChatGPT")
+    for hebrew_word, sentence in zip(new_materials_df["Hebrew"], sentences):
+        if "Error" in sentence:
+            print(f"Failed to generate a context sentence for {hebrew_word}: {sentence['Error']}")
     # update study progress
     datetime_now_str = dbAPI.format_date_string(datetime.now())
-    dbAPI.update_study_progress(date_str=datetime_now_str, new_material=[begin_rank, end_rank])
-    print(f"Your study material is being saved under GeneratedStudyMaterial/ folder, files names are today's date: {datetime.now().strftime("%Y-%m-%d")}")
+    with dbAPI.transaction():
+        dbAPI.update_study_progress(date_str=datetime_now_str, new_material=new_ranks)
+        # the new words are also scheduled one by one, for the per-word review
+        word_planner = SM2Planner.load_or_rebuild()
+        word_planner.introduce(list(new_ranks))
+        word_planner.save()
+    # todo: for now I will use this with quizlet, so just need to output to csv and upload to quizlet.
+    # the sentences are in the cache now, export today's words: notice that it's seperated by ";"
+    output_directory = get_output_directory()
+    with QuizletWriter(f"{output_directory}/CS_{datetime_now_str}.csv",
+                       fields=("ExampleSentence", "SentenceTranslation")) as sentence_writer, \
+            QuizletWriter(f"{output_directory}/HL_{datetime_now_str}.csv") as hebrew_list_writer:
+        StudyMaterialExporter.export_study_material([sentence_writer, hebrew_list_writer],
+                                                    begin_date_str=datetime_now_str, end_date_str=datetime_now_str)
+    print(f"Your study material is being saved under {output_directory}/ folder, files names are today's date: "
+          f"{datetime_now_str}")
+
+
+def export_all_study_material():
+    """
+    Export the words of all the dates (with their context sentences) for Quizlet, as jsonl, and for Anki if genanki
+    is installed. Only the words that changed since the last time are exported.
+    """
+    path = f"{get_output_directory()}/EX_{dbAPI.format_date_string(datetime.now())}"
+    with ExitStack() as stack:
+        writers = [stack.enter_context(QuizletWriter(
+                       f"{path}.csv",
+                       fields=("Hebrew+Pronounce", "English", "ExampleSentence", "SentenceTranslation"))),
+                   stack.enter_context(JsonlWriter(f"{path}.jsonl"))]
+        try:
+            writers.append(stack.enter_context(AnkiPackageWriter(f"{path}.apkg")))
+        except ImportError:
+            print("genanki is not installed, skipping the Anki package.")
+        num_cards = StudyMaterialExporter.export_study_material(writers, incremental_name=EXPORT_NAME)
+    print(f"Exported {num_cards} new or changed words to {path}.*")
+
+
+def prefetch_upcoming_material(API_KEY):
+    """
+    Generate the context sentences of the next days' words now, so that option 1 doesn't wait on those days.
+    """
+    report = Prefetcher.prefetch_upcoming_material(Prefetcher.prefetch_days, NUM_NEW_WORD_PER_DAY, API_KEY,
+                                                   requests_per_minute=NUM_REQUESTS_PER_MINUTE,
+                                                   max_concurrency=NUM_CONCURRENT_REQUESTS)
+    print(Prefetcher.format_prefetch_report(report))
 
 
 def print_study_progress_table():
     print("Here are the current study progress")
     study_progress_table = dbAPI.get_study_progress_df()
+    # the ranges as "1-40, 50-60"
+    study_progress_table[dbAPI.new_material_col_name] = study_progress_table[dbAPI.new_material_col_name].map(
+        lambda ranges: str(RangeSet(ranges)))
     print(study_progress_table)
 
 def print_date_need_to_recite():
@@ -49,28 +120,99 @@ def print_date_need_to_recite():
     should_recite_dates = recite_planner.get_recite_datetime()
     for date_str in should_recite_dates:
         print(date_str)
+    recite_material_df = recite_planner.get_recite_material()
+    print(f"These dates have {len(recite_material_df)} words to recite:")
+    print(recite_material_df[["Rank", "Hebrew", "Transliteration", "English"]])
+    if len(recite_material_df) and input("Export them with their context sentences? (y/n):") == "y":
+        export_path = f"{get_output_directory()}/RV_{dbAPI.format_date_string(datetime.now())}.csv"
+        recite_planner.export_recite_material(recite_material_df, export_path)
+        print(f"Your recite material is saved in {export_path}")
+
+def print_words_need_to_review():
+    word_planner = SM2Planner.load_or_rebuild()
+    due_ranks = word_planner.get_due_ranks(limit=NUM_MAX_REVIEW_WORDS_PER_DAY)
+    print(f"Here are the {len(due_ranks)} words you need to review today.")
+    print(dbAPI.get_vocabs_of_ranks(due_ranks))
+    print(f"Number of words to review in the next 7 days: {word_planner.get_workload(7).tolist()}")
+    if not len(due_ranks):
+        return
+    grade = input("How well did you remember them? 0-5 (5 perfect, 3 with difficulty, 0-2 forgot), "
+                  "or press Enter to skip:")
+    if grade in ["0", "1", "2", "3", "4", "5"]:
+        # only appended to the review log, see SM2Planner
+        word_planner.review(due_ranks, [int(grade)] * len(due_ranks))
+        word_planner.save()
+        print(f"Recorded the review of {len(due_ranks)} words.")
+
+
+def print_search_results():
+    query = input("Search for (Hebrew, transliteration or English):")
+    results = VocabSearch.search_vocabs(query)
+    if results.empty:
+        print("Nothing found.")
+    else:
+        print(results)
+
+
+def print_trace_summary():
+    """
+    Where the time of this session went. Tracing is off unless LEARNHEBREW_TRACE is set, so the first time this is
+    chosen it only starts recording.
+    """
+    if not Tracing.is_enabled():
+        Tracing.enable()
+        print("Started recording the timings of database and ChatGPT calls, choose this again to see them.")
+        return
+    print(Tracing.format_summary())
+    if input("Also save them as a trace file (open it in https://ui.perfetto.dev)? (y/n):") == "y":
+        trace_path = f"trace_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json"
+        Tracing.write_trace(trace_path)
+        print(f"The trace is saved in {trace_path}")
+
 
 def main():
     print("Please select your action:")
     print(f"1. generate study material for today: {NUM_NEW_WORD_PER_DAY} new words with context sentences")
     print("2. get previous dates that I need to review materials on")
     print("3. view my study progress")
+    print("4. get the words that I need to review today (each word on its own schedule)")
+    print("5. search the vocabulary")
+    print("6. export the words I studied (only the ones that changed since the last export)")
+    print("7. show where the time went in this session (database and ChatGPT calls)")
+    print(f"8. prepare the context sentences of the next {Prefetcher.prefetch_days} days ahead of time")
     print("9. Exit program")
     while True:
-        user_input = input("Your choice (number 1, 2, 3, or 9):")
+        user_input = input("Your choice (number 1, 2, 3, 4, 5, 6, 7, 8, or 9):")
         if user_input == '9':
+            if Tracing.is_enabled():
+                print(Tracing.format_summary())
             print("Goodbye!")
             break
         elif user_input == '1':
             print("Running.....")
-            API_KEY = input("Please provide your OPENAI API Key:")
+            API_KEY = None
+            # no need for the key when today's words were prefetched
+            today_ranks = dbAPI.get_next_new_material(NUM_NEW_WORD_PER_DAY)
+            if Prefetcher.get_missing_words(VocabStore.get_vocab_store().get_vocabs_of_ranks(today_ranks)):
+                API_KEY = input("Please provide your OPENAI API Key:")
             generate_today_material(NUM_NEW_WORD_PER_DAY, API_KEY)
         elif user_input == '2':
             print_date_need_to_recite()
         elif user_input == '3':
             print_study_progress_table()
+        elif user_input == '4':
+            print_words_need_to_review()
+        elif user_input == '5':
+            print_search_results()
+        elif user_input == '6':
+            export_all_study_material()
+        elif user_input == '7':
+            print_trace_summary()
+        elif user_input == '8':
+            API_KEY = input("Please provide your OPENAI API Key:")
+            prefetch_upcoming_material(API_KEY)
         else:
-            print("Invalid input, please input number 1, 2, 3, or 9.")
+            print("Invalid input, please input number 1, 2, 3, 4, 5, 6, 7, 8, or 9.")
 
 
     # todo: mark, unmark
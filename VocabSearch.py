@@ -0,0 +1,204 @@
+"""
+This file contains a search over the Hebrew frequency list, by Hebrew (with or without niqqud, with or without final
+letters), by transliteration, or by English.
+It uses two sqlite FTS5 indexes over a normalized copy of hebrew_list (see HebrewText):
+- hebrew_search: words are tokens, for (prefix) word queries, e.g. "שלו" finds שלום, "bel" finds "belongs to"
+- hebrew_search_trigram: trigrams, for fuzzy queries: the words sharing the most trigrams with the query are the
+  candidates, and they are ranked by edit distance, e.g. "shalon" finds "shalom"
+The indexes are built the first time they are needed, and rebuilt when hebrew_list changed: like VocabStore, they
+keep the checksum of hebrew_list they were built from.
+"""
+import zlib
+import pandas as pd
+import dbAPI
+import HebrewText
+import VocabStore
+
+search_entry_table = "hebrew_search_entry"  # the normalized copy of hebrew_list, the content of both indexes
+search_table = "hebrew_search"
+trigram_search_table = "hebrew_search_trigram"
+search_checksum_table = "hebrew_search_checksum"  # one row: the checksum of hebrew_list when the indexes were built
+num_fuzzy_candidates = 200  # how many candidates (by shared trigrams) are ranked by edit distance
+
+
+def build_search_index():
+    """
+    (Re)build the indexes from hebrew_list. Takes well under a second for the 10000 words list.
+    """
+    with dbAPI.shared_transaction() as conn:
+        cursor = conn.cursor()
+        for table in [search_table, trigram_search_table, search_entry_table, search_checksum_table]:
+            cursor.execute(f"DROP TABLE IF EXISTS {table};")
+        # ID is the rowid of the word in hebrew_list
+        cursor.execute(f"""
+            CREATE TABLE {search_entry_table}(
+                ID INTEGER PRIMARY KEY,
+                RANK INTEGER NOT NULL,
+                HEBREW_NORM TEXT NOT NULL,
+                TRANSLITERATION_NORM TEXT NOT NULL,
+                ENGLISH_NORM TEXT NOT NULL
+            )
+        """)
+        # both are external content tables: they only store the index, the text is in search_entry_table
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE {search_table} USING fts5(
+                HEBREW_NORM, TRANSLITERATION_NORM, ENGLISH_NORM,
+                content='{search_entry_table}', content_rowid='ID', prefix='1 2 3', tokenize='unicode61'
+            )
+        """)
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE {trigram_search_table} USING fts5(
+                HEBREW_NORM, TRANSLITERATION_NORM, ENGLISH_NORM,
+                content='{search_entry_table}', content_rowid='ID', tokenize='trigram'
+            )
+        """)
+        rows = cursor.execute(f"SELECT rowid, Rank, Hebrew, Transliteration, English "
+                              f"FROM {dbAPI.hebrew_list_table};").fetchall()
+        cursor.executemany(f"INSERT INTO {search_entry_table} VALUES (?, ?, ?, ?, ?);",
+                           [(row_id, rank, HebrewText.normalize_hebrew(hebrew),
+                             HebrewText.normalize_transliteration(transliteration),
+                             HebrewText.normalize_english(english))
+                            for row_id, rank, hebrew, transliteration, english in rows])
+        cursor.execute(f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild');")
+        cursor.execute(f"INSERT INTO {trigram_search_table}({trigram_search_table}) VALUES ('rebuild');")
+        cursor.execute(f"CREATE TABLE {search_checksum_table}(CHECKSUM INTEGER NOT NULL);")
+        cursor.execute(f"INSERT INTO {search_checksum_table} VALUES (?);", (sum(_row_checksum(*row) for row in rows),))
+
+
+def search_vocabs(query, limit=20, fuzzy=True):
+    """
+    Search the words: first the ones that match the query (the last word of the query can be a prefix), then, if
+    there are less than limit of them and fuzzy is True, the ones that are spelled similarly.
+    A query with Hebrew letters searches the Hebrew words, else the transliterations and the English translations.
+    :return: a pandas df with columns ['Rank', 'English', 'Transliteration', 'Hebrew', 'Distance'], the best matches
+            first. Distance is 0 for exact or prefix matches, and the edit distance for fuzzy ones.
+    """
+    results = prefix_search(query, limit)
+    if fuzzy and len(results) < limit:
+        fuzzy_results = fuzzy_search(query, limit)
+        fuzzy_results = fuzzy_results[~fuzzy_results["ID"].isin(results["ID"])]
+        results = pd.concat([results, fuzzy_results], ignore_index=True).head(limit)
+    return results.drop(columns="ID")
+
+
+def prefix_search(query, limit=20):
+    """
+    :return: the words that have all the words of the query, the last one can be a prefix. Exact matches first, then
+            by bm25, then by rank. Same columns as search_vocabs, plus ID (the rowid in hebrew_list).
+    """
+    _ensure_search_index()
+    normalized_query = HebrewText.normalize_query(query)
+    tokens = normalized_query.split()
+    if not tokens:
+        return _to_df([])
+    match_expression = " ".join(_quote(token) for token in tokens) + "*"
+    columns = "{HEBREW_NORM}" if HebrewText.is_hebrew(query) else "{TRANSLITERATION_NORM ENGLISH_NORM}"
+    sql_query = f"""SELECT h.rowid, h.Rank, h.English, h.Transliteration, h.Hebrew, 0
+                    FROM {search_table} AS s
+                    JOIN {search_entry_table} AS e ON e.ID = s.rowid
+                    JOIN {dbAPI.hebrew_list_table} AS h ON h.rowid = s.rowid
+                    WHERE {search_table} MATCH :match
+                    ORDER BY (e.HEBREW_NORM = :query OR e.TRANSLITERATION_NORM = :query
+                              OR e.ENGLISH_NORM = :query) DESC,
+                             bm25({search_table}), e.RANK
+                    LIMIT :limit;"""
+    parameters = {"match": f"{columns} : ({match_expression})", "query": normalized_query, "limit": limit}
+    rows = dbAPI._connect_shared().cursor().execute(sql_query, parameters).fetchall()
+    return _to_df(rows)
+
+
+def fuzzy_search(query, limit=20, max_distance=None):
+    """
+    :param max_distance: the largest edit distance that still counts as a match, by default a third of the length of
+            the query (at least 1)
+    :return: the words that are spelled similarly to the query, the closest first, then by rank. Same columns as
+            prefix_search.
+    """
+    _ensure_search_index()
+    normalized_query = HebrewText.normalize_query(query)
+    if len(normalized_query) < 3:
+        # shorter than a trigram, there is nothing to look up
+        return _to_df([])
+    if max_distance is None:
+        max_distance = max(1, len(normalized_query) // 3)
+    trigrams = {normalized_query[i:i + 3] for i in range(len(normalized_query) - 2)}
+    match_expression = " OR ".join(_quote(trigram) for trigram in sorted(trigrams))
+    columns = ["HEBREW_NORM"] if HebrewText.is_hebrew(query) else ["TRANSLITERATION_NORM", "ENGLISH_NORM"]
+    sql_query = f"""SELECT h.rowid, h.Rank, h.English, h.Transliteration, h.Hebrew,
+                           {", ".join("e." + column for column in columns)}
+                    FROM {trigram_search_table} AS s
+                    JOIN {search_entry_table} AS e ON e.ID = s.rowid
+                    JOIN {dbAPI.hebrew_list_table} AS h ON h.rowid = s.rowid
+                    WHERE {trigram_search_table} MATCH ?
+                    ORDER BY bm25({trigram_search_table})
+                    LIMIT ?;"""
+    match = "{" + " ".join(columns) + "} : (" + match_expression + ")"
+    candidates = dbAPI._connect_shared().cursor().execute(sql_query, (match, num_fuzzy_candidates)).fetchall()
+    rows = []
+    for candidate in candidates:
+        # compare with each word (and the whole text) of the normalized columns, keep the closest
+        words = set()
+        for text in candidate[5:]:
+            words.add(text)
+            words.update(text.split())
+        distance = min(_edit_distance(normalized_query, word, max_distance) for word in words)
+        if distance <= max_distance:
+            rows.append(candidate[:5] + (distance,))
+    rows.sort(key=lambda row: (row[5], row[1]))
+    return _to_df(rows[:limit])
+
+
+def _ensure_search_index():
+    """
+    Build the index if it doesn't exist, or if hebrew_list has changed since it was built (also a row changed in
+    place, e.g. by the upsert of HebrewListIngest, which keeps the number of rows).
+    """
+    conn = dbAPI._connect_shared()
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;"
+    if conn.execute(query, (search_checksum_table,)).fetchone():
+        conn.create_function("search_row_checksum", 5, _row_checksum, deterministic=True)
+        # TOTAL is exact here, as in VocabStore: the sum of 32 bit checksums of a few thousand rows is far below 2^53
+        query = (f"SELECT TOTAL(search_row_checksum(rowid, Rank, Hebrew, Transliteration, English)) "
+                 f"FROM {dbAPI.hebrew_list_table};")
+        table_checksum = int(conn.execute(query).fetchone()[0])
+        if conn.execute(f"SELECT CHECKSUM FROM {search_checksum_table};").fetchone() == (table_checksum,):
+            return
+    build_search_index()
+
+
+def _row_checksum(row_id, rank, hebrew, transliteration, english):
+    """
+    The checksum of a row of hebrew_list, with its rowid (the ID of its search entry). See VocabStore._row_checksum().
+    """
+    return zlib.crc32(str(row_id).encode("utf-8"), VocabStore._row_checksum(rank, english, transliteration, hebrew))
+
+
+def _quote(token):
+    """
+    Make a token a FTS5 string, so that characters like - or " are not read as operators.
+    """
+    return '"' + token.replace('"', '""') + '"'
+
+
+def _to_df(rows):
+    return pd.DataFrame([row[:6] for row in rows],
+                        columns=["ID", "Rank", "English", "Transliteration", "Hebrew", "Distance"])
+
+
+def _edit_distance(a, b, max_distance):
+    """
+    Levenshtein distance, it stops early and returns max_distance + 1 once the distance is surely larger than
+    max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current_row = [i]
+        for j, char_b in enumerate(b, start=1):
+            current_row.append(min(previous_row[j] + 1, current_row[j - 1] + 1,
+                                   previous_row[j - 1] + (char_a != char_b)))
+        if min(current_row) > max_distance:
+            return max_distance + 1
+        previous_row = current_row
+    return previous_row[-1]
@@ -0,0 +1,267 @@
+"""
+This file is a read-only copy of the table hebrew_list, compiled into one file that is read with mmap, for the reads
+that happen all the time (today's words, the words of a prefetch, the due words): no SQLite query and no pandas df.
+The frequency list doesn't change after it is ingested, so the file is built once, and built again only when the
+content of hebrew_list changes (e.g. after HebrewListIngest added or changed rows): the file keeps a checksum of the
+table, which is compared with the table's when the file is opened.
+The file has one column of ranks (uint32, sorted) and, for each text column, the offsets (uint64) of its values in
+one UTF-8 buffer. Several processes that open it share the same pages of the operating system's file cache.
+A lookup returns a VocabSlice, which only holds the rows it covers (a range for a range of ranks, so nothing is
+copied), and the strings are decoded when they are read. It can be used where a df of get_vocabs is expected:
+slice["Hebrew"], len(slice), slice.iloc[positions], slice["Hebrew"].iloc[i], and to_df() for a real pandas df.
+Usage:
+    vocab_store = VocabStore.get_vocab_store()
+    new_materials = vocab_store.get_vocabs(begin_rank, end_rank)
+    for hebrew, english in zip(new_materials["Hebrew"], new_materials["English"]): ...
+"""
+import bisect
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+vocab_store_path = "hebrew_list.vocab"
+vocab_columns = ["Rank", "English", "Transliteration", "Hebrew"]  # in the order of the table hebrew_list
+_text_columns = vocab_columns[1:]
+# magic, version, byte order, number of rows, the checksum of hebrew_list when it was built (see _row_checksum()), then
+# the offset of each section: ranks, and the offsets and the text of each text column
+_header_format = "<4sIBxxxIQ7Q"
+_magic = b"LHVS"
+_version = 2
+_open_stores = {}  # (path, db_path) -> VocabStore, see get_vocab_store()
+
+
+def build_vocab_store(path=vocab_store_path, db_path=None):
+    """
+    Compile the table hebrew_list into path.
+    :param db_path: the database, by default the one of dbAPI
+    :return: the number of rows
+    """
+    # only needed when building, so imported here
+    import dbConnection
+    import dbAPI
+    # the order of the index hebrew_list_word, which is the order of dbAPI.get_vocabs
+    query = f"""SELECT {", ".join(vocab_columns)} FROM {dbAPI.hebrew_list_table}
+                ORDER BY Rank, Hebrew, Transliteration, English;"""
+    rows = dbConnection.get_connection(db_path or dbAPI.my_database).execute(query).fetchall()
+    checksum = sum(_row_checksum(*row) for row in rows)
+    sections = [struct.pack(f"={len(rows)}I", *[row[0] for row in rows])]
+    for column_index in range(1, len(vocab_columns)):
+        offsets = [0]
+        text = bytearray()
+        for row in rows:
+            text += (row[column_index] or "").encode("utf-8")
+            offsets.append(len(text))
+        sections.append(struct.pack(f"={len(offsets)}Q", *offsets))
+        sections.append(bytes(text))
+    # every section starts at a multiple of 8 bytes, so the arrays are aligned
+    section_offsets = []
+    position = _align(struct.calcsize(_header_format))
+    for section in sections:
+        section_offsets.append(position)
+        position = _align(position + len(section))
+    header = struct.pack(_header_format, _magic, _version, sys.byteorder == "little", len(rows), checksum,
+                         *section_offsets)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(header)
+        for section_offset, section in zip(section_offsets, sections):
+            file.write(b"\0" * (section_offset - file.tell()))
+            file.write(section)
+    # the processes that have the old file open keep reading it, the new ones open the new file
+    os.replace(temporary_path, path)
+    return len(rows)
+
+
+def get_vocab_store(path=vocab_store_path, db_path=None):
+    """
+    :return: the VocabStore of path, opened once per process (per database). It is built if it doesn't exist, if it
+            is of an older version, or if the checksum of hebrew_list is not the one it was built from (one query over
+            the table, when it is opened).
+    """
+    vocab_store = _open_stores.get((path, db_path))
+    if vocab_store is not None:
+        return vocab_store
+    import dbConnection
+    import dbAPI
+    conn = dbConnection.get_connection(db_path or dbAPI.my_database)
+    conn.create_function("vocab_row_checksum", 4, _row_checksum, deterministic=True)
+    # TOTAL is exact here: the sum of 32 bit checksums of a few thousand rows is far below 2^53
+    table_checksum = int(conn.execute(f"""SELECT TOTAL(vocab_row_checksum({", ".join(vocab_columns)}))
+                                          FROM {dbAPI.hebrew_list_table};""").fetchone()[0])
+    if os.path.exists(path):
+        try:
+            vocab_store = VocabStore(path)
+        except ValueError:  # another version, it is built again
+            vocab_store = None
+        if vocab_store is not None and vocab_store.table_checksum != table_checksum:
+            vocab_store.close()
+            vocab_store = None
+    if vocab_store is None:
+        build_vocab_store(path, db_path)
+        vocab_store = VocabStore(path)
+    _open_stores[(path, db_path)] = vocab_store
+    return vocab_store
+
+
+def _row_checksum(rank, english, transliteration, hebrew):
+    """
+    The checksum of a row of hebrew_list. The checksum of the table is their sum, so it doesn't depend on the order of
+    the rows, and any changed value changes it (unless two changes cancel out, which a re-ingest won't do).
+    """
+    return zlib.crc32("\x1f".join([str(rank), english or "", transliteration or "", hebrew or ""]).encode("utf-8"))
+
+
+class VocabStore:
+    """
+    A read-only view of a file made by build_vocab_store().
+    """
+
+    def __init__(self, path=vocab_store_path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.unpack_from(_header_format, self._mmap, 0)
+        magic, version, is_little_endian, self.num_rows, self.table_checksum = header[:5]
+        if magic != _magic or version != _version:
+            raise ValueError(f"{path} is not a vocabulary store of this version, build it again")
+        if bool(is_little_endian) != (sys.byteorder == "little"):
+            raise ValueError(f"{path} was built on a machine with another byte order, build it again")
+        section_offsets = header[5:]
+        view = memoryview(self._mmap)
+        self.ranks = view[section_offsets[0]:section_offsets[0] + 4 * self.num_rows].cast("I")
+        self._text_offsets = {}
+        self._texts = {}
+        for i, column in enumerate(_text_columns):
+            offsets_at, text_at = section_offsets[1 + 2 * i], section_offsets[2 + 2 * i]
+            self._text_offsets[column] = view[offsets_at:offsets_at + 8 * (self.num_rows + 1)].cast("Q")
+            self._texts[column] = view[text_at:text_at + self._text_offsets[column][self.num_rows]]
+
+    def get_vocabs(self, begin_rank, end_rank):
+        """
+        Begin and end rank are inclusive, like dbAPI.get_vocabs.
+        :return: a VocabSlice of the rows, ordered by rank
+        """
+        begin_row = bisect.bisect_left(self.ranks, begin_rank)
+        end_row = bisect.bisect_right(self.ranks, end_rank, lo=begin_row)
+        return VocabSlice(self, range(begin_row, end_row))
+
+    def get_vocabs_of_ranks(self, ranks):
+        """
+        Same as get_vocabs, but for any set of ranks, like dbAPI.get_vocabs_of_ranks.
+        :return: a VocabSlice of the rows, ordered by rank
+        """
+        rows = []
+        for rank in sorted(set(int(rank) for rank in ranks)):
+            begin_row = bisect.bisect_left(self.ranks, rank)
+            end_row = bisect.bisect_right(self.ranks, rank, lo=begin_row)
+            rows.extend(range(begin_row, end_row))
+        return VocabSlice(self, rows)
+
+    def get_value(self, column, row):
+        """
+        :return: the value of column in row (a row of the file, not a rank)
+        """
+        if column == "Rank":
+            return self.ranks[row]
+        offsets = self._text_offsets[column]
+        return str(self._texts[column][offsets[row]:offsets[row + 1]], "utf-8")
+
+    def close(self):
+        # the memoryviews must be released before the mmap can be closed
+        for view in [self.ranks, *self._text_offsets.values(), *self._texts.values()]:
+            view.release()
+        self._mmap.close()
+        self._file.close()
+        for key in [key for key, vocab_store in _open_stores.items() if vocab_store is self]:
+            del _open_stores[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_rows
+
+
+class VocabSlice:
+    """
+    Some rows of a VocabStore, with the parts of a pandas df that the generators use.
+    """
+
+    def __init__(self, vocab_store, rows):
+        """
+        :param rows: the rows of the store (a range or a list), in the order of this slice
+        """
+        self.vocab_store = vocab_store
+        self.rows = rows
+        self.columns = vocab_columns
+        self.iloc = _SliceIndexer(self)
+
+    def __getitem__(self, column):
+        if column not in vocab_columns:
+            raise KeyError(column)
+        return VocabColumn(self.vocab_store, column, self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def empty(self):
+        return len(self.rows) == 0
+
+    def to_df(self):
+        """
+        :return: the rows as a pandas df, with the columns of dbAPI.get_vocabs
+        """
+        # only needed to print or export, so imported here
+        import pandas as pd
+        return pd.DataFrame({column: self[column].tolist() for column in vocab_columns}, columns=vocab_columns)
+
+
+class VocabColumn:
+    """
+    One column of a VocabSlice, like a pandas Series: iterate it, len(), column[i] or column.iloc[i], tolist().
+    """
+
+    def __init__(self, vocab_store, column, rows):
+        self.vocab_store = vocab_store
+        self.name = column
+        self.rows = rows
+        self.iloc = self
+
+    def __getitem__(self, position):
+        return self.vocab_store.get_value(self.name, self.rows[position])
+
+    def __iter__(self):
+        get_value = self.vocab_store.get_value
+        for row in self.rows:
+            yield get_value(self.name, row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def tolist(self):
+        return list(self)
+
+
+class _SliceIndexer:
+    """
+    VocabSlice.iloc: a list of positions or a slice gives a VocabSlice of these rows.
+    """
+
+    def __init__(self, vocab_slice):
+        self.vocab_slice = vocab_slice
+
+    def __getitem__(self, positions):
+        rows = self.vocab_slice.rows
+        if isinstance(positions, slice):
+            return VocabSlice(self.vocab_slice.vocab_store, rows[positions])
+        return VocabSlice(self.vocab_slice.vocab_store, [rows[position] for position in positions])
+
+
+def _align(position):
+    return (position + 7) // 8 * 8
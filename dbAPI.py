@@ -1,20 +1,74 @@
-import requests
-from bs4 import BeautifulSoup
 import pandas as pd
-import sqlite3
+import numpy as np
 import pickle
+import json
+import itertools
+import os
+import time
+import contextvars
+import dbConnection
+import Tracing
+from RangeSet import RangeSet, StudiedRanks
+from SentenceCache import create_sentence_cache_table, sentence_cache_table
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 """
 This interaction will be exclusive to learning hebrew frequency list.
+Several users (e.g. a whole class) can share one database: the tables of the study progress, the schedule and the
+review log have a USER_ID, and the functions of this file work on the rows of the current user, see as_user(). The word
+list and the sentence cache are shared by everyone.
 """
 my_database = "my_database.db"
 hebrew_list_table = 'hebrew_list'
-study_progress_table = 'study_progress'
+hebrew_list_url = 'https://www.teachmehebrew.com/hebrew-frequency-list.html'
+study_progress_table = 'study_progress'  # one row per date that has new material or recitations
+study_range_table = 'study_range'  # one row per range of ranks that was studied as new material on a date
+recitation_table = 'recitation'  # one row per (material date, date on which the material was recited)
 date_string_col_name = "DATE_STR"
+begin_rank_col_name = "BEGIN_RANK"  # the new material of a date is the ranks [BEGIN_RANK, END_RANK] of its ranges
+end_rank_col_name = "END_RANK"
+updated_at_col_name = "UPDATED_AT"  # when the row was last changed, "%Y-%m-%d %H:%M:%S" in UTC
+material_date_col_name = "MATERIAL_DATE_STR"  # the date on which the recited material was new material
+recited_on_date_col_name = "RECITED_ON_DATE_STR"  # the date on which the material was recited
+# These are the columns that the dataframe of get_study_progress_df() has, they used to be the (pickled) columns of
+# study_progress, before it was normalized.
 new_material_col_name = "NEW_MATERIAL"  # this column records what new materials are studied today
 recited_material_col_name = "RECITED_MATERIALS"  # this column records which materials are recited today
 being_recited_on_date_col_name = "BEING_RECITED"  # this column records on which dates was new_material_today recited
+legacy_study_progress_table = 'study_progress_pickled'  # the old table is kept under this name after the migration
+word_schedule_table = 'word_schedule'  # one row per rank: the spaced repetition state of the word, see SM2Planner
+rank_col_name = "RANK"
+ease_col_name = "EASE"
+interval_days_col_name = "INTERVAL_DAYS"
+repetitions_col_name = "REPETITIONS"  # number of successful reviews in a row
+lapses_col_name = "LAPSES"  # number of times the word was forgotten
+due_date_col_name = "DUE_DATE"
+last_reviewed_date_col_name = "LAST_REVIEWED_DATE"
+review_event_table = 'review_event'  # append-only: one row per word introduced or reviewed, see SM2Planner
+event_id_col_name = "EVENT_ID"
+event_type_col_name = "EVENT_TYPE"  # INTRODUCE or REVIEW
+grade_col_name = "GRADE"  # 0-5, NULL for INTRODUCE
+event_date_col_name = "EVENT_DATE"  # the day the planner used for the event
+created_at_col_name = "CREATED_AT"  # when the event was recorded, unix time
+INTRODUCE = "introduce"
+REVIEW = "review"
+# one row: the last review_event that is folded into word_schedule, the events after it are the "tail" of the log
+word_schedule_snapshot_table = 'word_schedule_snapshot'
+last_event_id_col_name = "LAST_EVENT_ID"
+export_state_table = 'export_state'  # one row per incremental export of a user, see StudyMaterialExporter
+user_table = 'app_user'  # in my_database: one row per user, see add_user()
+user_id_col_name = "USER_ID"  # every table of a user's progress has it, first in its primary key and its indexes
+user_name_col_name = "USER_NAME"
+default_user_id = 1  # the user of the single-user program, the rows from before there were users are theirs
+default_user_name = "default"
+# 0: the tables of the users are in my_database. n > 0: they are in n files next to it (the user user_id is in the file
+# user_id % n, see get_user_database()), so that users in different files don't wait for each other's writes. The
+# shared tables stay in my_database, which is attached read-only to the connections of these files.
+num_user_shards = 0
+_current_user_id = contextvars.ContextVar("current_user_id", default=default_user_id)
+schema_version = 7  # stored in "PRAGMA user_version", 0 is the old schema with pickled BLOB columns
+_schema_checked_databases = set()  # the database files that _connect() already migrated in this process
 
 
 #######################################################################################################################
@@ -23,32 +77,49 @@ being_recited_on_date_col_name = "BEING_RECITED"  # this column records on which
 #######################################################################################################################
 #######################################################################################################################
 
-def _download_hebrew_list_to_db():
+def _download_hebrew_list_to_db(source=hebrew_list_url):
     """
-    This function get a 10000 Hebrew frequency list from the internet.
-    :return:
+    This function get a 10000 Hebrew frequency list from the internet (or from a saved copy of the page).
+    It can be run again safely: words that are already in the table are not added twice.
+    See HebrewListIngest.ingest_hebrew_list()
+    :return: the report of ingest_hebrew_list()
+    """
+    # imported here, because HebrewListIngest itself uses this file
+    from HebrewListIngest import ingest_hebrew_list
+    return ingest_hebrew_list(source)
+
+
+def _create_hebrew_list_table(cursor):
     """
-    url = 'https://www.teachmehebrew.com/hebrew-frequency-list.html'
-    response = requests.get(url)
-
-    db_conn = sqlite3.connect("my_database.db")
-    db_table_name = "hebrew_list"
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        tables = soup.find_all('table', {'id': 'words'})
-        for table in tables:
-            table_rows = table.find_all('tr')
-            csv_rows_list = []
-            for row in table_rows:
-                cells = row.find_all(['th', 'td'])
-                csv_row = [cell.get_text(strip=True) for cell in cells]
-                csv_rows_list.append(csv_row)
-            df = pd.DataFrame(csv_rows_list[1:], columns=csv_rows_list[0])
-            df['Hebrew'] = df['Hebrew'].replace("", None).ffill()
-            df['Rank'] = df['Rank'].replace("", None).ffill()
-            df['Rank'] = pd.to_numeric(df['Rank'], errors='coerce')
-            df.to_sql(db_table_name, db_conn, index=False, if_exists="append")
-    db_conn.close()
+    The table used to be created by pandas' to_sql, so the columns are the same as what it created.
+    A word is identified by all of its columns: the same (Rank, Hebrew, Transliteration) can appear with different
+    English meanings (e.g. מעל - ma'al: embezzled / embezzlement), they are different rows.
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {hebrew_list_table}(
+            "Rank" INTEGER,
+            "English" TEXT,
+            "Transliteration" TEXT,
+            "Hebrew" TEXT
+        )
+    """)
+    cursor.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS {hebrew_list_table}_word
+                       ON {hebrew_list_table}(Rank, Hebrew, Transliteration, English);""")
+
+
+def _upsert_hebrew_list_rows(rows):
+    """
+    Insert the rows that are not in the table yet, in one transaction.
+    :param rows: a list of (rank, english, transliteration, hebrew)
+    :return: the number of rows that were new
+    """
+    query = f"""INSERT INTO {hebrew_list_table} (Rank, English, Transliteration, Hebrew)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(Rank, Hebrew, Transliteration, English) DO NOTHING;"""
+    with shared_transaction() as conn:
+        changes_before = conn.total_changes
+        conn.cursor().executemany(query, rows)
+        return conn.total_changes - changes_before
 
 
 def get_vocabs(begin_rank, end_rank):
@@ -58,13 +129,146 @@ def get_vocabs(begin_rank, end_rank):
     :param end_rank:
     :return:
     """
-    conn = sqlite3.connect(my_database)
     query = f"SELECT * FROM {hebrew_list_table} WHERE rank BETWEEN ? AND ?"
-    df = pd.read_sql_query(query, conn, params=(begin_rank, end_rank))
-    conn.close()
+    df = _read_sql_query("dbAPI.get_vocabs", query, params=(begin_rank, end_rank), conn=_connect_shared())
+    return df
+
+
+def get_vocabs_of_ranks(ranks):
+    """
+    Same as get_vocabs, but for any set of ranks (e.g. the words that are due today), in one query.
+    :param ranks: a list (or numpy array) of ranks
+    :return: a pandas df, ordered by rank
+    """
+    query = f"""SELECT * FROM {hebrew_list_table}
+                WHERE rank IN (SELECT value FROM json_each(?))
+                ORDER BY rank;"""
+    return _read_sql_query("dbAPI.get_vocabs_of_ranks", query, params=(json.dumps([int(rank) for rank in ranks]),),
+                           conn=_connect_shared())
+
+
+def _read_sql_query(span_name, query, params=(), conn=None):
+    """
+    pd.read_sql_query on the shared connection, recorded as a span (with the number of rows) if tracing is on.
+    :param conn: by default the connection of the current user's database
+    """
+    with Tracing.span(span_name) as trace_span:
+        df = pd.read_sql_query(query, _connect() if conn is None else conn, params=params)
+        trace_span.set(rows=len(df))
     return df
 
 
+#######################################################################################################################
+#######################################################################################################################
+############################################ Table: app_user ##########################################################
+#######################################################################################################################
+#######################################################################################################################
+
+def _create_user_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {user_table}(
+            {user_id_col_name} INTEGER PRIMARY KEY,
+            {user_name_col_name} TEXT NOT NULL UNIQUE,
+            CREATED_AT REAL NOT NULL
+        )
+    """)
+
+
+def _add_default_user(cursor):
+    cursor.execute(f"""INSERT INTO {user_table} ({user_id_col_name}, {user_name_col_name}, CREATED_AT)
+                       VALUES (?, ?, ?)
+                       ON CONFLICT DO NOTHING;""", (default_user_id, default_user_name, time.time()))
+
+
+def add_user(user_name):
+    """
+    :return: the user id of user_name, the user is added if it doesn't exist yet
+    """
+    with shared_transaction() as conn:
+        conn.execute(f"""INSERT INTO {user_table} ({user_name_col_name}, CREATED_AT) VALUES (?, ?)
+                         ON CONFLICT({user_name_col_name}) DO NOTHING;""", (user_name, time.time()))
+        return conn.execute(f"SELECT {user_id_col_name} FROM {user_table} WHERE {user_name_col_name} = ?;",
+                            (user_name,)).fetchone()[0]
+
+
+def get_users():
+    """
+    :return: a list of (user_id, user_name), by user id
+    """
+    query = f"SELECT {user_id_col_name}, {user_name_col_name} FROM {user_table} ORDER BY {user_id_col_name};"
+    return _connect_shared().execute(query).fetchall()
+
+
+def get_user_id(user_name=None):
+    """
+    :param user_name: None for the current user (see as_user())
+    :return: the user id, None if there is no user with this name
+    """
+    if user_name is None:
+        return _current_user_id.get()
+    row = _connect_shared().execute(f"SELECT {user_id_col_name} FROM {user_table} WHERE {user_name_col_name} = ?;",
+                                    (user_name,)).fetchone()
+    return row[0] if row else None
+
+
+@contextmanager
+def as_user(user_id):
+    """
+    Inside "with dbAPI.as_user(user_id):" the functions of this file (and everything that uses them: the planners, the
+    exports, generating today's material) work on the progress of this user. Outside of it, it is default_user_id.
+    It is a contextvar, so threads and asyncio tasks can each work for another user.
+    """
+    token = _current_user_id.set(int(user_id))
+    try:
+        yield
+    finally:
+        _current_user_id.reset(token)
+
+
+def get_user_database(user_id=None):
+    """
+    :param user_id: None for the current user
+    :return: the database file that has the progress of the user, see num_user_shards
+    """
+    if num_user_shards == 0:
+        return my_database
+    user_id = _current_user_id.get() if user_id is None else user_id
+    return f"{os.path.splitext(my_database)[0]}_users_{user_id % num_user_shards}.db"
+
+
+def _group_users_by_database(user_ids=None):
+    """
+    :param user_ids: None for all the users of app_user
+    :return: a dictionary database file -> the user ids in it, for the functions that do one pass per file for many
+            users
+    """
+    if user_ids is None:
+        user_ids = [user_id for user_id, _ in get_users()]
+    user_ids_by_database = {}
+    for user_id in user_ids:
+        user_ids_by_database.setdefault(get_user_database(int(user_id)), []).append(int(user_id))
+    return user_ids_by_database
+
+
+def _create_export_state_table(cursor):
+    """
+    The incremental exports of StudyMaterialExporter: when each one ran last.
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {export_state_table}(
+            {user_id_col_name} INTEGER NOT NULL,
+            EXPORT_NAME TEXT NOT NULL,
+            LAST_EXPORTED_AT REAL NOT NULL,
+            PRIMARY KEY ({user_id_col_name}, EXPORT_NAME)
+        )
+    """)
+
+
+# the tables that have a USER_ID
+_user_table_names = [study_progress_table, study_range_table, recitation_table, word_schedule_table,
+                     review_event_table, word_schedule_snapshot_table, export_state_table]
+
+
 #######################################################################################################################
 #######################################################################################################################
 ############################################ Table: study_progress ####################################################
@@ -74,20 +278,275 @@ def get_vocabs(begin_rank, end_rank):
 def _initialize_tables():
     """
     Note "DATE" is a keyword in sqlite3....
+    Dates are stored as %Y-%m-%d strings, so they sort (and can be indexed) in chronological order.
+    If the database still has the old study_progress table with pickled columns, it is migrated first.
     :return:
     """
-    conn = sqlite3.connect(my_database)
-    conn.cursor().execute(f"""
+    _migrate_schema()
+
+
+def _create_tables(cursor):
+    """
+    Create all the tables that don't exist yet, in their current form.
+    """
+    _create_hebrew_list_table(cursor)
+    create_sentence_cache_table(cursor)
+    _create_user_table(cursor)
+    _create_user_tables(cursor)
+
+
+def _create_user_tables(cursor):
+    """
+    The tables of the users' progress, the only ones in a file of num_user_shards.
+    """
+    _create_study_progress_tables(cursor)
+    _create_word_schedule_table(cursor)
+    _create_review_event_tables(cursor)
+    _create_export_state_table(cursor)
+
+
+def _create_study_progress_tables(cursor):
+    """
+    The ranges of a date in study_range are kept merged (see update_study_progress()), so a date that studied the
+    ranks 1-20 in the morning and 21-40 in the evening has one row 1-40, and one that skipped some ranks has one row per
+    range. The primary key also answers "what was the last studied range": the latest date, its highest range.
+    All the keys start with USER_ID, so the rows of a user are together, and a query of one user only reads them.
+    """
+    cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {study_progress_table}(
-            {date_string_col_name} TEXT PRIMARY KEY,
-            {new_material_col_name} BLOB,
-            {recited_material_col_name} BLOB,
-            {being_recited_on_date_col_name} BLOB
+            {user_id_col_name} INTEGER NOT NULL,
+            {date_string_col_name} DATE NOT NULL CHECK (date({date_string_col_name}) IS {date_string_col_name}),
+            {updated_at_col_name} DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ({user_id_col_name}, {date_string_col_name})
         )
     """)
-    # commit the change
-    conn.commit()
-    conn.close()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {study_range_table}(
+            {user_id_col_name} INTEGER NOT NULL,
+            {date_string_col_name} DATE NOT NULL CHECK (date({date_string_col_name}) IS {date_string_col_name}),
+            {begin_rank_col_name} INTEGER NOT NULL CHECK ({begin_rank_col_name} >= 1),
+            {end_rank_col_name} INTEGER NOT NULL CHECK ({end_rank_col_name} >= {begin_rank_col_name}),
+            PRIMARY KEY ({user_id_col_name}, {date_string_col_name}, {begin_rank_col_name})
+        ) WITHOUT ROWID
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {recitation_table}(
+            {user_id_col_name} INTEGER NOT NULL,
+            {material_date_col_name} DATE NOT NULL
+                CHECK (date({material_date_col_name}) IS {material_date_col_name}),
+            {recited_on_date_col_name} DATE NOT NULL
+                CHECK (date({recited_on_date_col_name}) IS {recited_on_date_col_name}),
+            PRIMARY KEY ({user_id_col_name}, {material_date_col_name}, {recited_on_date_col_name})
+        ) WITHOUT ROWID
+    """)
+    # "what was recited on date X"
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {recitation_table}_recited_on
+                       ON {recitation_table}({user_id_col_name}, {recited_on_date_col_name},
+                                             {material_date_col_name});""")
+
+
+def _migrate_schema(db_path=None):
+    """
+    Bring the database to the current schema_version. This is done in one transaction, so if anything goes wrong the
+    database stays as it was, and other connections see either the old tables or the new ones, never half of it.
+    Version 0 -> 1: study_progress used to have the columns (DATE_STR, NEW_MATERIAL, RECITED_MATERIALS, BEING_RECITED),
+    the last three were pickled python objects. Now the new material is two integer columns, and both
+    RECITED_MATERIALS and BEING_RECITED are the table recitation (RECITED_MATERIALS of date Y are the rows with
+    RECITED_ON_DATE_STR = Y, BEING_RECITED of date X are the rows with MATERIAL_DATE_STR = X).
+    The old table is kept as study_progress_pickled, in case something needs to be checked.
+    Version 1 -> 2: add the table word_schedule.
+    Version 2 -> 3: hebrew_list gets a unique index, so downloading the list again doesn't duplicate it. If it was
+    already duplicated, the duplicates are removed.
+    Version 3 -> 4: add the tables review_event and word_schedule_snapshot. The word_schedule that exists is the
+    snapshot of an empty log.
+    Version 4 -> 5: the new material of a date is moved from the columns BEGIN_RANK and END_RANK of study_progress to
+    the table study_range, which can have several ranges per date.
+    Version 5 -> 6: add the table app_user, and USER_ID to the tables of the progress. What exists is the progress of
+    the default user.
+    Version 6 -> 7: the sentence cache is created with the other tables, so reading the studied words (which joins it)
+    doesn't have to create it first.
+    A file of num_user_shards only has the tables of the users, it is made in their current form.
+    The tables are always created in their current form, so a migration that copies rows into them gives all the
+    current columns (e.g. USER_ID).
+    :param db_path: my_database (None), or a file of num_user_shards
+    """
+    db_path = my_database if db_path is None else db_path
+    if dbConnection.get_connection(db_path).execute("PRAGMA user_version;").fetchone()[0] >= schema_version:
+        return
+    with dbConnection.transaction(db_path) as conn:
+        cursor = conn.cursor()
+        # another connection might have migrated while we were waiting for the lock
+        current_version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+        if db_path != my_database:
+            _create_user_tables(cursor)
+        else:
+            for version, migrate_to_version in enumerate(_schema_migrations, start=1):
+                if current_version < version:
+                    migrate_to_version(cursor)
+        cursor.execute(f"PRAGMA user_version = {schema_version};")
+
+
+def _migrate_to_version_1(cursor):
+    study_progress_columns = [row[1] for row in
+                              cursor.execute(f"PRAGMA table_info({study_progress_table});").fetchall()]
+    has_legacy_table = new_material_col_name in study_progress_columns
+    if has_legacy_table:
+        cursor.execute(f"ALTER TABLE {study_progress_table} RENAME TO {legacy_study_progress_table};")
+    _create_study_progress_tables(cursor)
+    if has_legacy_table:
+        _copy_legacy_study_progress(cursor)
+
+
+def _migrate_to_version_2(cursor):
+    _create_word_schedule_table(cursor)
+
+
+def _migrate_to_version_3(cursor):
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;"
+    if cursor.execute(query, (hebrew_list_table,)).fetchone():
+        cursor.execute(f"""DELETE FROM {hebrew_list_table}
+                           WHERE rowid NOT IN (SELECT min(rowid) FROM {hebrew_list_table}
+                                               GROUP BY Rank, Hebrew, Transliteration, English);""")
+    _create_hebrew_list_table(cursor)
+
+
+def _migrate_to_version_4(cursor):
+    _create_review_event_tables(cursor)
+
+
+def _migrate_to_version_5(cursor):
+    study_progress_columns = [row[1] for row in
+                              cursor.execute(f"PRAGMA table_info({study_progress_table});").fetchall()]
+    if begin_rank_col_name not in study_progress_columns:  # created by _migrate_to_version_1() in its new form
+        _create_study_progress_tables(cursor)
+        return
+    old_table = f"{study_progress_table}_version_4"
+    cursor.execute(f"ALTER TABLE {study_progress_table} RENAME TO {old_table};")
+    _create_study_progress_tables(cursor)
+    cursor.execute(f"""INSERT INTO {study_progress_table}
+                       ({user_id_col_name}, {date_string_col_name}, {updated_at_col_name})
+                       SELECT ?, {date_string_col_name}, {updated_at_col_name} FROM {old_table};""",
+                   (default_user_id,))
+    cursor.execute(f"""INSERT INTO {study_range_table}
+                       ({user_id_col_name}, {date_string_col_name}, {begin_rank_col_name}, {end_rank_col_name})
+                       SELECT ?, {date_string_col_name}, {begin_rank_col_name}, {end_rank_col_name} FROM {old_table}
+                       WHERE {begin_rank_col_name} IS NOT NULL;""", (default_user_id,))
+    # its index study_progress_studied_date goes with it
+    cursor.execute(f"DROP TABLE {old_table};")
+
+
+def _migrate_to_version_6(cursor):
+    _create_user_table(cursor)
+    _add_default_user(cursor)
+    old_tables = []
+    for table_name in _user_table_names:
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name});").fetchall()]
+        # a table that doesn't exist (export_state is created when it is first used), or that an earlier migration
+        # already created in its current form
+        if not columns or user_id_col_name in columns:
+            continue
+        old_table = f"{table_name}_version_5"
+        cursor.execute(f"ALTER TABLE {table_name} RENAME TO {old_table};")
+        # the indexes keep their names when the table is renamed, the new table needs them
+        index_names = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                     "AND sql IS NOT NULL;", (old_table,)).fetchall()
+        for (index_name,) in index_names:
+            cursor.execute(f"DROP INDEX {index_name};")
+        old_tables.append((table_name, old_table, columns))
+    _create_user_tables(cursor)
+    for table_name, old_table, columns in old_tables:
+        # e.g. the ID of word_schedule_snapshot, which had one row, is not a column anymore
+        new_columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table_name});").fetchall()}
+        columns = ", ".join(column for column in columns if column in new_columns)
+        cursor.execute(f"""INSERT INTO {table_name} ({user_id_col_name}, {columns})
+                           SELECT ?, {columns} FROM {old_table};""", (default_user_id,))
+        cursor.execute(f"DROP TABLE {old_table};")
+
+
+def _migrate_to_version_7(cursor):
+    create_sentence_cache_table(cursor)
+
+
+def _copy_legacy_study_progress(cursor):
+    """
+    Copy the rows of the pickled study_progress_pickled into the new tables.
+    """
+    study_progress_rows = []
+    study_range_rows = []
+    recitation_rows = set()
+    legacy_rows = cursor.execute(f"SELECT * FROM {legacy_study_progress_table};").fetchall()
+    for row in legacy_rows:
+        date_str, new_material, recited_material, being_recited_on_date = _deserialize_rows_sqlite(row)
+        study_progress_rows.append((default_user_id, date_str))
+        if new_material:
+            study_range_rows.append((default_user_id, date_str, new_material[0], new_material[1]))
+        for material_date_str in recited_material:
+            recitation_rows.add((default_user_id, material_date_str, date_str))
+        for recited_on_date_str in being_recited_on_date:
+            recitation_rows.add((default_user_id, date_str, recited_on_date_str))
+    cursor.executemany(f"""INSERT INTO {study_progress_table} ({user_id_col_name}, {date_string_col_name})
+                           VALUES (?, ?);""",
+                       study_progress_rows)
+    cursor.executemany(f"""INSERT INTO {study_range_table}
+                           ({user_id_col_name}, {date_string_col_name}, {begin_rank_col_name}, {end_rank_col_name})
+                           VALUES (?, ?, ?, ?);""", study_range_rows)
+    cursor.executemany(f"""INSERT INTO {recitation_table}
+                           ({user_id_col_name}, {material_date_col_name}, {recited_on_date_col_name})
+                           VALUES (?, ?, ?);""", sorted(recitation_rows))
+
+
+# _schema_migrations[i] brings the database from version i to version i + 1
+_schema_migrations = [_migrate_to_version_1, _migrate_to_version_2, _migrate_to_version_3, _migrate_to_version_4,
+                      _migrate_to_version_5, _migrate_to_version_6, _migrate_to_version_7]
+
+
+def _connect():
+    """
+    Get the (shared, already open) connection to the database of the current user (see as_user()), and make sure it
+    has the current schema (only checked once per database file). Don't close it.
+    The shared tables (e.g. hebrew_list) can be read from it too, but are written through _connect_shared().
+    """
+    return dbConnection.get_connection(_check_database(get_user_database()))
+
+
+def _connect_shared():
+    """
+    Same as _connect(), for my_database, which has the shared tables: hebrew_list, the sentence cache and app_user.
+    """
+    return dbConnection.get_connection(_check_database(my_database))
+
+
+def _check_database(db_path):
+    """
+    Migrate db_path the first time it is used in this process.
+    :return: db_path
+    """
+    if db_path not in _schema_checked_databases:
+        if db_path != my_database:
+            # the file of some users reads the shared tables from my_database, which must exist first
+            _check_database(my_database)
+            dbConnection.attach_read_only(db_path, "shared", my_database)
+        with Tracing.span("dbAPI._migrate_schema", db_path=db_path):
+            _migrate_schema(db_path)
+        _schema_checked_databases.add(db_path)
+    return db_path
+
+
+def transaction(db_path=None):
+    """
+    Everything done inside "with dbAPI.transaction():" (including calls to other functions of this file) is committed
+    together at the end, or not at all if there is an exception. It is a transaction on the database of the current
+    user.
+    :param db_path: another database file of the users, e.g. for a pass over all the users in it
+    """
+    return dbConnection.transaction(_check_database(get_user_database() if db_path is None else db_path))
+
+
+def shared_transaction():
+    """
+    A transaction on my_database, for the shared tables. With num_user_shards it is not the same as transaction().
+    """
+    return dbConnection.transaction(_check_database(my_database))
 
 
 def _clear_table(table_name):
@@ -95,12 +554,10 @@ def _clear_table(table_name):
     Note "DATE" is a keyword in sqlite3....
     :return:
     """
-    conn = sqlite3.connect(my_database)
-    conn.cursor().execute(f"""DROP TABLE {table_name};""")
-    _initialize_tables()
-    # commit the change
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.cursor().execute(f"""DROP TABLE {table_name};""")
+        # a file of num_user_shards must not get its own (empty) copy of the shared tables
+        (_create_tables if get_user_database() == my_database else _create_user_tables)(conn.cursor())
 
 
 def update_study_progress(date_str, new_material=None, recited_material=None, being_recited_on_date=None,
@@ -111,16 +568,17 @@ def update_study_progress(date_str, new_material=None, recited_material=None, be
     If I map study progress to date, for each study progress I would be able to assess how well is it studied.
     Also, what's the precision of time? to hours? to minutes? first do until day. If later we want to include a
     Ebbinghaus we can create another table.
-    Note: for inserting binary BLOB into table, must use ? with parameters, not f-string, else it would be syntax error
     Note: also for queries, must use ? instead of f-strings....
     Note: sql date time only understand %Y-%m-%d format
     Conclusion is: map date to progress is essential. First realize this.
     Map progress to date is also essential, but each progress's identifier will be its date, so it can be in the same
     table.
+    Note: both recited_material and being_recited_on_date are rows of the recitation table, so giving
+    recited_material={date_x} to date_y is the same as giving being_recited_on_date={date_y} to date_x.
     :param date_time: should be a datetime object that is obtained by e.g. datetime.now().
-    :param new_material: should be a list [begin_rank, end_rank], if nothing is studied, then empty list [],
-            if a new new_material is provided (from a second call of this function), it will append to the old one
-            according to _rules_for_adding_new_material()
+    :param new_material: should be a list [begin_rank, end_rank], or a RangeSet (e.g. from get_next_new_material()),
+            if nothing is studied, then empty list [], if a new new_material is provided (from a second call of this
+            function), its ranks are added to the old ones (the ranges are merged, or kept apart if there is a gap)
     :param recited_material: should be a set {date_str_1, date_str_2, },
             if a new recited_material is provided (from a second call of this function), it will append to the old one
     :param being_recited_on_date: should be a set {date_str}
@@ -128,195 +586,604 @@ def update_study_progress(date_str, new_material=None, recited_material=None, be
     not change the old value.
     :return:
     """
-    # connect to db
-    conn = sqlite3.connect(my_database)
-    cursor = conn.cursor()
-    # check if the date already exist in the table
-    query = f'SELECT * FROM {study_progress_table} WHERE {date_string_col_name} = ?'
-    cursor.execute(query, (date_str,))
-    existing_row = cursor.fetchone()
-    if not existing_row:  # insert the new row
-        # parameter check: regardless override or not
-        if new_material is None:
-            new_material = []
-        if recited_material is None:
-            recited_material = set()
-        if being_recited_on_date is None:
-            being_recited_on_date = set()
-        # convert dictionary to BLOB
-        row_values = _serialized_rows(date_str, new_material, recited_material, being_recited_on_date)
-        # insert the new row
-        query = f'''INSERT INTO {study_progress_table} 
-                    VALUES (?, ?, ?, ?);'''
-        cursor.execute(query, row_values)
-    else:  # update the row according to some rules
-        # deserialize the information
-        date_str, exist_new_material, exist_recited_material, exist_being_recited_on_date = _deserialize_rows_sqlite(
-            existing_row)
-        new_material, recited_material, being_recited_on_date = _rules_for_updating_tables(new_material,
-                                                                                           exist_new_material,
-                                                                                           recited_material,
-                                                                                           exist_recited_material,
-                                                                                           being_recited_on_date,
-                                                                                           exist_being_recited_on_date,
-                                                                                           override)
-        # serialize: convert to BLOB
-        date_str, new_material_BLOB, recited_material_BLOB, being_recited_on_date_BLOB = _serialized_rows(date_str,
-                                                                                                          new_material,
-                                                                                                          recited_material,
-                                                                                                          being_recited_on_date)
-        # update table
-        query = f'''UPDATE {study_progress_table}
-                    SET {new_material_col_name} = ?, {recited_material_col_name} = ?, {being_recited_on_date_col_name} = ?
-                    WHERE {date_string_col_name} = ?;'''
-        cursor.execute(query, (new_material_BLOB, recited_material_BLOB, being_recited_on_date_BLOB, date_str))
-    # commit the change
-    conn.commit()
-    conn.close()
+    # the read and the writes are one transaction, so nobody can change the row in between
+    user_id = get_user_id()
+    with Tracing.span("dbAPI.update_study_progress"), transaction() as conn:
+        cursor = conn.cursor()
+        # check if the date already exist in the table
+        query = f"SELECT 1 FROM {study_progress_table} WHERE {user_id_col_name} = ? AND {date_string_col_name} = ?"
+        if not cursor.execute(query, (user_id, date_str)).fetchone():  # insert the new row
+            cursor.execute(f"INSERT INTO {study_progress_table} ({user_id_col_name}, {date_string_col_name}) "
+                           f"VALUES (?, ?);", (user_id, date_str))
+        elif new_material is not None:
+            cursor.execute(f"""UPDATE {study_progress_table} SET {updated_at_col_name} = CURRENT_TIMESTAMP
+                               WHERE {user_id_col_name} = ? AND {date_string_col_name} = ?;""", (user_id, date_str))
+        if new_material is not None:
+            if not isinstance(new_material, RangeSet):
+                new_material = RangeSet([new_material] if new_material else [])
+            if not override:
+                query = f"""SELECT {begin_rank_col_name}, {end_rank_col_name} FROM {study_range_table}
+                            WHERE {user_id_col_name} = ? AND {date_string_col_name} = ?;"""
+                new_material = RangeSet(cursor.execute(query, (user_id, date_str)).fetchall()) | new_material
+            # the ranges of the date are written again, merged
+            cursor.execute(f"""DELETE FROM {study_range_table}
+                               WHERE {user_id_col_name} = ? AND {date_string_col_name} = ?;""", (user_id, date_str))
+            cursor.executemany(f"""INSERT INTO {study_range_table}
+                                   ({user_id_col_name}, {date_string_col_name}, {begin_rank_col_name},
+                                    {end_rank_col_name})
+                                   VALUES (?, ?, ?, ?);""",
+                               [(user_id, date_str, begin_rank, end_rank)
+                                for begin_rank, end_rank in new_material.ranges()])
+        # recitations: without override we only add, with override the given set replaces the old one
+        if recited_material is not None:
+            if override:
+                cursor.execute(f"DELETE FROM {recitation_table} "
+                               f"WHERE {user_id_col_name} = ? AND {recited_on_date_col_name} = ?;", (user_id, date_str))
+            cursor.executemany(f"""INSERT OR IGNORE INTO {recitation_table}
+                                   ({user_id_col_name}, {material_date_col_name}, {recited_on_date_col_name})
+                                   VALUES (?, ?, ?);""",
+                               [(user_id, material_date, date_str) for material_date in recited_material])
+        if being_recited_on_date is not None:
+            if override:
+                cursor.execute(f"DELETE FROM {recitation_table} "
+                               f"WHERE {user_id_col_name} = ? AND {material_date_col_name} = ?;", (user_id, date_str))
+            cursor.executemany(f"""INSERT OR IGNORE INTO {recitation_table}
+                                   ({user_id_col_name}, {material_date_col_name}, {recited_on_date_col_name})
+                                   VALUES (?, ?, ?);""",
+                               [(user_id, date_str, recited_on) for recited_on in being_recited_on_date])
 
 
-def get_next_new_material(num_new_words_to_learn):
+def get_last_studied_range():
     """
-    Assume all study material before are consecutively selected, then the next new materials will be the last date's
-    new material + 1 until last date's new material + n
-    :param num_new_words_to_learn:
-    :return: the begin rank and end rank for the new materials
+    :return: (date_str, begin_rank, end_rank) of the highest range of the latest date that has new material, None if
+            nothing is studied
     """
-    BLOB_of_empty_list = pickle.dumps([])
-    query = f"""SELECT *
-                FROM {study_progress_table}
-                WHERE NOT {new_material_col_name} = ?
-                ORDER BY unixepoch({date_string_col_name}) DESC
+    query = f"""SELECT {date_string_col_name}, {begin_rank_col_name}, {end_rank_col_name}
+                FROM {study_range_table}
+                WHERE {user_id_col_name} = ?
+                ORDER BY {date_string_col_name} DESC, {begin_rank_col_name} DESC
                 LIMIT 1;
             """
-    conn = sqlite3.connect(my_database)
-    cursor = conn.cursor()
-    cursor.execute(query, (BLOB_of_empty_list,))
-    row_latest_progress = cursor.fetchone()
-    if row_latest_progress:
-        new_material = _deserialize_rows_sqlite(row_latest_progress)[1]
-        last_studied_rank = new_material[1]
-        return last_studied_rank + 1, last_studied_rank + num_new_words_to_learn
-    # in the extreme cases where there is no studied list
-    return 1, num_new_words_to_learn
+    return _connect().cursor().execute(query, (get_user_id(),)).fetchone()
+
+
+def get_studied_ranks():
+    """
+    :return: a StudiedRanks of the new material of all the dates (one query), for "is rank X studied", "which dates
+            introduced rank X" and "which ranks are not studied yet"
+    """
+    with Tracing.span("dbAPI.get_studied_ranks"):
+        return StudiedRanks(get_new_material_ranges())
+
+
+def get_next_new_material(num_new_words_to_learn):
+    """
+    The next new materials are the first n ranks that were never studied: if some ranks were skipped (e.g. a date's
+    material was overridden), they come first, then the ranks after the highest studied one.
+    In the usual case there is no gap, and it is the last date's new material + 1 until last date's new material + n.
+    :param num_new_words_to_learn:
+    :return: a RangeSet of the ranks of the new materials, usually one range
+    """
+    # only the union of the ranges is needed here, not the StudiedRanks of every date
+    query = f"""SELECT {begin_rank_col_name}, {end_rank_col_name} FROM {study_range_table}
+                WHERE {user_id_col_name} = ?
+                ORDER BY {begin_rank_col_name};"""
+    with Tracing.span("dbAPI.get_next_new_material"):
+        studied_ranks = RangeSet(_connect().cursor().execute(query, (get_user_id(),)).fetchall())
+    return studied_ranks.get_missing(num_new_words_to_learn)
+
+
+def get_next_new_material_of_users(num_new_words_to_learn, user_ids=None):
+    """
+    get_next_new_material() of many users, in one query per database file.
+    :param user_ids: None for all the users
+    :return: a dictionary user_id -> RangeSet
+    """
+    query = f"""SELECT {user_id_col_name}, {begin_rank_col_name}, {end_rank_col_name} FROM {study_range_table}
+                WHERE {user_id_col_name} IN (SELECT value FROM json_each(?))
+                ORDER BY {user_id_col_name}, {begin_rank_col_name};"""
+    next_new_material = {}
+    with Tracing.span("dbAPI.get_next_new_material_of_users"):
+        for db_path, db_user_ids in _group_users_by_database(user_ids).items():
+            studied_ranks = {user_id: RangeSet() for user_id in db_user_ids}
+            rows = dbConnection.get_connection(_check_database(db_path)).execute(query, (json.dumps(db_user_ids),))
+            for user_id, begin_rank, end_rank in rows:
+                studied_ranks[user_id].add(begin_rank, end_rank)
+            for user_id, range_set in studied_ranks.items():
+                next_new_material[user_id] = range_set.get_missing(num_new_words_to_learn)
+    return next_new_material
+
+
+def get_materials_recited_on_date(date_str):
+    """
+    :param date_str: The date string must be in form %Y-%m-%d
+    :return: a set of dates (strings), whose new material was recited on date_str
+    """
+    query = f"""SELECT {material_date_col_name} FROM {recitation_table}
+                WHERE {user_id_col_name} = ? AND {recited_on_date_col_name} = ?;"""
+    rows = _connect().cursor().execute(query, (get_user_id(), date_str)).fetchall()
+    return {row[0] for row in rows}
 
 
 def recited_material_of_date(recited_material_date_string):
     """
     You can recite material on day that doesn't have materials, it will still record it in the database.
+    Both dates are updated in one commit.
     :param recited_material_date_string: The date string must be in form %Y-%m-%d
     :return:
     """
-    update_study_progress(recited_material_date_string, being_recited_on_date={datetime.now().strftime("%Y-%m-%d")})
-    update_study_progress(datetime.now().strftime("%Y-%m-%d"), recited_material={recited_material_date_string})
+    with transaction():
+        update_study_progress(recited_material_date_string,
+                              being_recited_on_date={datetime.now().strftime("%Y-%m-%d")})
+        update_study_progress(datetime.now().strftime("%Y-%m-%d"), recited_material={recited_material_date_string})
+
+
+def get_vocabs_of_dates(date_strs):
+    """
+    The words that were new material on any of the given dates, in one query: the dates' rank ranges are joined with
+    hebrew_list in sql. A word that is in the ranges of several dates is returned once.
+    The context sentence of each word is attached if it is in the sentence cache (the most recently used one, if
+    there are several).
+    :param date_strs: a list of date strings of form %Y-%m-%d
+    :return: a pandas df with columns ['Rank', 'English', 'Transliteration', 'Hebrew', 'DATE_STR', 'ExampleSentence',
+            'SentenceTranslation'], ordered by rank. DATE_STR is the first of the dates that has the word, the sentences
+            are None for words that are not cached.
+    """
+    condition = f"s.{date_string_col_name} IN (SELECT value FROM json_each(?))"
+    return _read_sql_query("dbAPI.get_vocabs_of_dates", _studied_words_query(condition),
+                           params=(get_user_id(), json.dumps(list(date_strs))))
+
+
+def _studied_words_query(condition):
+    """
+    :param condition: a sql condition on the study_progress row s (and the cache row c) that keeps the wanted dates
+    :return: the query of get_vocabs_of_dates, with condition instead of the list of dates. It is shared with
+            StudyMaterialExporter, which streams the same rows instead of reading them into a df. Its first parameter
+            is the user id, then the ones of condition.
+    """
+    return f"""SELECT h.Rank, h.English, h.Transliteration, h.Hebrew, MIN(s.{date_string_col_name}) AS DATE_STR,
+                      c.EXAMPLE_SENTENCE AS ExampleSentence, c.SENTENCE_TRANSLATION AS SentenceTranslation
+               FROM {study_progress_table} AS s
+               JOIN {study_range_table} AS r
+                   ON r.{user_id_col_name} = s.{user_id_col_name}
+                  AND r.{date_string_col_name} = s.{date_string_col_name}
+               JOIN {hebrew_list_table} AS h ON h.Rank BETWEEN r.{begin_rank_col_name} AND r.{end_rank_col_name}
+               LEFT JOIN {sentence_cache_table} AS c
+                   ON c.CACHE_KEY = (SELECT CACHE_KEY FROM {sentence_cache_table}
+                                     WHERE HEBREW = h.Hebrew AND ENGLISH = h.English
+                                     ORDER BY LAST_USED_AT DESC
+                                     LIMIT 1)
+               WHERE s.{user_id_col_name} = ? AND {condition}
+               GROUP BY h.rowid
+               ORDER BY h.Rank, h.rowid;"""
+
+
+def get_new_material_ranges(begin_date_str=None, end_date_str=None):
+    """
+    :param begin_date_str: only the dates from this date (inclusive), None for no limit
+    :param end_date_str: only the dates until this date (inclusive), None for no limit
+    :return: a list of (date_str, begin_rank, end_rank) of the ranges of all the dates that have new material, oldest
+            first (a date can have several ranges, lowest first)
+    """
+    window_condition, parameters = _date_window_condition(date_string_col_name, begin_date_str, end_date_str)
+    query = f"""SELECT {date_string_col_name}, {begin_rank_col_name}, {end_rank_col_name}
+                FROM {study_range_table}
+                WHERE {user_id_col_name} = ? AND {window_condition}
+                ORDER BY {date_string_col_name}, {begin_rank_col_name};"""
+    return _connect().cursor().execute(query, [get_user_id()] + parameters).fetchall()
+
+
+def get_recitations():
+    """
+    :return: a list of (material_date_str, recited_on_date_str), in the order they were recited
+    """
+    query = f"""SELECT {material_date_col_name}, {recited_on_date_col_name}
+                FROM {recitation_table}
+                WHERE {user_id_col_name} = ?
+                ORDER BY {recited_on_date_col_name}, {material_date_col_name};"""
+    return _connect().cursor().execute(query, (get_user_id(),)).fetchall()
 
 
 def format_date_string(datetime_obj):
     return datetime_obj.strftime("%Y-%m-%d")
 
 
-def get_study_progress_df():
-    conn = sqlite3.connect(my_database)
-    query = f"SELECT * FROM {study_progress_table} ORDER BY unixepoch({date_string_col_name});"
-    df = pd.read_sql_query(query, conn)
-    df.apply(_deserialize_rows_pandas, axis=1)
-    conn.close()
+def get_study_progress_df(begin_date_str=None, end_date_str=None):
+    """
+    :param begin_date_str: only the dates from this date (inclusive), None for no limit. Filtered in sql, so a short
+            window of a long history only reads the rows of the window.
+    :param end_date_str: only the dates until this date (inclusive), None for no limit
+    :return: a pandas df with columns [DATE_STR, NEW_MATERIAL, RECITED_MATERIALS, BEING_RECITED], where NEW_MATERIAL is
+            a list of [begin_rank, end_rank] lists, sorted (empty if the date has no new material, one pair if it
+            studied one range), and the other two are sets of date strings
+    """
+    window_condition, parameters = _date_window_condition(f"s.{date_string_col_name}", begin_date_str, end_date_str)
+    query = f"""SELECT s.{date_string_col_name},
+                       (SELECT group_concat({material_date_col_name}) FROM {recitation_table}
+                        WHERE {user_id_col_name} = s.{user_id_col_name}
+                          AND {recited_on_date_col_name} = s.{date_string_col_name}) AS {recited_material_col_name},
+                       (SELECT group_concat({recited_on_date_col_name}) FROM {recitation_table}
+                        WHERE {user_id_col_name} = s.{user_id_col_name}
+                          AND {material_date_col_name} = s.{date_string_col_name}) AS {being_recited_on_date_col_name}
+                FROM {study_progress_table} AS s
+                WHERE s.{user_id_col_name} = ? AND {window_condition}
+                ORDER BY s.{date_string_col_name};"""
+    with Tracing.span("dbAPI.get_study_progress_df") as trace_span:
+        rows = _connect().cursor().execute(query, [get_user_id()] + parameters).fetchall()
+        date_ranges = {}
+        for date_str, begin_rank, end_rank in get_new_material_ranges(begin_date_str, end_date_str):
+            date_ranges.setdefault(date_str, []).append([begin_rank, end_rank])
+        trace_span.set(rows=len(rows))
+    df = pd.DataFrame({
+        date_string_col_name: [row[0] for row in rows],
+        new_material_col_name: [date_ranges.get(row[0], []) for row in rows],
+        recited_material_col_name: [set(row[1].split(",")) if row[1] else set() for row in rows],
+        being_recited_on_date_col_name: [set(row[2].split(",")) if row[2] else set() for row in rows],
+    })
     return df
 
 
+def get_studied_words_df(begin_date_str=None, end_date_str=None, as_arrow=False):
+    """
+    The study history, one row per word: each date's ranges are expanded into the words of their ranks
+    (by a join with hebrew_list in sql, not in python), together with how often that date's material was recited.
+    :param begin_date_str: only the dates from this date (inclusive), None for no limit. Filtered in sql.
+    :param end_date_str: only the dates until this date (inclusive), None for no limit
+    :param as_arrow: return a pyarrow Table instead of a pandas df (needs pyarrow)
+    :return: columns DATE (datetime64), Rank (int64), Hebrew, Transliteration, English (strings),
+            NUM_RECITATIONS (int64) and LAST_RECITED_DATE (datetime64, NaT if never recited), ordered by date and rank
+    """
+    window_condition, parameters = _date_window_condition(f"s.{date_string_col_name}", begin_date_str, end_date_str)
+    recitation_window_condition, recitation_parameters = _date_window_condition(material_date_col_name,
+                                                                                begin_date_str, end_date_str)
+    query = f"""WITH recitation_summary AS (
+                    SELECT {material_date_col_name}, COUNT(*) AS NUM_RECITATIONS,
+                           MAX({recited_on_date_col_name}) AS LAST_RECITED_DATE
+                    FROM {recitation_table}
+                    WHERE {user_id_col_name} = ? AND {recitation_window_condition}
+                    GROUP BY {material_date_col_name}
+                )
+                SELECT s.{date_string_col_name}, h.Rank, h.Hebrew, h.Transliteration, h.English,
+                       COALESCE(r.NUM_RECITATIONS, 0), r.LAST_RECITED_DATE
+                FROM {study_range_table} AS s
+                JOIN {hebrew_list_table} AS h ON h.Rank BETWEEN s.{begin_rank_col_name} AND s.{end_rank_col_name}
+                LEFT JOIN recitation_summary AS r ON r.{material_date_col_name} = s.{date_string_col_name}
+                WHERE s.{user_id_col_name} = ? AND {window_condition}
+                ORDER BY s.{date_string_col_name}, h.Rank, h.rowid;"""
+    user_id = get_user_id()
+    with Tracing.span("dbAPI.get_studied_words_df") as trace_span:
+        rows = _connect().cursor().execute(query, [user_id] + recitation_parameters + [user_id] + parameters).fetchall()
+        trace_span.set(rows=len(rows))
+    columns = list(zip(*rows)) if rows else [()] * 7
+    df = pd.DataFrame({
+        "DATE": pd.to_datetime(pd.Series(columns[0], dtype=object), format="%Y-%m-%d").astype("datetime64[ns]"),
+        "Rank": np.array(columns[1], dtype=np.int64),
+        "Hebrew": pd.Series(columns[2], dtype=object),
+        "Transliteration": pd.Series(columns[3], dtype=object),
+        "English": pd.Series(columns[4], dtype=object),
+        "NUM_RECITATIONS": np.array(columns[5], dtype=np.int64),
+        "LAST_RECITED_DATE": pd.to_datetime(pd.Series(columns[6], dtype=object),
+                                            format="%Y-%m-%d").astype("datetime64[ns]"),
+    })
+    if as_arrow:
+        # optional dependency, only needed here
+        import pyarrow
+        return pyarrow.Table.from_pandas(df, preserve_index=False)
+    return df
+
+
+def _date_window_condition(column, begin_date_str, end_date_str):
+    """
+    :return: a sql condition on column that keeps the dates in [begin_date_str, end_date_str] (None means no limit),
+            and its parameters
+    """
+    conditions = ["1"]
+    parameters = []
+    if begin_date_str is not None:
+        conditions.append(f"{column} >= ?")
+        parameters.append(begin_date_str)
+    if end_date_str is not None:
+        conditions.append(f"{column} <= ?")
+        parameters.append(end_date_str)
+    return " AND ".join(conditions), parameters
+
+
 #######################################################################################################################
 #######################################################################################################################
-########################################################## helpers ####################################################
+############################################ Table: word_schedule #####################################################
 #######################################################################################################################
 #######################################################################################################################
-def _deserialize_rows_sqlite(row):
+
+def _create_word_schedule_table(cursor):
     """
-    This function deserialize a row of table study_progress, the row is obtained from sqlite3
-    :param row: a tuple of (date_str, new_material_BLOB, recited_material_BLOB, being_recited_on_date_BLOB)
-    :return:
+    Dates here are also %Y-%m-%d strings, but get_word_schedule() and save_word_schedule() work with days since
+    1970-01-01 (integers), so the planner can do its math with numpy.
     """
-    date_str = row[0]
-    new_material = pickle.loads(row[1])
-    recited_material = pickle.loads(row[2])
-    being_recited_on_date = pickle.loads(row[3])
-    return date_str, new_material, recited_material, being_recited_on_date
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {word_schedule_table}(
+            {user_id_col_name} INTEGER NOT NULL,
+            {rank_col_name} INTEGER NOT NULL CHECK ({rank_col_name} >= 1),
+            {ease_col_name} REAL NOT NULL,
+            {interval_days_col_name} REAL NOT NULL,
+            {repetitions_col_name} INTEGER NOT NULL,
+            {lapses_col_name} INTEGER NOT NULL,
+            {due_date_col_name} DATE NOT NULL CHECK (date({due_date_col_name}) IS {due_date_col_name}),
+            {last_reviewed_date_col_name} DATE
+                CHECK (date({last_reviewed_date_col_name}) IS {last_reviewed_date_col_name}),
+            PRIMARY KEY ({user_id_col_name}, {rank_col_name})
+        ) WITHOUT ROWID
+    """)
+    # "what is due today", per user
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {word_schedule_table}_due_date
+                       ON {word_schedule_table}({user_id_col_name}, {due_date_col_name});""")
 
 
-def _deserialize_rows_pandas(row):
+def get_word_schedule():
     """
-    This function deserialize a row of table study_progress, the row is obtained from pandas
+    Read the whole schedule at once (it is at most one row per word of the list).
+    :return: a dictionary of numpy arrays of the same length, with keys "rank", "ease", "interval_days", "repetitions",
+            "lapses", "due_day", "last_reviewed_day". Days are counted from 1970-01-01, last_reviewed_day is -1 for
+            words that were never reviewed.
+    """
+    # julianday of 1970-01-01 is 2440587.5
+    query = f"""SELECT {rank_col_name}, {ease_col_name}, {interval_days_col_name}, {repetitions_col_name},
+                       {lapses_col_name},
+                       CAST(julianday({due_date_col_name}) - 2440587.5 AS INTEGER),
+                       COALESCE(CAST(julianday({last_reviewed_date_col_name}) - 2440587.5 AS INTEGER), -1)
+                FROM {word_schedule_table}
+                WHERE {user_id_col_name} = ?;"""
+    with Tracing.span("dbAPI.get_word_schedule") as trace_span:
+        rows = _connect().cursor().execute(query, (get_user_id(),)).fetchall()
+        trace_span.set(rows=len(rows))
+    return _word_schedule_arrays(rows)
 
-    :param row:
-    :return:
+
+def _word_schedule_arrays(rows):
+    """
+    :param rows: (rank, ease, interval_days, repetitions, lapses, due_day, last_reviewed_day) tuples
+    :return: the dictionary of numpy arrays of get_word_schedule()
     """
-    row.iloc[1] = pickle.loads(row.iloc[1])
-    row.iloc[2] = pickle.loads(row.iloc[2])
-    row.iloc[3] = pickle.loads(row.iloc[3])
-    return row
+    table = np.array(rows, dtype=np.float64).reshape(len(rows), 7)
+    return {"rank": table[:, 0].astype(np.int64),
+            "ease": table[:, 1],
+            "interval_days": table[:, 2],
+            "repetitions": table[:, 3].astype(np.int64),
+            "lapses": table[:, 4].astype(np.int64),
+            "due_day": table[:, 5].astype(np.int64),
+            "last_reviewed_day": table[:, 6].astype(np.int64)}
 
 
-def _serialized_rows(date_str, new_material, recited_material, being_recited_on_date):
+def save_word_schedule(rank, ease, interval_days, repetitions, lapses, due_day, last_reviewed_day,
+                       last_event_id=None):
     """
-    This function serialize a row of table study_progress
-    :param date_str:
-    :param new_material:
-    :param recited_material:
-    :param being_recited_on_date:
-    :return:
+    Insert or update the schedule of the given ranks, all in one transaction.
+    The parameters are numpy arrays (or lists) of the same length, same meaning as in get_word_schedule().
+    :param last_event_id: if given, the schedule now includes the review events up to this one (see
+            get_compacted_event_id()), it is saved in the same transaction
     """
-    new_material_BLOB = pickle.dumps(new_material)
-    recited_material_BLOB = pickle.dumps(recited_material)
-    being_recited_on_date_BLOB = pickle.dumps(being_recited_on_date)
-    return date_str, new_material_BLOB, recited_material_BLOB, being_recited_on_date_BLOB
-
-
-def _rules_for_updating_tables(new_material, exist_new_material,
-                               recited_material, exist_recited_material,
-                               being_recited_on_date, exist_being_recited_on_date,
-                               override):
-    if not override:
-        # parameter check: existed ones will not be None
-        if new_material is None:
-            new_material = []
-        if recited_material is None:
-            recited_material = set()
-        if being_recited_on_date is None:
-            being_recited_on_date = set()
-        # add to new/recited_material
-        new_material = _combine_new_material(exist_new_material, new_material)
-        recited_material = recited_material | exist_recited_material
-        being_recited_on_date = being_recited_on_date | exist_being_recited_on_date
-    else:  # override
-        if new_material is None:  # else new material
-            new_material = exist_new_material
-        if recited_material is None:
-            recited_material = exist_recited_material
-        if being_recited_on_date is None:
-            being_recited_on_date = exist_being_recited_on_date
-    return new_material, recited_material, being_recited_on_date
-
-
-def _combine_new_material(exist_new_material, new_material):
-    """
-    the new new_material must be consecutive to the old one, else the result will be unpredicted!!!
-    e.g. if the old one is [20, 30] then the new one must be [20<=x<30, y] or [x, 20<=y<30] or [20<=x<30, 20<=y<30]
-    and the resulting new list will be [1, x]
-    if the old one is [], then the new one will replace the old one.
-    :param exist_new_material: a list of [begin_rank, end_rank] or []
-    :param new_material: a list of [begin_rank, end_rank] or []
-    :return:
+    user_id = get_user_id()
+    rows = zip(itertools.repeat(user_id), np.asarray(rank).tolist(), np.asarray(ease).tolist(),
+               np.asarray(interval_days).tolist(), np.asarray(repetitions).tolist(), np.asarray(lapses).tolist(),
+               (np.asarray(due_day) * 86400).tolist(),
+               [None if day < 0 else day * 86400 for day in np.asarray(last_reviewed_day).tolist()])
+    query = f"""INSERT INTO {word_schedule_table}
+                ({user_id_col_name}, {rank_col_name}, {ease_col_name}, {interval_days_col_name},
+                 {repetitions_col_name}, {lapses_col_name}, {due_date_col_name}, {last_reviewed_date_col_name})
+                VALUES (?, ?, ?, ?, ?, ?, date(?, 'unixepoch'), date(?, 'unixepoch'))
+                ON CONFLICT({user_id_col_name}, {rank_col_name}) DO UPDATE SET
+                    {ease_col_name} = excluded.{ease_col_name},
+                    {interval_days_col_name} = excluded.{interval_days_col_name},
+                    {repetitions_col_name} = excluded.{repetitions_col_name},
+                    {lapses_col_name} = excluded.{lapses_col_name},
+                    {due_date_col_name} = excluded.{due_date_col_name},
+                    {last_reviewed_date_col_name} = excluded.{last_reviewed_date_col_name};"""
+    with Tracing.span("dbAPI.save_word_schedule"), transaction() as conn:
+        conn.cursor().executemany(query, rows)
+        if last_event_id is not None:
+            conn.execute(f"""INSERT INTO {word_schedule_snapshot_table}
+                             ({user_id_col_name}, {last_event_id_col_name}, {created_at_col_name})
+                             VALUES (?, ?, ?)
+                             ON CONFLICT({user_id_col_name}) DO UPDATE SET
+                                 {last_event_id_col_name} = excluded.{last_event_id_col_name},
+                                 {created_at_col_name} = excluded.{created_at_col_name};""",
+                         (user_id, int(last_event_id), time.time()))
+
+
+def get_due_ranks_of_users(day, limit=None, user_ids=None):
+    """
+    The words due on day (or before) of many users, in one query per database file instead of one per user. Like
+    SM2Planner.get_due_ranks(), it reads the snapshot in word_schedule, so the tails of the logs should be compacted
+    first (SM2Planner.get_due_ranks_of_users() does it).
+    :param day: counted from 1970-01-01
+    :param limit: at most this many words per user, the most overdue first
+    :param user_ids: None for all the users
+    :return: a dictionary user_id -> numpy array of ranks, most overdue first (and by rank for the same due date)
+    """
+    # the window numbers each user's due words in the order of the index (USER_ID, DUE_DATE), so the limit is per user
+    query = f"""SELECT {user_id_col_name}, {rank_col_name} FROM (
+                    SELECT {user_id_col_name}, {rank_col_name},
+                           ROW_NUMBER() OVER (PARTITION BY {user_id_col_name}
+                                              ORDER BY {due_date_col_name}, {rank_col_name}) AS position
+                    FROM {word_schedule_table}
+                    WHERE {user_id_col_name} IN (SELECT value FROM json_each(?))
+                      AND {due_date_col_name} <= date(?, 'unixepoch')
+                )
+                WHERE position <= COALESCE(?, position)
+                ORDER BY {user_id_col_name}, position;"""
+    due_ranks = {}
+    with Tracing.span("dbAPI.get_due_ranks_of_users") as trace_span:
+        for db_path, db_user_ids in _group_users_by_database(user_ids).items():
+            rows = dbConnection.get_connection(_check_database(db_path)).execute(
+                query, (json.dumps(db_user_ids), int(day) * 86400, None if limit is None else int(limit))).fetchall()
+            table = np.array(rows, dtype=np.int64).reshape(len(rows), 2)
+            # the rows are grouped by user, so each user's ranks are one slice
+            users, starts = np.unique(table[:, 0], return_index=True)
+            for user_id, ranks in zip(users.tolist(), np.split(table[:, 1], starts[1:])):
+                due_ranks[user_id] = ranks
+            for user_id in db_user_ids:
+                due_ranks.setdefault(user_id, np.zeros(0, dtype=np.int64))
+        trace_span.set(users=len(due_ranks))
+    return due_ranks
+
+
+#######################################################################################################################
+#######################################################################################################################
+############################################ Table: review_event ######################################################
+#######################################################################################################################
+#######################################################################################################################
+
+def _create_review_event_tables(cursor):
     """
-    if not exist_new_material:  # if they are empty set or empty list
-        return new_material
-    if not new_material:
-        return exist_new_material
-    new_begin = min(exist_new_material[0], new_material[0])
-    new_end = max(exist_new_material[1], new_material[1])
-    # useless fool safe
-    if new_end <= 0:
-        new_end = 1
-    if new_begin <= 0:
-        new_begin = 1
-    return [new_begin, new_end]
+    review_event is only ever appended to: recording a review is one INSERT per word, and nothing that was written
+    is changed. word_schedule is a snapshot of the log up to LAST_EVENT_ID of word_schedule_snapshot, see
+    SM2Planner.compact().
+    The events of all the users of a file are in one log (EVENT_ID grows across users), each user's snapshot has the
+    last event of that user that is folded into their word_schedule.
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {review_event_table}(
+            {event_id_col_name} INTEGER PRIMARY KEY AUTOINCREMENT,
+            {user_id_col_name} INTEGER NOT NULL,
+            {rank_col_name} INTEGER NOT NULL CHECK ({rank_col_name} >= 1),
+            {event_type_col_name} TEXT NOT NULL CHECK ({event_type_col_name} IN ('{INTRODUCE}', '{REVIEW}')),
+            {grade_col_name} INTEGER CHECK ({grade_col_name} BETWEEN 0 AND 5),
+            {event_date_col_name} DATE NOT NULL CHECK (date({event_date_col_name}) IS {event_date_col_name}),
+            {created_at_col_name} REAL NOT NULL,
+            CHECK (({grade_col_name} IS NULL) = ({event_type_col_name} = '{INTRODUCE}'))
+        )
+    """)
+    # "the history of a word"
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {review_event_table}_rank
+                       ON {review_event_table}({user_id_col_name}, {rank_col_name}, {event_id_col_name});""")
+    # "the tail of the log of a user"
+    cursor.execute(f"""CREATE INDEX IF NOT EXISTS {review_event_table}_user
+                       ON {review_event_table}({user_id_col_name}, {event_id_col_name});""")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {word_schedule_snapshot_table}(
+            {user_id_col_name} INTEGER PRIMARY KEY,
+            {last_event_id_col_name} INTEGER NOT NULL,
+            {created_at_col_name} REAL NOT NULL
+        )
+    """)
+
 
+def append_review_events(event_types, ranks, grades, days):
+    """
+    Append events to the log, all in one transaction (one executemany).
+    :param event_types: a list of INTRODUCE or REVIEW
+    :param ranks: a list (or numpy array) of ranks, same length
+    :param grades: a list of grades 0-5, None for INTRODUCE
+    :param days: the days of the events, counted from 1970-01-01
+    :return: the number of events
+    """
+    now = time.time()
+    user_id = get_user_id()
+    rows = [(user_id, rank, event_type, grade, day * 86400, now) for event_type, rank, grade, day in
+            zip(event_types, np.asarray(ranks).tolist(), list(grades), np.asarray(days).tolist())]
+    query = f"""INSERT INTO {review_event_table}
+                ({user_id_col_name}, {rank_col_name}, {event_type_col_name}, {grade_col_name}, {event_date_col_name},
+                 {created_at_col_name})
+                VALUES (?, ?, ?, ?, date(?, 'unixepoch'), ?);"""
+    with Tracing.span("dbAPI.append_review_events", rows=len(rows)), transaction() as conn:
+        conn.cursor().executemany(query, rows)
+    return len(rows)
 
+
+def get_review_events(after_event_id=0):
+    """
+    :param after_event_id: only the events after this one, e.g. get_compacted_event_id() for the tail of the log
+    :return: a list of (event_id, rank, event_type, grade, day) tuples, in the order they were recorded. grade is None
+            for INTRODUCE, day is counted from 1970-01-01.
+    """
+    query = f"""SELECT {event_id_col_name}, {rank_col_name}, {event_type_col_name}, {grade_col_name},
+                       CAST(julianday({event_date_col_name}) - 2440587.5 AS INTEGER)
+                FROM {review_event_table}
+                WHERE {user_id_col_name} = ? AND {event_id_col_name} > ?
+                ORDER BY {event_id_col_name};"""
+    with Tracing.span("dbAPI.get_review_events") as trace_span:
+        rows = _connect().cursor().execute(query, (get_user_id(), after_event_id)).fetchall()
+        trace_span.set(rows=len(rows))
+    return rows
+
+
+def get_compacted_event_id():
+    """
+    :return: the id of the last review event that is included in word_schedule, 0 if none
+    """
+    row = _connect().execute(f"SELECT {last_event_id_col_name} FROM {word_schedule_snapshot_table} "
+                             f"WHERE {user_id_col_name} = ?;", (get_user_id(),)).fetchone()
+    return row[0] if row else 0
+
+
+def get_last_review_event_id():
+    """
+    :return: the id of the last review event of the current user, 0 if none
+    """
+    row = _connect().execute(f"SELECT MAX({event_id_col_name}) FROM {review_event_table} "
+                             f"WHERE {user_id_col_name} = ?;", (get_user_id(),)).fetchone()
+    return row[0] or 0
+
+
+def get_log_tails_of_users(db_path, user_ids):
+    """
+    What SM2Planner.compact_users() needs to fold the tails of the logs of many users of one database file, read in
+    one pass instead of a load of the whole schedule per user.
+    :param db_path: the file of the users, see _group_users_by_database()
+    :return: a dictionary user_id -> (compacted event id, the events of the tail like get_review_events(), the
+            word_schedule of the ranks in the tail like get_word_schedule()). Users without a tail are left out.
+    """
+    conn = dbConnection.get_connection(_check_database(db_path))
+    users_json = json.dumps(user_ids)
+    compacted_event_ids = dict(conn.execute(f"""SELECT {user_id_col_name}, {last_event_id_col_name}
+                                                FROM {word_schedule_snapshot_table}
+                                                WHERE {user_id_col_name} IN (SELECT value FROM json_each(?));""",
+                                            (users_json,)).fetchall())
+    # one (user, after event) pair per user, as json, joined with the log through its index (USER_ID, EVENT_ID)
+    tails_json = json.dumps([[user_id, compacted_event_ids.get(user_id, 0)] for user_id in user_ids])
+    events = conn.execute(f"""SELECT e.{user_id_col_name}, e.{event_id_col_name}, e.{rank_col_name},
+                                     e.{event_type_col_name}, e.{grade_col_name},
+                                     CAST(julianday(e.{event_date_col_name}) - 2440587.5 AS INTEGER)
+                              FROM json_each(?) AS t
+                              JOIN {review_event_table} AS e
+                                  ON e.{user_id_col_name} = t.value ->> 0 AND e.{event_id_col_name} > t.value ->> 1
+                              ORDER BY e.{user_id_col_name}, e.{event_id_col_name};""", (tails_json,)).fetchall()
+    tails = {}
+    for user_id, *event in events:
+        tails.setdefault(user_id, (compacted_event_ids.get(user_id, 0), [], []))[1].append(tuple(event))
+    if not tails:
+        return tails
+    # the schedule of the ranks that the tails touch, the other ranks don't change
+    touched_json = json.dumps(sorted({(user_id, event[1]) for user_id, tail in tails.items() for event in tail[1]}))
+    schedule_rows = conn.execute(f"""SELECT w.{user_id_col_name}, w.{rank_col_name}, w.{ease_col_name},
+                                            w.{interval_days_col_name}, w.{repetitions_col_name},
+                                            w.{lapses_col_name},
+                                            CAST(julianday(w.{due_date_col_name}) - 2440587.5 AS INTEGER),
+                                            COALESCE(CAST(julianday(w.{last_reviewed_date_col_name}) - 2440587.5
+                                                          AS INTEGER), -1)
+                                     FROM json_each(?) AS t
+                                     JOIN {word_schedule_table} AS w
+                                         ON w.{user_id_col_name} = t.value ->> 0
+                                        AND w.{rank_col_name} = t.value ->> 1;""", (touched_json,)).fetchall()
+    for user_id, *row in schedule_rows:
+        tails[user_id][2].append(tuple(row))
+    return {user_id: (compacted_event_id, tail_events, _word_schedule_arrays(schedule))
+            for user_id, (compacted_event_id, tail_events, schedule) in tails.items()}
+
+
+#######################################################################################################################
+#######################################################################################################################
+########################################################## helpers ####################################################
+#######################################################################################################################
+#######################################################################################################################
+def _deserialize_rows_sqlite(row):
+    """
+    This function deserialize a row of the old (pickled) table study_progress, the row is obtained from sqlite3.
+    Only needed for the migration.
+    :param row: a tuple of (date_str, new_material_BLOB, recited_material_BLOB, being_recited_on_date_BLOB)
+    :return:
+    """
+    date_str = row[0]
+    new_material = pickle.loads(row[1])
+    recited_material = pickle.loads(row[2])
+    being_recited_on_date = pickle.loads(row[3])
+    return date_str, new_material, recited_material, being_recited_on_date
@@ -0,0 +1,163 @@
+"""
+This file manages the connections to the sqlite database files, so that the rest of the code doesn't need to open and
+close a connection for every query.
+- Each thread gets its own connection per database file, and keeps it open (sqlite connections shouldn't be shared
+  between threads).
+- The database is put in WAL mode, so readers (e.g. viewing the study progress) don't wait for a writer, and a writer
+  doesn't wait for the readers.
+- transaction() can be nested: only the outermost one commits, so several calls (e.g. the two updates of a recitation)
+  end up in one atomic commit. An inner transaction that fails is rolled back to where it started (a savepoint).
+- A database file can have other files attached read-only (see attach_read_only()), e.g. the shard of some users' study
+  progress reads the shared word list. They are read-only so that a transaction on the shard doesn't take the write
+  lock of the shared file.
+Usage:
+    with dbConnection.transaction("my_database.db") as conn:
+        conn.execute(...)
+"""
+import os
+import sqlite3
+import threading
+import urllib.request
+from contextlib import contextmanager
+import Tracing
+
+# Applied to every new connection. WAL + synchronous=NORMAL is safe against corruption, and only the last transactions
+# before a power loss can be lost (not on an application crash).
+connection_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # ms to wait for another writer, instead of failing with "database is locked" at once
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # negative means KiB, so 16MB of page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+}
+_attached_databases = {}  # db_path -> {schema name: path of the file attached read-only}, see attach_read_only()
+
+
+class ConnectionManager:
+    """
+    Keeps one open connection per thread for one database file.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._all_connections = []
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        """
+        :return: the connection of the current thread, it is opened the first time. Don't close it, use close().
+                The connection is in autocommit mode: a statement outside of transaction() is committed at once.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with Tracing.span("sqlite3.connect", db_path=self.db_path):
+                # uri=True for the "file:...?mode=ro" of the attached databases, a plain path is opened as before
+                conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False, uri=True)
+                for pragma, value in connection_pragmas.items():
+                    conn.execute(f"PRAGMA {pragma} = {value};")
+                for schema_name, attached_path in _attached_databases.get(self.db_path, {}).items():
+                    uri = f"file:{urllib.request.pathname2url(os.path.abspath(attached_path))}?mode=ro"
+                    conn.execute(f"ATTACH DATABASE ? AS {schema_name};", (uri,))
+            self._local.conn = conn
+            self._local.transaction_depth = 0
+            with self._lock:
+                self._all_connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        The outermost transaction takes the write lock at once (BEGIN IMMEDIATE), so two writers never deadlock on
+        upgrading a read lock. Nested transactions are savepoints.
+        """
+        conn = self.get_connection()
+        depth = self._local.transaction_depth
+        savepoint = f"nested_transaction_{depth}"
+        # the span covers waiting for the write lock, the body and the commit, and counts the rows changed in it
+        with Tracing.span("db.transaction" if depth == 0 else "db.savepoint") as trace_span:
+            total_changes_before = conn.total_changes
+            conn.execute("BEGIN IMMEDIATE;" if depth == 0 else f"SAVEPOINT {savepoint};")
+            self._local.transaction_depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.execute("ROLLBACK;")
+                else:
+                    conn.execute(f"ROLLBACK TO {savepoint};")
+                    conn.execute(f"RELEASE {savepoint};")
+                raise
+            else:
+                conn.execute("COMMIT;" if depth == 0 else f"RELEASE {savepoint};")
+            finally:
+                self._local.transaction_depth = depth
+                trace_span.set(rows_changed=conn.total_changes - total_changes_before)
+
+    def in_transaction(self):
+        return getattr(self._local, "transaction_depth", 0) > 0
+
+    def close(self):
+        """
+        Close the connection of the current thread.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        with self._lock:
+            self._all_connections.remove(conn)
+        conn.close()
+        self._local.conn = None
+
+    def close_all(self):
+        """
+        Close the connections of all threads, only call this when none of them is using its connection any more.
+        """
+        with self._lock:
+            connections, self._all_connections = self._all_connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_path):
+    """
+    :return: the ConnectionManager shared by everyone who uses db_path
+    """
+    with _managers_lock:
+        if db_path not in _managers:
+            _managers[db_path] = ConnectionManager(db_path)
+        return _managers[db_path]
+
+
+def get_connection(db_path):
+    return get_manager(db_path).get_connection()
+
+
+def attach_read_only(db_path, schema_name, attached_path):
+    """
+    The connections to db_path that are opened from now on have attached_path attached read-only as schema_name. Its
+    tables can be used without the schema name, as long as db_path has no table of the same name.
+    """
+    _attached_databases.setdefault(db_path, {})[schema_name] = attached_path
+
+
+def transaction(db_path):
+    return get_manager(db_path).transaction()
+
+
+def close_all():
+    """
+    Close every connection that was opened through this module.
+    """
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close_all()
@@ -0,0 +1,36 @@
+"""
+GenerationJob against FakeChatGPTServer: a 429 that doesn't go away ends with the word FAILED, instead of a job that
+never stops.
+    python -m pytest test_GenerationJob.py
+"""
+import os
+import pandas as pd
+from FakeChatGPTServer import start_fake_server
+from GenerationJob import GenerationJob
+
+words_df = pd.DataFrame([(1, "of / belongs to", "shel", "של")],
+                        columns=["Rank", "English", "Transliteration", "Hebrew"])
+
+
+def _run_job(tmp_path, **server_kwargs):
+    server, base_url = start_fake_server(rate_limit_every=1, retry_after_seconds=0.05, **server_kwargs)
+    try:
+        generation_job = GenerationJob("rate_limited", words_df, "fake-api-key", base_url=base_url, max_attempts=3,
+                                       max_rate_limited_attempts=4, max_backoff_seconds=0.1,
+                                       db_path=os.path.join(tmp_path, "job.db"))
+        return generation_job.run(), server.num_requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_permanent_rate_limit_fails_the_word(tmp_path):
+    report, num_requests = _run_job(tmp_path)
+    assert report["failed"] == 1
+    assert num_requests == 4
+
+
+def test_insufficient_quota_fails_at_once(tmp_path):
+    report, num_requests = _run_job(tmp_path, rate_limit_code="insufficient_quota")
+    assert report["failed"] == 1
+    assert num_requests == 1